@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Benchmark the ddtool_html.py pipeline on synthetic stations.
+Readings are a sinusoidal seasonal and daily cycle plus noise, with whole
+days missing at the gap rate.  Each station is ingested into a daily store
+(ddstore.py) and run through the report pipeline; the time, CPU and memory
+of every stage (see instrument.py) are summed over the stations of each
+scale and written to a json file to compare between versions.
+"""
+
+import sys
+import os
+import time
+import argparse
+from datetime import datetime
+import logging
+import json
+import platform
+import subprocess
+import tempfile
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import ddtool_html
+import ddstore
+import instrument
+
+# setup logging
+def getlvlnum(name):
+    return name if isinstance(name, int) else logging.getLevelName(name)
+def getlvlname(num):
+    return num if isinstance(num, str) else logging.getLevelName(num)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+logging.getLogger().setLevel(logging.INFO)
+
+
+## CONSTANTS ##
+# name: (stations, years, minutes between readings)
+SCALES = {'tiny': (1, 3, 60),
+          'small': (5, 10, 30),
+          'medium': (20, 20, 15),
+          'large': (100, 30, 5),
+         }
+END_DATE = '2019-08-31' # last day of synthetic data
+START_DATE = '2019-04-01' # degree-day accumulation start
+
+
+###
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scales", default='tiny,small',
+            help="Comma separated scales to run: "+
+            ", ".join("{} ({} stations x {} years x {} min)".format(k, *v) for k, v in SCALES.items()))
+    parser.add_argument("--stations", type=int, default=None,
+            help="Run a custom scale with this many stations (with --years and --freq-min)")
+    parser.add_argument("--years", type=int, default=10,
+            help="Years of readings per station for the custom scale")
+    parser.add_argument("--freq-min", type=int, default=15,
+            help="Minutes between readings for the custom scale")
+    parser.add_argument("--gap-rate", type=float, default=0.01,
+            help="Fraction of days without readings")
+    parser.add_argument("--seed", type=int, default=0,
+            help="Random seed for the synthetic readings")
+    parser.add_argument("--norm-method", default="median",
+            help="norm_method used by the pipeline")
+    parser.add_argument('-o', "--out-file", default=None,
+            help="json file for the results; Default is bench-<version>-<date>.json")
+    parser.add_argument("--work-dir", default=None,
+            help="Directory for the stores and reports; Default is a temporary directory")
+    parser.add_argument('-q', "--quiet", action='count', default=0,
+            help="Decrease verbosity")
+    parser.add_argument('-v', "--verbose", action='count', default=0,
+            help="Increase verbosity")
+    parser.add_argument("--verbose_level", type=int, default=0,
+            help="Set verbosity level as a number")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.getLogger().getEffectiveLevel()+
+                                 (10*(args.quiet-args.verbose-args.verbose_level)))
+
+    start_time = time.time()
+    logging.info("Started @ {}".format(
+                        datetime.fromtimestamp(time.time()).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z")))
+    logging.info("args="+str(args))
+
+    retval = main_process(args)
+
+    logging.info("Ended @ {} ({:.2f} s)".format(
+                        datetime.fromtimestamp(time.time()).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z"),
+                        time.time()-start_time))
+    return retval
+
+
+#######
+
+def main_process(args):
+    scales = {}
+    for k in [x.strip() for x in args.scales.split(',') if x.strip()]:
+        if k not in SCALES:
+            logging.critical("Unknown scale '{}'".format(k))
+            return 1
+        scales[k] = SCALES[k]
+    if args.stations:
+        scales['custom'] = (args.stations, args.years, args.freq_min)
+
+    ddtool_html.plt.switch_backend('Agg') # no windows
+    work_dir = args.work_dir if args.work_dir else tempfile.mkdtemp(prefix='ddbench')
+    os.makedirs(work_dir, exist_ok=True)
+    version = git_version()
+    results = {'version': version,
+               'date': datetime.now().astimezone().isoformat(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'pandas': pd.__version__,
+               'platform': platform.platform(),
+               'gap_rate': args.gap_rate,
+               'seed': args.seed,
+               'scales': {}}
+
+    try:
+        for name, (num_stations, years, freq_min) in scales.items():
+            logging.info("Scale '{}': {} stations x {} years x {} min".format(
+                            name, num_stations, years, freq_min))
+            results['scales'][name] = run_scale(name, num_stations, years, freq_min, work_dir, args)
+            print(format_scale(name, results['scales'][name]))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    out_fn = args.out_file
+    if not out_fn:
+        out_fn = "bench-{}-{}.json".format(version or 'unknown', datetime.now().strftime("%Y%m%d-%H%M%S"))
+    with open(out_fn, 'w') as fh:
+        json.dump(results, fh, indent=1, default=str)
+    logging.info("Results saved to '{}'".format(out_fn))
+    return 0
+
+
+def synthetic_readings(years, freq_min, gap_rate=0.01, end=END_DATE, mean=60., seasonal=15.,
+                       daily=10., noise=2., rng=None):
+    """
+    Readings every freq_min minutes for years ending on end (frame with 'T'
+    indexed by time): seasonal (coldest mid January) and daily (coldest at
+    3am) cosine cycles plus normal noise; days are dropped at gap_rate
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    last = pd.Timestamp(end) + pd.Timedelta(days=1) - pd.Timedelta(minutes=freq_min)
+    first = pd.Timestamp(end) - pd.DateOffset(years=years) + pd.Timedelta(days=1)
+    times = pd.date_range(first, last, freq='{}min'.format(freq_min))
+    doy = times.dayofyear.values
+    hr = times.hour.values + times.minute.values/60.
+    T = (mean - seasonal*np.cos(2*np.pi*(doy-15)/365.25) - daily*np.cos(2*np.pi*(hr-3)/24.)
+         + rng.normal(0, noise, len(times)))
+    if gap_rate > 0:
+        days = (times - first).days.values
+        gaps = rng.random(days[-1]+1) < gap_rate
+        gaps[-1] = False # keep the last day so the data ends on end
+        keep = ~gaps[days]
+        times, T = times[keep], T[keep]
+    return pd.DataFrame({'T': T}, index=times)
+
+
+def pipeline_args(store_fn, station, out_fn, norm_method='median'):
+    """
+    ddtool_html.main_process arguments (the ddtool_html.py defaults) for one station
+    """
+    return ddtool_html.default_args(temperatures_file=store_fn, out_file=out_fn, station=station,
+                                    start_date=START_DATE, base_temp=54.3, DD_per_gen=622.,
+                                    norm_method=norm_method, no_open=True,
+                                    cfg_filename='(bench_ddtool.py)')
+
+
+def run_scale(name, num_stations, years, freq_min, work_dir, args):
+    """
+    Ingest and run the pipeline for each synthetic station; returns the stage
+    totals (wall and cpu summed, peak RSS increase the max) over the stations
+    """
+    rng = np.random.default_rng(args.seed)
+    store_fn = os.path.join(work_dir, "{}.hdf".format(name))
+    if os.path.exists(store_fn):
+        os.remove(store_fn)
+    totals = {}
+    num_readings = 0
+    gen_s = 0.
+    wall_start = time.perf_counter()
+    for i in range(num_stations):
+        station = "S{:03d}".format(i)
+        tmp = time.perf_counter()
+        t = synthetic_readings(years, freq_min, args.gap_rate, rng=rng)
+        gen_s += time.perf_counter()-tmp
+        num_readings += t.shape[0]
+
+        instrument.reset()
+        instrument.start('ingest')
+        n = ddstore.ingest_readings(store_fn, station, t)
+        recs = [instrument.stop(rows=t.shape[0])]
+        del t
+        logging.debug("Station {}: {} days stored".format(station, n))
+
+        out_fn = os.path.join(work_dir, "{}-{}.html".format(name, station))
+        ddtool_html.main_process(pipeline_args(store_fn, station, out_fn, args.norm_method), None, None)
+        ddtool_html.plt.close('all')
+        recs.extend(instrument.stages())
+        for rec in recs:
+            if rec['depth'] > 0:
+                continue
+            tot = totals.setdefault(rec['stage'], {'wall_s': 0., 'cpu_s': 0.,
+                                                   'peak_rss_delta_bytes': None, 'rows': 0})
+            tot['wall_s'] += rec['wall_s']
+            tot['cpu_s'] += rec['cpu_s']
+            if rec['peak_rss_delta_bytes'] is not None:
+                tot['peak_rss_delta_bytes'] = max(tot['peak_rss_delta_bytes'] or 0,
+                                                  rec['peak_rss_delta_bytes'])
+            tot['rows'] += rec['rows'] or 0
+    return {'stations': num_stations,
+            'years': years,
+            'freq_min': freq_min,
+            'readings': num_readings,
+            'generate_s': gen_s,
+            'total_wall_s': time.perf_counter()-wall_start-gen_s,
+            'peak_rss_bytes': instrument.peak_rss(),
+            'stages': totals}
+
+
+def format_scale(name, res):
+    lines = ["{}: {} stations x {} years x {} min, {} readings, {:.2f} s".format(
+                name, res['stations'], res['years'], res['freq_min'], res['readings'], res['total_wall_s']),
+             "  {:<20s} {:>10s} {:>10s} {:>12s} {:>12s}".format(
+                "stage", "wall [s]", "cpu [s]", "peak RSS +MB", "rows")]
+    for stage, tot in res['stages'].items():
+        rss = tot['peak_rss_delta_bytes']
+        lines.append("  {:<20s} {:>10.3f} {:>10.3f} {:>12s} {:>12d}".format(
+                stage, tot['wall_s'], tot['cpu_s'],
+                "" if rss is None else "{:.1f}".format(rss/2**20), tot['rows']))
+    return "\n".join(lines)
+
+
+def git_version():
+    """
+    git describe of the ddtool checkout (None if not available)
+    """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+Serve degree-day reports from a local HTTP server that keeps the loaded
+station data (daily values with the normals projection) and degree-days
+in memory, so repeated requests skip the imports and the workbook parse.
+
+    python ddserve.py -f temps.xlsx -f store.hdf
+    http://127.0.0.1:8051/report?station=Country+Club&start_date=2018-04-01&base_temp=54.3&DD_per_gen=622
+    http://127.0.0.1:8051/report?...&format=html
+    http://127.0.0.1:8051/cdd?file=store.hdf&station=Country+Club&start_date=2017-04-01,2018-04-01&base_temp=54.3&DD_per_gen=622
+    http://127.0.0.1:8051/status
+
+/cdd answers from the cumulative degree-days stored in a daily store
+(ddstore.py), extended by the days added since the last request, with
+the sum restarted at each start date (observed days only; no projection).
+
+Cached stations are evicted least recently used first when the cache goes
+over --cache-mb, and dropped when their temperatures file changes.
+"""
+
+import sys
+import os
+import time
+import argparse
+from datetime import datetime
+import logging
+import json
+import threading
+from collections import OrderedDict as ordereddict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+import html
+
+import numpy as np
+import pandas as pd
+
+import ddtool_html
+
+# setup logging
+def getlvlnum(name):
+    return name if isinstance(name, int) else logging.getLevelName(name)
+def getlvlname(num):
+    return num if isinstance(num, str) else logging.getLevelName(num)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+logging.getLogger().setLevel(logging.INFO)
+
+
+###
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-f", "--temperatures-file", action='append', default=[],
+            help="Temperatures file (workbook or daily store) requests can use; can be repeated. "
+            "Requests choose one with file=<name> (default is the first)")
+    parser.add_argument("--host", default='127.0.0.1',
+            help="Address to listen on (only local by default)")
+    parser.add_argument("--port", type=int, default=8051,
+            help="Port to listen on")
+    parser.add_argument("--cache-mb", type=float, default=256,
+            help="Memory limit (MB) of the cached station data")
+    parser.add_argument("--watch-interval", type=float, default=2.,
+            help="Seconds between checks for changed temperatures files")
+    ddtool_html.add_load_arguments(parser) # load_temperature_data options
+    parser.add_argument('-q', "--quiet", action='count', default=0,
+            help="Decrease verbosity")
+    parser.add_argument('-v', "--verbose", action='count', default=0,
+            help="Increase verbosity")
+    parser.add_argument("--verbose_level", type=int, default=0,
+            help="Set verbosity level as a number")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.getLogger().getEffectiveLevel()+
+                                 (10*(args.quiet-args.verbose-args.verbose_level)))
+
+    if not args.temperatures_file:
+        parser.error("Must specify at least one temperatures file (-f)")
+
+    start_time = time.time()
+    logging.info("Started @ {}".format(
+                        datetime.fromtimestamp(time.time()).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z")))
+    logging.info("args="+str(args))
+
+    retval = main_process(args)
+
+    logging.info("Ended @ {} ({:.2f} s)".format(
+                        datetime.fromtimestamp(time.time()).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z"),
+                        time.time()-start_time))
+    return retval
+
+
+#######
+
+def main_process(args):
+    for fn in args.temperatures_file:
+        if not os.path.isfile(fn):
+            logging.critical("Temperatures file '{}' not found".format(fn))
+            return 1
+    cache = StationCache(args, int(args.cache_mb*2**20))
+    watcher = threading.Thread(target=cache.watch, args=(args.watch_interval,), daemon=True)
+    watcher.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), ReportHandler)
+    server.cache = cache
+    server.store_lock = threading.Lock() # /cdd appends to the stores
+    server.files = ordereddict((os.path.basename(fn), os.path.abspath(fn)) for fn in args.temperatures_file)
+    logging.info("Serving on http://{}:{}/".format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StationCache(object):
+    """
+    Least recently used cache of station data loaded with
+    ddtool_html.load_temperature_data, bounded by the total memory of the
+    entries.  Each entry keeps the daily values (with projection) in the
+    compact form of ddtool_html.compact_daily, the norm start date, the stat
+    of its file and the daily DD for each base_temp used.
+    """
+    def __init__(self, args, max_bytes):
+        self.args = args
+        self.max_bytes = max_bytes
+        self.entries = ordereddict() # (file, station) -> entry; most recently used last
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self.loading = {} # key -> Event set when its load is done
+
+    def load_args(self, station):
+        a = vars(self.args).copy()
+        a['station'] = station
+        return argparse.Namespace(**a)
+
+    def get(self, fn, station):
+        """
+        Entry for station in fn, loading it if not cached or if fn changed.
+        Only one request loads a station at a time; the others wait for it.
+        """
+        key = (fn, station)
+        while True:
+            st = file_stat(fn)
+            with self.lock:
+                e = self.entries.get(key)
+                if e is not None and e['stat'] == st:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return e, True
+                loading = self.loading.get(key)
+                if loading is None:
+                    if e is not None:
+                        logging.info("'{}' changed; reloading station '{}'".format(fn, station))
+                        self._remove(key)
+                    self.loading[key] = loading = threading.Event()
+                    break
+            loading.wait() # then use its entry (or load it if that failed)
+        # load outside the lock so other stations are still served
+        try:
+            e = self._load(key, st)
+        finally:
+            with self.lock:
+                del self.loading[key]
+            loading.set()
+        return e, False
+
+    def _load(self, key, st):
+        fn, station = key
+        try:
+            with ddtool_html.instrument.disabled(): # the stages of concurrent loads would interleave
+                tmp = ddtool_html.load_temperature_data(fn, self.load_args(station))
+        except (IndexError, KeyError, ValueError):
+            tmp = None # eg: no readings for the station
+        if not isinstance(tmp, tuple):
+            raise KeyError("Failed to load station '{}' from '{}'".format(station, os.path.basename(fn)))
+        t, norm_start = tmp
+        c = ddtool_html.compact_daily(t)
+        e = {'c': c, 'norm_start': norm_start, 'stat': st, 'dd': {},
+             'nbytes': ddtool_html.compact_daily_nbytes(c)}
+        with self.lock:
+            self.misses += 1
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = e
+            self.nbytes += e['nbytes']
+            self._evict()
+        return e
+
+    def daily_dd(self, e, base_temp):
+        """
+        Daily DD values (numpy array) of the entry for base_temp (cached)
+        """
+        with self.lock:
+            DD = e['dd'].get(base_temp)
+        if DD is None:
+            c = e['c']
+            DD = ddtool_html.compute_BMDD_Fs(pd.Series(c['minAT'].astype(np.float64)),
+                                             pd.Series(c['maxAT'].astype(np.float64)), base_temp)['DD'].values
+            with self.lock:
+                if base_temp not in e['dd']:
+                    e['dd'][base_temp] = DD
+                    e['nbytes'] += DD.nbytes
+                    if any(x is e for x in self.entries.values()):
+                        self.nbytes += DD.nbytes
+                        self._evict(keep=e)
+        return DD
+
+    def _remove(self, key):
+        e = self.entries.pop(key)
+        self.nbytes -= e['nbytes']
+
+    def _evict(self, keep=None):
+        # least recently used first; never the entry just used
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            key = next(iter(self.entries))
+            if self.entries[key] is keep:
+                break
+            logging.info("Evicting station '{}' of '{}'".format(key[1], os.path.basename(key[0])))
+            self._remove(key)
+
+    def watch(self, interval):
+        """
+        Drop entries whose file changed (run in a thread)
+        """
+        while True:
+            time.sleep(interval)
+            with self.lock:
+                for key in list(self.entries):
+                    if file_stat(key[0]) != self.entries[key]['stat']:
+                        logging.info("'{}' changed; dropping station '{}'".format(key[0], key[1]))
+                        self._remove(key)
+
+    def status(self):
+        with self.lock:
+            return {'entries': [{'file': os.path.basename(k[0]), 'station': k[1],
+                                 'days': len(e['c']['day']), 'base_temps': sorted(e['dd']),
+                                 'bytes': e['nbytes']}
+                                for k, e in self.entries.items()],
+                    'bytes': self.nbytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+def file_stat(fn):
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def report(cache, fn, station, start_date, base_temp, DD_per_gen, num_gen):
+    """
+    Generation dates and the cumulative degree-days for one request (dict)
+    """
+    e, hit = cache.get(fn, station)
+    c = e['c']
+    dates = c['start']+pd.to_timedelta(c['day'].astype(np.int64), unit='D')
+    DD = cache.daily_dd(e, base_temp)
+    cDD = ddtool_html.cumsum_dd(pd.Series(DD, index=dates))
+    start_dt = pd.to_datetime(start_date)
+    if start_dt not in cDD.index:
+        raise ValueError("start_date {} outside of the data ({} to {})".format(
+                            start_dt.date(), dates[0].date(), dates[-1].date()))
+    fdate = ddtool_html.generation_dates(cDD, start_dt, DD_per_gen, num_gen)
+    proj_start_dt = dates[(c['status'] & ddtool_html.STATUS_PROJECTED) != 0][0]
+    latest = dates[(c['status'] & ddtool_html.STATUS_INPUT) != 0][-1]
+    startcDD = cDD.loc[start_dt]
+    return {'file': os.path.basename(fn),
+            'station': station,
+            'start_date': str(start_dt.date()),
+            'base_temp': base_temp,
+            'DD_per_gen': DD_per_gen,
+            'num_gen': num_gen,
+            'generations': [None if pd.isnull(d) else str(d.date()) for d in fdate[1:]],
+            'projected': [bool(pd.isnull(d) or d >= proj_start_dt) for d in fdate[1:]],
+            'latest_temperature_date': str(latest.date()),
+            'cDD_at_latest': float(cDD.loc[latest]-startcDD) if latest >= start_dt else 0.,
+            'projection_start': str(proj_start_dt.date()),
+            'norm_start': str(e['norm_start'].date()),
+            'cached': hit}
+
+
+def cdd_report(fn, station, starts, base_temp, DD_per_gen, num_gen, min_readings_per_day):
+    """
+    Generation dates of each start date from the cumulative degree-days
+    stored in the daily store fn (dict)
+    """
+    if os.path.splitext(fn)[1].lower() not in ['.hdf', '.h5']:
+        raise ValueError("'{}' is not a daily store (.hdf)".format(os.path.basename(fn)))
+    segs = ddtool_html.stored_generation_dates(fn, station, base_temp, starts, DD_per_gen, num_gen,
+                                               min_readings_per_day)
+    return {'file': os.path.basename(fn),
+            'station': station,
+            'base_temp': base_temp,
+            'DD_per_gen': DD_per_gen,
+            'num_gen': num_gen,
+            'starts': [{'start_date': str(g['start_date'].date()),
+                        'generations': [None if pd.isnull(d) else str(d.date()) for d in g['fdate'][1:]],
+                        'end_date': str(g['end_date'].date()),
+                        'cDD': g['cDD'],
+                        'missing_days': g['missing_days']}
+                       for g in segs]}
+
+
+def report_html(r):
+    rows = "\n".join("<tr><td>{}</td><td>{}</td><td>{}</td></tr>".format(
+                        i+1, d if d else "not reached", "projected" if p else "")
+                     for i, (d, p) in enumerate(zip(r['generations'], r['projected'])))
+    return """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>{name} {start_date}</title></head>
+<body>
+<h2>{name}: generations from {start_date}</h2>
+<p>Base temperature {base_temp}, {DD_per_gen} degree-days per generation.
+Temperatures up to {latest_temperature_date} ({cDD_at_latest:.1f} degree-days since {start_date}),
+normals from {projection_start}.</p>
+<table border="1" cellpadding="4">
+<tr><th>Generation</th><th>Date</th><th></th></tr>
+{rows}
+</table>
+<p><small>{file}; {elapsed_ms:.1f} ms{from_cache}</small></p>
+</body>
+</html>""".format(rows=rows,
+                  name=html.escape(r['station'] or os.path.splitext(r['file'])[0]),
+                  from_cache=" (cached)" if r['cached'] else "",
+                  **{k: html.escape(v) if isinstance(v, str) else v for k, v in r.items()})
+
+
+class ReportHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        q = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path == '/status':
+            return self.send_json(200, self.server.cache.status())
+        if url.path not in ['/report', '/cdd']:
+            return self.send_json(404, {'error': "Unknown path '{}'; use /report, /cdd or /status".format(
+                                            url.path)})
+        missing = [k for k in ['start_date', 'base_temp', 'DD_per_gen'] if k not in q]
+        if missing:
+            return self.send_json(400, {'error': "Missing parameter(s): "+", ".join(missing)})
+        fn = self.server.files.get(q.get('file', next(iter(self.server.files))))
+        if fn is None:
+            return self.send_json(404, {'error': "Unknown file '{}'; one of: {}".format(
+                                            q['file'], ", ".join(self.server.files))})
+        start = time.perf_counter()
+        try:
+            if url.path == '/cdd':
+                with self.server.store_lock, ddtool_html.instrument.disabled():
+                    r = cdd_report(fn, q.get('station', ''), q['start_date'].split(','),
+                                   float(q['base_temp']), float(q['DD_per_gen']), int(q.get('num_gen', 3)),
+                                   self.server.cache.args.min_readings_per_day)
+            else:
+                r = report(self.server.cache, fn, q.get('station', ''), q['start_date'],
+                           float(q['base_temp']), float(q['DD_per_gen']), int(q.get('num_gen', 3)))
+        except KeyError as e: # station not found
+            return self.send_json(404, {'error': str(e.args[0])})
+        except ValueError as e:
+            return self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            logging.exception("Report request '{}' failed".format(self.path))
+            return self.send_json(500, {'error': repr(e)})
+        r['elapsed_ms'] = (time.perf_counter()-start)*1000
+        if q.get('format', 'json') == 'html' and url.path == '/report':
+            return self.send(200, report_html(r).encode(), 'text/html; charset=utf-8')
+        return self.send_json(200, r)
+
+    def send_json(self, code, obj):
+        self.send(code, json.dumps(obj, indent=1).encode(), 'application/json')
+
+    def send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Ingest raw temperature files (HOBO csv, Excel workbooks, MBF/COPY13.BAS files)
+into a persistent per-station store of daily min & max temperatures.
+Only readings newer than those already in the store are aggregated, so
+refreshing with the latest exports is quick.  ddtool_html.py can read the
+store directly as its temperatures_file.
+"""
+
+import sys
+import os
+import time
+import argparse
+from datetime import datetime
+import logging
+import glob
+
+import numpy as np
+import pandas as pd
+
+from temps2daily import load_tfile, daily_min_max
+from MBFTemps2CSV import load_datfile
+
+# setup logging
+def getlvlnum(name):
+    return name if isinstance(name, int) else logging.getLevelName(name)
+def getlvlname(num):
+    return num if isinstance(num, str) else logging.getLevelName(num)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+logging.getLogger().setLevel(logging.INFO)
+
+
+## CONSTANTS ##
+DAILY_KEY = 'daily' # table of station, date, minAT, maxAT, cntAT, flags
+LAST_READING_KEY = 'last_reading' # table of station, last_reading
+CDD_KEY = 'cdd' # table of station, base_temp, date, DD, cDD, missing (see ddtool_html.update_cumulative_dd)
+# flags bits
+FLAG_DAILY_INPUT = 1 # min & max came from a daily summary (eg: MBF files); cntAT is unknown
+MAX_STATION_NAME_LEN = 64
+
+
+###
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(dest='store', help="Daily store (HDF5) file; created if needed")
+    parser.add_argument(dest='files', nargs='*', default=[],
+            help="Raw temperature files to add (.csv HOBO, .xls/.xlsx workbook, others MBF)")
+    parser.add_argument("-s", "--station", default='',
+            help="Station name for files without one (MBF files); "
+            "for workbooks only this station is ingested")
+    parser.add_argument("--replace", action='store_true', default=False,
+            help="Replace all days covered by the files instead of only adding newer readings")
+    parser.add_argument("--list", action='store_true', default=False,
+            help="List the stations in the store and their date ranges")
+    parser.add_argument("--date-column", default="Date",
+            help="The label (header) of the column containing date+time in HOBO csv files")
+    parser.add_argument("--temperature-column", default="Temperature",
+            help="The label (header) of the column containing temperature in HOBO csv files. "
+            "Matches just the first part. NOTE: USES THE FIRST MATCHING COLUMN")
+    parser.add_argument("--skiprows", type=int, default=0,
+            help="Number of initial rows to skip of workbooks")
+    parser.add_argument("--station-col", default="STATION",
+            help="Column heading for station names in workbooks")
+    parser.add_argument("--date-col", default="DATE",
+            help="Column heading for dates in workbooks")
+    parser.add_argument("--time-col", default="TIME",
+            help="Column heading for time in workbooks")
+    parser.add_argument("--air-temp-col", default="TEMP_A_F",
+            help="Column heading for air temperatures in workbooks")
+    parser.add_argument("--timezone", default='',
+            help="Timezone (tz database name) to convert readings to before grouping by day")
+    parser.add_argument("--source-timezone", default='UTC',
+            help="Timezone of the readings (used with --timezone)")
+    parser.add_argument("--day-start-hour", type=int, default=0,
+            help="Local hour each (observation) day starts at")
+    parser.add_argument('-q', "--quiet", action='count', default=0,
+            help="Decrease verbosity")
+    parser.add_argument('-v', "--verbose", action='count', default=0,
+            help="Increase verbosity")
+    parser.add_argument("--verbose_level", type=int, default=0,
+            help="Set verbosity level as a number")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.getLogger().getEffectiveLevel()+
+                                 (10*(args.quiet-args.verbose-args.verbose_level)))
+
+    if not args.files and not args.list:
+        parser.error("Must specify input file(s) or --list")
+
+    start_time = time.time()
+    logging.info("Started @ {}".format(
+                        datetime.fromtimestamp(time.time()).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z")))
+    logging.info("args="+str(args))
+
+    retval = main_process(args)
+
+    logging.info("Ended @ {} ({:.2f} s)".format(
+                        datetime.fromtimestamp(time.time()).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z"),
+                        time.time()-start_time))
+    return retval
+
+
+#######
+
+def main_process(args):
+    files = []
+    for f in args.files:
+        if os.path.isfile(f):
+            files.append(f)
+        else:
+            tmp = glob.glob(f)
+            if not tmp:
+                logging.critical("Input '{}' not found".format(f))
+                return 1 # exit with error code
+            files.extend(tmp)
+
+    for f in files:
+        logging.info("Input file '{}'".format(f))
+        ext = os.path.splitext(f)[1].lower()
+        if ext == '.csv':
+            station, t = load_tfile(f, args.date_column, args.temperature_column)
+            if t is None:
+                logging.critical("Failed to load file '{}'".format(f))
+                return 1
+            readings = {station: t}
+        elif ext in ['.xls', '.xlsx']:
+            readings = load_workbook_readings(f, args)
+        else: # MBF daily min & max
+            if not args.station:
+                logging.critical("Must give --station for MBF file '{}'".format(f))
+                return 1
+            daily = load_mbf_daily(f)
+            if daily is None:
+                logging.critical("Failed to load file '{}'".format(f))
+                return 1
+            n = upsert_daily(args.store, args.station, daily)
+            logging.info("{}: {} days stored".format(args.station, n))
+            continue
+        for station, t in readings.items():
+            n = ingest_readings(args.store, station, t, replace=args.replace,
+                                tz=args.timezone, source_tz=args.source_timezone,
+                                day_start_hour=args.day_start_hour)
+            logging.info("{}: {} days stored".format(station, n))
+
+    if args.list and os.path.isfile(args.store):
+        print(store_summary(args.store).to_string())
+    return 0
+
+
+def load_workbook_readings(fn, args):
+    """
+    Readings from a workbook with one row per reading (station, date, time,
+    temperature) as a dict of station -> frame of readings ('T') indexed by time.
+    """
+    df = pd.read_excel(fn, skiprows=args.skiprows)
+    df = df.rename(columns={args.station_col:'station',
+                            args.date_col:'date',
+                            args.time_col:'time',
+                            args.air_temp_col:'T'})
+    if args.station:
+        df = df.loc[df['station'] == args.station]
+    df.index = pd.to_datetime(df['date']) + pd.to_timedelta(df['time'].astype(str))
+    df = df[['station', 'T']].dropna()
+    return {station: t[['T']].sort_index() for station, t in df.groupby('station')}
+
+
+def load_mbf_daily(fn):
+    """
+    Daily min & max temperatures from an MBF (COPY13.BAS) file as a store frame
+    """
+    dat = load_datfile(fn)
+    if not dat:
+        return None
+    dat = pd.DataFrame(dat, columns=['jday', 'day', 'month', 'year', 'minAT', 'maxAT', 'date_str', 'filename'])
+    dat = dat.loc[dat['date_str'] != '']
+    daily = pd.DataFrame({'minAT': dat['minAT'].values,
+                          'maxAT': dat['maxAT'].values,
+                          'cntAT': 0,
+                          'flags': FLAG_DAILY_INPUT},
+                         index=pd.DatetimeIndex(pd.to_datetime(dat['date_str'].values), name='date'))
+    return daily[~daily.index.duplicated(keep='last')].sort_index()
+
+
+def ingest_readings(store_fn, station, t, replace=False, **day_kwargs):
+    """
+    Aggregate readings (frame with 'T' indexed by time) for station to days
+    and upsert them in the store.  Unless replace, only readings after the
+    last one already ingested for the station are used, and a day which is
+    partly in the store is combined with the stored values.
+    Returns the number of days stored.
+    """
+    stored_last = last_reading(store_fn, station)
+    last = None if replace else stored_last
+    if last is not None:
+        t = t.loc[t.index > last]
+    if t.shape[0] == 0:
+        return 0
+    d = daily_min_max(t, **day_kwargs)
+    daily = pd.DataFrame({'minAT': d['minT'],
+                          'maxAT': d['maxT'],
+                          'cntAT': d['cntT'],
+                          'flags': 0},
+                         index=d.index)
+    if last is not None: # combine with days already (partly) stored
+        old = read_store(store_fn, station, daily.index[0], daily.index[-1])
+        both = daily.index.intersection(old.index)
+        if len(both) > 0:
+            daily.loc[both, 'minAT'] = np.fmin(daily.loc[both, 'minAT'], old.loc[both, 'minAT'])
+            daily.loc[both, 'maxAT'] = np.fmax(daily.loc[both, 'maxAT'], old.loc[both, 'maxAT'])
+            daily.loc[both, 'cntAT'] += old.loc[both, 'cntAT'].astype(np.int64)
+    n = upsert_daily(store_fn, station, daily)
+
+    # never move it back (eg: replacing the days of an older file)
+    last = t.index.max() if stored_last is None else max(stored_last, t.index.max())
+    with pd.HDFStore(store_fn, mode='a') as store:
+        if LAST_READING_KEY in store:
+            store.remove(LAST_READING_KEY, where="station == {!r}".format(station))
+        store.append(LAST_READING_KEY,
+                     pd.DataFrame({'station': [station], 'last_reading': [last]}),
+                     data_columns=['station'], index=False,
+                     min_itemsize={'station': MAX_STATION_NAME_LEN})
+    return n
+
+
+def upsert_daily(store_fn, station, daily):
+    """
+    Replace (or add) the days of daily (frame with minAT, maxAT, cntAT and
+    flags indexed by date) for station in the store; stored days in gaps of
+    daily are kept.  Returns the number of days.
+    """
+    if daily.shape[0] == 0:
+        return 0
+    df = pd.DataFrame({'station': station,
+                       'date': daily.index.values,
+                       'minAT': daily['minAT'].values.astype(np.float32),
+                       'maxAT': daily['maxAT'].values.astype(np.float32),
+                       'cntAT': np.clip(daily['cntAT'].values, 0, np.iinfo(np.uint16).max).astype(np.uint16),
+                       'flags': daily['flags'].values.astype(np.uint8)})
+    with pd.HDFStore(store_fn, mode='a') as store:
+        if DAILY_KEY in store:
+            # one remove per run of consecutive days
+            for first, last in date_runs(daily.index):
+                store.remove(DAILY_KEY, where="station == {!r} & date >= {!r} & date <= {!r}".format(
+                        station, str(first), str(last)))
+        store.append(DAILY_KEY, df, data_columns=['station', 'date'], index=False,
+                     min_itemsize={'station': MAX_STATION_NAME_LEN})
+        if CDD_KEY in store: # cumulative values from the changed days on are stale
+            store.remove(CDD_KEY, where="station == {!r} & date >= {!r}".format(
+                    station, str(daily.index.min())))
+    return df.shape[0]
+
+
+def date_runs(idx):
+    """
+    (first, last) dates of each run of consecutive days in idx
+    """
+    days = np.unique(pd.DatetimeIndex(idx).normalize().values)
+    brk = np.flatnonzero(np.diff(days) != np.timedelta64(1, 'D'))
+    firsts = np.concatenate((days[:1], days[brk+1]))
+    lasts = np.concatenate((days[brk], days[-1:]))
+    return [(pd.Timestamp(a), pd.Timestamp(b)) for a, b in zip(firsts, lasts)]
+
+
+def read_cdd(store_fn, station, base_temp, start=None):
+    """
+    Stored cumulative degree-days (DD, cDD, missing indexed by date) for
+    station and base_temp; optionally only from start on.
+    """
+    where = "station == {!r} & base_temp == {!r}".format(station, float(base_temp))
+    if start is not None:
+        where += " & date >= {!r}".format(str(pd.Timestamp(start)))
+    df = None
+    if os.path.isfile(store_fn):
+        with pd.HDFStore(store_fn, mode='r') as store:
+            if CDD_KEY in store:
+                df = store.select(CDD_KEY, where=where)
+    if df is None:
+        df = pd.DataFrame(columns=['date', 'DD', 'cDD', 'missing'])
+    df = df.set_index(pd.DatetimeIndex(df['date'], name='date'))
+    return df[['DD', 'cDD', 'missing']].sort_index()
+
+
+def append_cdd(store_fn, station, base_temp, cdd):
+    """
+    Append cumulative degree-days (frame of DD, cDD, missing indexed by date)
+    for station and base_temp to the store.
+    """
+    df = pd.DataFrame({'station': station,
+                       'base_temp': float(base_temp),
+                       'date': cdd.index.values,
+                       'DD': cdd['DD'].values.astype(np.float64),
+                       'cDD': cdd['cDD'].values.astype(np.float64),
+                       'missing': cdd['missing'].values.astype(np.int32)})
+    with pd.HDFStore(store_fn, mode='a') as store:
+        store.append(CDD_KEY, df, data_columns=['station', 'base_temp', 'date'], index=False,
+                     min_itemsize={'station': MAX_STATION_NAME_LEN})
+
+
+def read_store(store_fn, station, start=None, end=None):
+    """
+    Daily values (minAT, maxAT, cntAT, flags indexed by date) for station
+    from the store; optionally only from start to end (inclusive).
+    """
+    where = ["station == {!r}".format(station)]
+    if start is not None:
+        where.append("date >= {!r}".format(str(pd.Timestamp(start))))
+    if end is not None:
+        where.append("date <= {!r}".format(str(pd.Timestamp(end))))
+    with pd.HDFStore(store_fn, mode='r') as store:
+        if DAILY_KEY not in store:
+            df = pd.DataFrame(columns=['date', 'minAT', 'maxAT', 'cntAT', 'flags'])
+        else:
+            df = store.select(DAILY_KEY, where=" & ".join(where))
+    df = df.set_index(pd.DatetimeIndex(df['date'], name='date'))
+    return df[['minAT', 'maxAT', 'cntAT', 'flags']].sort_index()
+
+
+def last_reading(store_fn, station):
+    """
+    Time of the last reading ingested for station (None if none)
+    """
+    if not os.path.isfile(store_fn):
+        return None
+    with pd.HDFStore(store_fn, mode='r') as store:
+        if LAST_READING_KEY not in store:
+            return None
+        df = store.select(LAST_READING_KEY, where="station == {!r}".format(station))
+    if df.shape[0] == 0:
+        return None
+    return pd.Timestamp(df['last_reading'].max())
+
+
+def store_summary(store_fn):
+    """
+    First date, last date, and number of days for each station in the store
+    """
+    with pd.HDFStore(store_fn, mode='r') as store:
+        df = store.select(DAILY_KEY, columns=['station', 'date'])
+    gb = df.groupby('station')['date']
+    return pd.DataFrame({'first': gb.min(), 'last': gb.max(), 'days': gb.count()})
+
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
@@ -20,6 +20,8 @@ import pandas as pd
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 
+import instrument
+
 # setup logging
 def getlvlnum(name):
     return name if isinstance(name, int) else logging.getLevelName(name)
@@ -90,7 +92,8 @@ def main(argv):
             if k in defaults:
                 defaults[k] = int(defaults[k])
         for k in ['base_temp',
-                  'DD_per_gen']:
+                  'DD_per_gen',
+                  'profile_sample']:
             if k in defaults:
                 defaults[k] = float(defaults[k])
         #defaults['overwrite'] = defaults['overwrite'].lower() in ['true', 'yes', 'y', '1']
@@ -136,6 +139,12 @@ def main(argv):
             help="Column heading for time in data file")
     parser.add_argument("--air-temp-col", default="TEMP_A_F",
             help="Column heading for air temperatures in data file")
+    parser.add_argument("--profile", nargs='?', const=True, default=False, metavar='PREFIX',
+            help="Profile the run with cProfile; writes PREFIX.prof and PREFIX.collapsed.txt "
+            "(stacks for flamegraph tools). Default PREFIX is the script name and time")
+    parser.add_argument("--profile-sample", type=float, default=0, metavar='MS',
+            help="With --profile, sample the stack every MS milliseconds instead of cProfile "
+            "(lower overhead for long batch runs)")
     parser.add_argument('-q', "--quiet", action='count', default=0,
             help="Decrease verbosity")
     parser.add_argument('-v', "--verbose", action='count', default=0,
@@ -159,7 +168,11 @@ def main(argv):
                         datetime.fromtimestamp(time.time()).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z")))
     logging.info("args="+str(args))
 
-    retval = main_process(args)
+    if args.profile:
+        retval = instrument.profile_call(main_process, instrument.profile_prefix(args.profile, __file__),
+                                         args.profile_sample/1000., args)
+    else:
+        retval = main_process(args)
 
     # cleanup and exit
     logging.info("Ended @ {}".format(
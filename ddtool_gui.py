@@ -22,12 +22,17 @@ import pandas as pd
 import matplotlib as mpl
 mpl.use('TkAgg')
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
 import tkinter as tk
 from tkinter import ttk
 import tkinter.filedialog
 import tkinter.font
 
+import ddtool_html
+import instrument
+import tkworker
+
 # setup logging
 def getlvlnum(name):
     return name if isinstance(name, int) else logging.getLevelName(name)
@@ -43,8 +48,18 @@ INLINE_DEFAULT_CFG_FILE = """
 # base_temp: 54.3
 # DD_per_gen: 622
 # num_gen: 3
+# dd_method: sine # 'sine' (from daily min & max) or 'hourly' (integrate the readings where they cover the day)
+# dh_max_gap: 90 # minutes; longer gaps between readings are not integrated ('hourly' dd_method)
+# dh_min_coverage: 20 # hours of a day the readings must cover to use the integral ('hourly' dd_method)
 
 # min_readings_per_day: 4 # exclude days with too few temperature reads/points
+# night_hours: # local hours (eg: 0-8, end excluded) a day needs a reading in for its min; empty to not check
+# afternoon_hours: # local hours (eg: 12-18) a day needs a reading in for its max; empty to not check
+# qc_mad_k: 0 # drop readings this many MADs from the rolling median (eg: 5); 0 to not check
+# qc_window: 120 # minutes of readings in the rolling median window (qc_mad_k)
+# qc_max_rate: 0 # drop single readings jumping faster than this (degrees per hour) and back; 0 to not check
+# neighbor_fill: False # fill missing days from the other stations in the temperatures file (per month regressions)
+# neighbor_min_corr: 0.8 # least correlation of a neighbor's monthly fit to use it (neighbor_fill)
 # max_num_years_to_norm: 6
 # norm_method: median # use either 'mean' or 'median' for normal/typical temperatures
 # num_years_to_add_for_projection: 3
@@ -194,25 +209,20 @@ def main(argv):
 
 #######
 
-DDTOOL_DEFAULT_CONFIG = {
-        'cfg_filename': '',
-        'temperatures_file': '',
-        'station': '',
-        'skiprows': '0',
-        'station_col': 'STATION',
-        'date_col': 'DATE',
-        'time_col': 'TIME',
-        'air_temp_col': 'TEMP_A_F',
-        'start_date': '',
-        'base_temp': '54.3',
-        'DD_per_gen': '622',
-        'num_gen': '3',
-        'min_readings_per_day': '4', # exclude days with too few temperature reads/points
-        'max_num_years_to_norm': '6',
-        'norm_method': 'median', # use either 'mean' or 'median' for normal/typical temperatures
-        'num_years_to_add_for_projection': '3',
-        'interpolation_window': '3',  # number of points to average on ends of gaps before interpolating
-        }
+def default_config():
+    """
+    The cfg dict (of strings) of ddtool_html's defaults for the options the gui uses
+    """
+    d = vars(ddtool_html.default_args(base_temp=54.3, DD_per_gen=622))
+    keys = (['cfg_filename', 'temperatures_file', 'station', 'start_date', 'base_temp', 'DD_per_gen',
+             'num_gen'] + list(ddtool_html.dd_defaults()) + list(ddtool_html.load_defaults()))
+    return {k: '' if d[k] is None else str(d[k]) for k in keys}
+
+DDTOOL_DEFAULT_CONFIG = default_config()
+# types to convert the cfg strings to (from the defaults; others stay strings)
+CFG_TYPES = {k: type(v) for k,v in vars(ddtool_html.default_args(base_temp=54.3, DD_per_gen=622.)).items()
+             if k in DDTOOL_DEFAULT_CONFIG and type(v) in (int, float, bool)}
+AUTO_RUN_DELAY_MS = 300 # re-run this long after the last parameter edit
 
 
 def load_config(cfg_filename):
@@ -230,6 +240,249 @@ def load_config(cfg_filename):
     return cfg
 
 
+def cfg_args(cfg):
+    """
+    Namespace (like ddtool_html's args) from a cfg dict of strings; raises
+    ValueError for values which don't convert
+    """
+    a = dict(cfg)
+    for k,typ in CFG_TYPES.items():
+        if typ is bool:
+            a[k] = str(a[k]).lower() in ['true', 'yes', 'y', '1']
+        else:
+            a[k] = typ(a[k])
+    return argparse.Namespace(**a)
+
+
+## pipeline stages (run in a tkworker.Worker thread; no Tk or pyplot calls)
+def stage_load(args, out):
+    # the readings are kept for the 'hourly' dd_method
+    tmp = ddtool_html.load_temperature_data(args.temperatures_file, args,
+                                            keep_readings=(args.dd_method == 'hourly'))
+    if not isinstance(tmp, tuple):
+        raise ValueError("Failed to load temperatures file '{}'".format(args.temperatures_file))
+    return {'t': tmp[0], 'norm_start': tmp[1], 'readings': tmp[2] if len(tmp) > 2 else None}
+
+
+def stage_dd(args, out):
+    t = out['load']['t']
+    instrument.start('DD')
+    dd = ddtool_html.compute_BMDD_Fs(t['minAT'], t['maxAT'], args.base_temp)
+    if out['load']['readings'] is not None:
+        dh = ddtool_html.compute_degree_hours(out['load']['readings'], args.base_temp, args.dh_max_gap)
+        ddtool_html.apply_degree_hours(dd, dh, args.dh_min_coverage)
+    instrument.stop(rows=dd.shape[0])
+    return dd
+
+
+def stage_solve(args, out):
+    instrument.start('generation solve')
+    cDD = ddtool_html.cumsum_dd(out['DD']['DD'])
+    fdate = ddtool_html.generation_dates(cDD, args.start_date, args.DD_per_gen, args.num_gen)
+    instrument.stop(rows=args.num_gen)
+    return {'cDD': cDD, 'fdate': fdate}
+
+
+class StageGraph(object):
+    """
+    Pipeline stages with the cfg parameters and the earlier stages each one
+    depends on.  A stage is only re-run if it hasn't run yet, one of its
+    parameters changed since it ran or a stage it depends on is re-run.
+    Stages are called as func(args, outputs) with outputs the results of
+    the earlier stages by name.  gui stages must run in the Tk thread.
+    Only outputs is written by the stages run in the worker thread; the
+    parameters each stage ran with are recorded in the Tk thread (record).
+    """
+    def __init__(self):
+        self.stages = {} # in dependency order
+        self.outputs = {}
+        self.used = {} # parameter values of the last completed run of each stage
+
+    def add(self, name, func, params=(), deps=(), timers=(), gui=False):
+        # timers: the instrument stages it runs (for progress)
+        self.stages[name] = {'func': func, 'params': list(params), 'deps': list(deps),
+                             'timers': list(timers), 'gui': gui}
+
+    def stale(self, cfg):
+        """
+        Names of the stages which need to (re-)run for cfg, in order
+        """
+        out = []
+        for name, st in self.stages.items():
+            used = self.used.get(name)
+            if (used is None or name not in self.outputs or any(d in out for d in st['deps']) or
+                    any(used[k] != cfg.get(k) for k in st['params'])):
+                out.append(name)
+        return out
+
+    def forget(self, names):
+        # before running names: they stay stale until the run is recorded
+        for name in names:
+            self.used.pop(name, None)
+
+    def record(self, names, cfg):
+        # after names ran for cfg
+        for name in names:
+            self.used[name] = {k: cfg.get(k) for k in self.stages[name]['params']}
+
+    def timers(self, names):
+        return [x for name in names for x in self.stages[name]['timers']]
+
+    def run(self, names, args):
+        """
+        Run the stages names (from stale) in order.  Their old outputs are
+        dropped first so they stay stale if one fails or is cancelled.
+        """
+        for name in names:
+            self.outputs.pop(name, None)
+        for name in names:
+            self.outputs[name] = self.stages[name]['func'](args, self.outputs)
+        return self.outputs
+
+
+class DDPlot(object):
+    """
+    The GUI's cumulative DD (top) and daily temperature (bottom) plots.
+    Updates change the data of the existing artists (set_data) and, if the
+    axes don't need to change, redraw only them over the cached background
+    (blitting).  The temperatures are only redrawn after a (re)load.
+    """
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.fig = canvas.figure
+        gs = mpl.gridspec.GridSpec(2, 1, height_ratios=[3,2], figure=self.fig)
+        self.ax = self.fig.add_subplot(gs[0,0])
+        self.tax = self.fig.add_subplot(gs[1,0])
+        ax = self.ax
+        # animated artists are left out of full draws and drawn by _draw_animated
+        self.prev = mpl.collections.LineCollection([], colors='k', alpha=0.25, zorder=1,
+                                                   label='previous years', animated=True)
+        ax.add_collection(self.prev)
+        self.obs, = ax.plot([], [], '-', c='b', lw=2, label='from start date', animated=True)
+        self.proj, = ax.plot([], [], '-', c='r', lw=2, label='projection', animated=True)
+        self.gens = [] # artists for each generation
+        self.tlines = [] # start date and generation lines on the temperature plot
+        self.t = None # temperatures currently plotted
+        self.lims = None # what the last full draw depends on
+        self.background = None
+        ax.set_ylabel('thermal accumulation [degree-days]')
+        canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _animated(self):
+        return ([self.prev, self.obs, self.proj] + [x for g in self.gens for x in g] +
+                self.tlines)
+
+    def _on_draw(self, event):
+        # full draw; save it without the animated artists then add them
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for a in self._animated():
+            self.fig.draw_artist(a)
+
+    def _plot_temperatures(self, t, norm_start):
+        tax = self.tax
+        tax.clear()
+        t2 = t.loc[norm_start:]
+        regions = [['input',        (t2['filled'] == 0) & (t2['normN'] == 0), 'C0'],
+                   ['interpolated', (t2['filled'] != 0) & ~t2['neighbor'] & (t2['normN'] == 0), 'C1'],
+                   ['neighbor',     t2['neighbor'] & (t2['normN'] == 0),      'C3'],
+                   ['projected',    (t2['normN'] != 0),                       'C2'],
+                  ]
+        x = np.column_stack((t2.index, t2.index+pd.Timedelta(days=1))).flatten()
+        for label, mask, color in regions:
+            m = np.repeat(mask.values, 2)
+            ymin = np.where(m, np.repeat(t2['minAT'].values, 2), np.nan)
+            ymax = np.where(m, np.repeat(t2['maxAT'].values, 2), np.nan)
+            tax.fill_between(x, ymin, ymax, linewidth=0.5,
+                             facecolor=mpl.colors.to_rgba(color, alpha=0.5),
+                             edgecolor=mpl.colors.to_rgba(color, alpha=1),
+                             label=label)
+        tax.set_xlim(t2.index[0], t2.index[-1]+pd.Timedelta(days=1))
+        tax.set_ylabel("temperature")
+        tax.legend(loc='lower left', ncol=4, fontsize='small')
+        self.tlines = []
+
+    def update(self, args, out):
+        """
+        Show the StageGraph outputs out for args (the 'plot' stage)
+        """
+        t = out['load']['t']
+        cDD = out['solve']['cDD']
+        fdate = out['solve']['fdate']
+        start_dt = pd.to_datetime(args.start_date)
+        if t is not self.t:
+            self._plot_temperatures(t, out['load']['norm_start'])
+            self.t = t
+            self.lims = None
+
+        # accumulation from start_date (and the same day in previous years)
+        end_dt = fdate[-1] if not pd.isnull(fdate[-1]) else cDD.index[-1]
+        c = cDD.values
+        i0 = cDD.index.get_loc(start_dt)
+        i1 = cDD.index.get_loc(end_dt)+1
+        days = np.arange(i1-i0)
+        y = c[i0:i1]-c[i0]
+        proj = t['normN'].values[i0:i1] > 0
+        self.obs.set_data(days[~proj], y[~proj])
+        self.proj.set_data(days[proj], y[proj])
+        target = args.DD_per_gen*args.num_gen
+        segs = []
+        for yr in range(cDD.index[0].year, start_dt.year):
+            try:
+                j0 = cDD.index.get_loc(start_dt.replace(year=yr))
+            except KeyError:
+                continue
+            tmp = c[j0:]-c[j0]
+            reach = np.nonzero(tmp > target)[0]
+            tmp = tmp[:reach[0]+1] if len(reach) else tmp
+            segs.append(np.column_stack((np.arange(len(tmp)), tmp)))
+        self.prev.set_segments(segs)
+
+        # generations
+        full = len(self.gens) != args.num_gen or len(self.tlines) != args.num_gen+1
+        if full:
+            for a in [x for g in self.gens for x in g] + self.tlines:
+                a.remove()
+            trans = mpl.transforms.blended_transform_factory(self.ax.transData, self.ax.transAxes)
+            self.gens = [(self.ax.axhline(0, c='k', ls=':', alpha=0.5, lw=1, animated=True),
+                          self.ax.axvline(0, c='k', ls=':', alpha=0.5, lw=1, animated=True),
+                          self.ax.text(0, 0, '', transform=trans, ha='left', va='bottom', animated=True))
+                         for i in range(args.num_gen)]
+            self.tlines = [self.tax.axvline(0, c='k', ls=':' if i else '--', alpha=0.5, lw=1, animated=True)
+                           for i in range(args.num_gen+1)]
+        for i, (hl, vl, txt) in enumerate(self.gens):
+            hl.set_ydata([args.DD_per_gen*(i+1)]*2)
+            d = fdate[i+1]
+            x = np.nan if pd.isnull(d) else (d-start_dt).days
+            vl.set_xdata([x, x])
+            txt.set_x(x)
+            txt.set_text('' if pd.isnull(d) else ' F{:d}: {:d}'.format(i+1, int(x)))
+        for d, tl in zip(fdate, self.tlines):
+            x = np.nan if pd.isnull(d) else mpl.dates.date2num(d)
+            tl.set_xdata([x, x])
+
+        # axes limits (rounded up so small changes keep them)
+        lims = (start_dt, 30*np.ceil(max(len(days), 1)/30.), 100*np.ceil(target*1.05/100.),
+                args.num_gen)
+        if full or lims != self.lims or self.background is None or not self.canvas.supports_blit:
+            self.lims = lims
+            self.ax.set_xlim(0, lims[1])
+            self.ax.set_ylim(0, lims[2])
+            self.ax.set_xlabel('days after {}'.format(start_dt.date()))
+            self.ax.legend(loc='upper left')
+            self.canvas.draw_idle()
+        else:
+            self.canvas.restore_region(self.background)
+            self._draw_animated()
+            self.canvas.blit(self.fig.bbox)
+
+
+# cfg parameters used by load_temperature_data
+LOAD_PARAMS = ['temperatures_file', 'station'] + list(ddtool_html.load_defaults()) + ['dd_method']
+
+
 class DDToolFrame(ttk.Frame):
 
     def __init__(self, parent, cfg, *args, **kwargs):
@@ -277,7 +530,7 @@ class DDToolFrame(ttk.Frame):
         #self.add_labeled_entry(tfile_frame, 'station_col', cfg['station_col'])
         
         self.load_tfile_button = tk.Button(tfile_frame, text='Load Temperatures File',
-                    state='disabled')
+                    state='disabled', command=self._run)
         self.load_tfile_button.pack(side=tk.BOTTOM)
 
         ttk.Separator(parent, orient='horizontal').pack(anchor=tk.W, fill=tk.X)
@@ -287,16 +540,41 @@ class DDToolFrame(ttk.Frame):
         self.add_labeled_entry(parent, 'start_date', cfg['start_date'], self._date_entry_validate)
 
 
-        self.tktext = tk.Text(master=parent)
+        self.canvas = FigureCanvasTkAgg(mpl.figure.Figure(figsize=(7,5), layout='tight'),
+                                        master=parent)
+        self.canvas.get_tk_widget().pack(anchor=tk.W, expand=1, fill=tk.BOTH)
+        self.plot = DDPlot(self.canvas)
+
+        self.tktext = tk.Text(master=parent, height=10)
         self.tktext.bind("<Key>", lambda _: 'break') # make read-only
         self.tktext.pack(anchor=tk.W, expand=1, fill=tk.BOTH)
 
-        run_button = ttk.Button(parent, text='RUN',
-                        command=lambda : self.load_tfile_button.config(state='normal'))
-        run_button.pack(anchor=tk.S, padx=3, pady=3)
+        foo = ttk.Frame(parent)
+        foo.pack(anchor=tk.S, fill=tk.X, padx=3, pady=3)
+        self.progress = ttk.Progressbar(foo, orient='horizontal', mode='determinate', maximum=100)
+        self.progress.pack(side=tk.LEFT, fill=tk.X, expand=1, padx=3)
+        self.cancel_button = ttk.Button(foo, text='Cancel', state='disabled', command=self._cancel)
+        self.cancel_button.pack(side=tk.RIGHT)
+        self.worker = None # tkworker.Worker of the current run
+        self.run_button = ttk.Button(parent, text='RUN', command=self._run)
+        self.run_button.pack(anchor=tk.S, padx=3, pady=3)
         quit_button = ttk.Button(parent, text='Quit', command=self._quit)
         quit_button.pack(anchor=tk.SE, padx=3, pady=3)
 
+        # RUN only re-runs the stages whose parameters changed
+        self.graph = StageGraph()
+        self.graph.add('load', stage_load, LOAD_PARAMS,
+                       timers=['load', 'qc', 'aggregate', 'neighbor fill', 'gap-fill', 'normals', 'projection'])
+        self.graph.add('DD', stage_dd, ['base_temp'] + list(ddtool_html.dd_defaults()), ['load'],
+                       timers=['DD'])
+        self.graph.add('solve', stage_solve, ['start_date', 'DD_per_gen', 'num_gen'], ['DD'],
+                       timers=['generation solve'])
+        self.graph.add('plot', self.plot.update, [], ['solve'], gui=True)
+        self._auto_run_id = None
+        for e in self.ent.values():
+            e.var.trace_add('write', self._param_changed)
+        self._update_stale()
+
         parent.update()
 
 
@@ -362,15 +640,11 @@ class DDToolFrame(ttk.Frame):
         return True
 
 
-    ###  @TCC -- Working point
     def _isdigit_tfile_validate(self, varname, newval):
         try:
             self.ent[varname].mark_valid(str.isdigit(newval))
         except (TypeError):
             self.ent[varname].mark_valid(False)
-        print(newval, self.last_cfg[varname])
-        if newval != self.last_cfg[varname]:
-            print("TFILE RELOAD NEEDED")
         return True
 
 
@@ -383,8 +657,116 @@ class DDToolFrame(ttk.Frame):
 
 
     def _quit(self):
+        if self.worker is not None:
+            self.worker.cancel()
         self.root.quit()
 
+    def current_cfg(self):
+        cfg = copy.deepcopy(self.last_cfg)
+        for k, e in self.ent.items():
+            cfg[k] = e.var.get().strip()
+        cfg['temperatures_file'] = self.temperatures_file
+        cfg['cfg_filename'] = self.cfg_file
+        return cfg
+
+    def _run(self, auto=False):
+        """
+        Re-run the stale stages, the gui ones (plot) once the others are done
+        in the worker thread.  auto runs (after a parameter change) never
+        (re)load the temperatures file and don't complain.
+        """
+        if self.worker is not None and self.worker.is_alive():
+            return
+        if not self.temperatures_file:
+            if not auto:
+                self.log("Choose a temperatures file first\n")
+            return
+        cfg = self.current_cfg()
+        try:
+            datetime.strptime(cfg['start_date'], '%Y-%m-%d')
+            args = cfg_args(cfg)
+        except ValueError as e:
+            if not auto:
+                self.log("Invalid parameter: {}\n".format(e))
+            return
+        stale = self.graph.stale(cfg)
+        if not stale or (auto and 'load' in stale):
+            return
+        work = [x for x in stale if not self.graph.stages[x]['gui']]
+        self.run_button.config(state='disabled')
+        self.load_tfile_button.config(state='disabled')
+        self.cancel_button.config(state='normal')
+        self.progress['value'] = 0
+        if 'load' in work:
+            self.log("Loading '{}'\n".format(self.temperatures_file))
+        instrument.reset()
+        self.graph.forget(stale)
+        self.worker = tkworker.Worker(self.graph.run, work, args, stages=self.graph.timers(work))
+        self.worker.cfg = cfg
+        self.worker.run_args = args
+        self.worker.work = work
+        self.worker.gui_stages = [x for x in stale if self.graph.stages[x]['gui']]
+        self.worker.start()
+        tkworker.poll(self, self.worker, self._progress, self._done)
+
+    def _param_changed(self, *_):
+        # wait for typing to pause before updating
+        if self._auto_run_id is not None:
+            self.after_cancel(self._auto_run_id)
+        self._auto_run_id = self.after(AUTO_RUN_DELAY_MS, self._auto_run)
+
+    def _auto_run(self):
+        self._auto_run_id = None
+        self._update_stale()
+        if 'load' in self.graph.outputs: # only after the first RUN
+            self._run(auto=True)
+
+    def _update_stale(self):
+        # the load button is enabled when the temperatures file needs (re)loading
+        busy = self.worker is not None and self.worker.is_alive()
+        stale = self.graph.stale(self.current_cfg())
+        self.load_tfile_button.config(state='normal' if 'load' in stale and not busy else 'disabled')
+
+    def _cancel(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.cancel_button.config(state='disabled')
+            self.log("Cancelling (after the current stage)...\n")
+
+    def _progress(self, stage, percent, rows):
+        self.progress['value'] = percent
+        if rows is not None:
+            self.log("  {} done ({} rows)\n".format(stage, rows))
+
+    def _done(self, result, error):
+        worker = self.worker
+        self.worker = None
+        self.run_button.config(state='normal')
+        self.cancel_button.config(state='disabled')
+        self._update_stale()
+        if isinstance(error, tkworker.Cancelled):
+            self.progress['value'] = 0
+            self.log("Canceled\n")
+            return
+        if error is not None:
+            self.log("FAILED: {}\n".format(error))
+            return
+        self.progress['value'] = 100
+        self.last_cfg = worker.cfg
+        self.graph.record(worker.work, worker.cfg)
+        try:
+            self.graph.run(worker.gui_stages, worker.run_args)
+            self.graph.record(worker.gui_stages, worker.cfg)
+        except Exception as e:
+            logging.exception("Plot failed")
+            self.log("FAILED: {}\n".format(e))
+        if self.graph.stale(self.current_cfg()):
+            self._param_changed() # edited while running
+        fdate = result['solve']['fdate']
+        self.log("Generation dates from {}:\n".format(fdate[0].date()))
+        for i, d in enumerate(fdate[1:]):
+            self.log("  generation {} : {}\n".format(i+1, "not reached" if pd.isnull(d) else d.date()))
+
     def _choose_cfg_file(self):
         if self.cfg_file:
             tmpd, tmpf = os.path.split(self.cfg_file)
@@ -422,6 +804,7 @@ class DDToolFrame(ttk.Frame):
             else:
                 logging.warn("'{}' is not a file... This shouldn't happen".format(tfn))
         self._update_tfile()
+        self._param_changed()
 
     def _update_cfg_file(self):
         if self.cfg_file and self.cfg_file != 'INLINE DEFAULT CONFIG':
@@ -14,6 +14,8 @@ import logging
 import io
 import glob
 import subprocess
+import warnings
+import json
 
 import numpy as np
 import pandas as pd
@@ -25,6 +27,11 @@ import matplotlib.pyplot as plt
 import tkinter as tk
 import tkinter.filedialog
 
+from temps2daily import local_day_hours, hour_coverage, hour_mask, count_hours, spike_flags
+from ddstore import read_store, read_cdd, append_cdd, store_summary, FLAG_DAILY_INPUT
+import instrument
+import tkworker
+
 # setup logging
 def getlvlnum(name):
     return name if isinstance(name, int) else logging.getLevelName(name)
@@ -40,12 +47,27 @@ INLINE_DEFAULT_CFG_FILE = """
 # base_temp: 54.3
 # DD_per_gen: 622
 # num_gen: 3
+# dd_method: sine # 'sine' (from daily min & max) or 'hourly' (integrate the readings where they cover the day)
+# dh_max_gap: 90 # minutes; longer gaps between readings are not integrated ('hourly' dd_method)
+# dh_min_coverage: 20 # hours of a day the readings must cover to use the integral ('hourly' dd_method)
 
 # min_readings_per_day: 4 # exclude days with too few temperature reads/points
+# night_hours: # local hours (eg: 0-8, end excluded) a day needs a reading in for its min; empty to not check
+# afternoon_hours: # local hours (eg: 12-18) a day needs a reading in for its max; empty to not check
+# qc_mad_k: 0 # drop readings this many MADs from the rolling median (eg: 5); 0 to not check
+# qc_window: 120 # minutes of readings in the rolling median window (qc_mad_k)
+# qc_max_rate: 0 # drop single readings jumping faster than this (degrees per hour) and back; 0 to not check
+# neighbor_fill: False # fill missing days from the other stations in the temperatures file (per month regressions)
+# neighbor_min_corr: 0.8 # least correlation of a neighbor's monthly fit to use it (neighbor_fill)
 # max_num_years_to_norm: 6
-# norm_method: median # use either 'mean' or 'median' for normal/typical temperatures
+# norm_method: median # 'mean', 'median', 'rolling', or 'harmonic' for normal/typical temperatures
+# norm_window: 15 # days in the window for the 'rolling' norm_method
+# norm_harmonics: 3 # number of yearly harmonics for the 'harmonic' norm_method
 # num_years_to_add_for_projection: 3
 # interpolation_window: 3  # number of points to average on ends of gaps before interpolating
+# day_start_hour: 0 # local hour days start at; eg: 6 for 06:00 to 06:00 observation days
+# timezone: # tz database name (eg: America/Los_Angeles) if readings need converting to local days
+# data_timezone: UTC # timezone of the readings (used with timezone)
 
 # skiprows: 0
 # station_col: STATION
@@ -53,7 +75,13 @@ INLINE_DEFAULT_CFG_FILE = """
 # time_col: TIME
 # air_temp_col: TEMP_A_F
 
+# results_format: # 'json', 'csv' or 'parquet' to also save the results (generation dates, daily series)
+# results_file: # Default is the out_file name with the results_format extension
+# results_only: False # only save the results; no figures or html report
+
 # interactive: False
+# timing_summary: False
+# no_open: False
 """
 
 ###
@@ -107,21 +135,10 @@ def main(argv):
     cfg.optionxform = str # make configparser case-sensitive
     cfg.read_file(chain(("[DEFAULTS]",), args.cfg_file))
     defaults = dict(cfg.items("DEFAULTS"))
-    # special handling of parameters that need it like lists
-    for k in ['num_gen', # ints
-              'max_num_years_to_norm',
-              'num_years_to_add_for_projection',
-              'min_readings_per_day',
-              'interpolation_window',
-              'skiprows']:
-        if k in defaults:
-            defaults[k] = int(defaults[k])
-    for k in ['base_temp', # floats
-              'DD_per_gen']:
-        if k in defaults:
-            defaults[k] = float(defaults[k])
-    for k in ['interactive']: # booleans
-        if k in defaults:
+    # special handling of parameters that need it; the int & float options
+    # are converted by their argparse type (string defaults are parsed)
+    for k,v in vars(default_args()).items(): # booleans
+        if isinstance(v, bool) and k in defaults:
             defaults[k] = defaults[k].lower() in ['true', 'yes', 'y', '1']
     #if( 'files' in defaults ): # files needs to be a list
     #    defaults['files'] = [ x for x in defaults['files'].split('\n')
@@ -138,51 +155,7 @@ def main(argv):
         print("Using configuration file '{}'".format(cfg_filename))
 
     # parse rest of arguments with a new ArgumentParser
-    parser = argparse.ArgumentParser(description=__doc__, parents=[conf_parser])
-    parser.add_argument("-f","--temperatures_file", default=None,
-            help="File containing the daily min & max temperature data for all sites")
-    parser.add_argument("-o","--out-file", default=None,
-            help="Filename to output results report to; Default is to ask")
-    parser.add_argument("-s","--station", default='',
-            help="Filter temperatures_file for given station name")
-    parser.add_argument("--start-date", type=str, default=None,
-            help="Date (YYYY-MM-DD) to begin degree-day accumulation calculation")
-    parser.add_argument("--base-temp", type=float, default=None,
-            help="Base temperature threshold for degree-day computation")
-    parser.add_argument("--DD-per-gen", type=float, default=None,
-            help="Degree-days required for one generation of development")
-    parser.add_argument("--num-gen", type=int, default=3,
-            help="Number of generations of development to model")
-    parser.add_argument("--min-readings-per-day", type=int, default=4,
-            help="Exclude days with fewer temperature values from min & max calculation")
-    parser.add_argument("--max-num-years-to-norm", type=int, default=6,
-            help="Maximum number of years to use for normal temperature calculation. "
-                "'0' uses all available data")
-    parser.add_argument("--norm-method", default="median",
-            help="Use either 'mean' or 'median' to calculate normal/typical temperatures for projection")
-    parser.add_argument("--num-years-to-add-for-projection", type=int, default=3,
-            help="Number of years of normal temperatures to generate for projection")
-    parser.add_argument("--interpolation-window", type=int, default=3,
-            help="Number of points to average on ends of gaps before interpolating")
-    parser.add_argument("--skiprows", type=int, default=0,
-            help="Number of initial rows to skip of input temperature data file")
-    parser.add_argument("--station-col", default="STATION",
-            help="Column heading for station names in data file")
-    parser.add_argument("--date-col", default="DATE",
-            help="Column heading for dates in data file")
-    parser.add_argument("--time-col", default="TIME",
-            help="Column heading for time in data file")
-    parser.add_argument("--air-temp-col", default="TEMP_A_F",
-            help="Column heading for air temperatures in data file")
-    parser.add_argument('-i', "--interactive", action='store_true', default=False,
-            help="Display interactive plots")
-    parser.add_argument('-q', "--quiet", action='count', default=0,
-            help="Decrease verbosity")
-    parser.add_argument('-v', "--verbose", action='count', default=0,
-            help="Increase verbosity")
-    parser.add_argument("--verbose_level", type=int, default=0,
-            help="Set verbosity level as a number")
-
+    parser = make_parser([conf_parser])
     parser.set_defaults(**defaults) # add the defaults read from the config file
     args = parser.parse_args(remaining_argv)
     vars(args).update({'cfg_filename':cfg_filename})
@@ -203,7 +176,11 @@ def main(argv):
                         datetime.fromtimestamp(run_time).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z")))
     logging.info("args="+str(args))
 
-    retval = main_process(args, tkroot, tktext)
+    if args.profile:
+        retval = instrument.profile_call(main_process, instrument.profile_prefix(args.profile, __file__),
+                                         args.profile_sample/1000., args, tkroot, tktext)
+    else:
+        retval = main_process(args, tkroot, tktext)
 
     # cleanup and exit
     logging.info("Ended @ {}".format(
@@ -223,44 +200,102 @@ def main_process(args, tkroot, tktext):
         temperatures_filename = tk.filedialog.askopenfilename(initialdir=".",
                 title = "Select Temperatures File",
                 defaultextension=".xlsx",
-                filetypes = (("Excel files",("*.xlsx","*.xls")), ("all files","*.*")))
+                filetypes = (("Excel files",("*.xlsx","*.xls")), ("Daily store",("*.hdf","*.h5")), ("all files","*.*")))
         if not temperatures_filename:
             logging.critical("Select Temperatures File canceled")
             sys.exit(0)
 
-    tktext.insert(tk.END, "Loading temperatures file '{}'\n".format(temperatures_filename))
-    tktext.see(tk.END) # scroll if needed
-    tkroot.update()
-    t, norm_start = load_temperature_data(temperatures_filename, args)
-
-    tktext.insert(tk.END, "Computing thermal accumulation values\n")
-    tktext.see(tk.END) # scroll if needed
-    tkroot.update()
-    dd = compute_BMDD_Fs(t['minAT'], t['maxAT'], args.base_temp)
-
-    ## Plot
-
-    ## Main results figure ... spaghetti-like plot
-    fig = plt.figure(figsize=(7,4))
-    ax = fig.add_subplot(1,1,1)
+    def load_and_compute():
+        hourly = args.dd_method == 'hourly'
+        tmp = load_temperature_data(temperatures_filename, args, keep_readings=hourly)
+        t, norm_start = tmp[:2]
+        instrument.start('DD')
+        dd = compute_BMDD_Fs(t['minAT'], t['maxAT'], args.base_temp)
+        if hourly and tmp[2] is None:
+            logging.warning("No readings to integrate (daily store); using single-sine degree-days")
+        elif hourly:
+            dh = compute_degree_hours(tmp[2], args.base_temp, args.dh_max_gap)
+            n = apply_degree_hours(dd, dh, args.dh_min_coverage)
+            logging.info("Degree-days integrated from the readings for {} of {} days".format(n, dh.shape[0]))
+        instrument.stop(rows=dd.shape[0])
+        return t, norm_start, dd
+
+    instrument.reset()
+    if tktext is None: # no status window when run in batch (eg: bench_ddtool.py)
+        t, norm_start, dd = load_and_compute()
+    else:
+        # load & compute in a worker thread so the window stays responsive
+        def progress(stage, percent, rows):
+            if rows is None:
+                tktext.insert(tk.END, "{:3.0f}% {} ...\n".format(percent, stage))
+            else:
+                tktext.insert(tk.END, "{:3.0f}% {} done ({} rows)\n".format(percent, stage, rows))
+            tktext.see(tk.END) # scroll if needed
+        tktext.insert(tk.END, "Loading temperatures file '{}' (close window to cancel)\n".format(
+                                temperatures_filename))
+        try:
+            t, norm_start, dd = tkworker.run_blocking(tkroot, tkworker.Worker(load_and_compute), progress)
+        except tkworker.Cancelled:
+            logging.critical("Canceled")
+            sys.exit(0)
 
+    instrument.start('generation solve')
     start_date = args.start_date
     DD_per_gen = args.DD_per_gen
     num_gen = args.num_gen
 
-    cDD = dd['DD'].cumsum(skipna=False)
+    cDD = cumsum_dd(dd['DD'])
     start_dt = pd.to_datetime(start_date)
     proj_start_dt = t[t['normN'] > 0].index[0] # first day of projection based on normals
 
     # compute generation dates
-    startcDD = cDD.loc[start_date]
-    fdate = np.empty([num_gen+1], dtype=type(start_dt))
-    fdate[0] = start_dt
-    tmp = cDD-startcDD
-    for gen in range(1,num_gen+1):
-        fdate[gen] = cDD[tmp>DD_per_gen*gen].index[0]
-    max_plot_date = fdate[-1] # track maximum date used
+    fdate = generation_dates(cDD, start_date, DD_per_gen, num_gen)
+    startcDD = cDD.loc[start_dt]
+    # track maximum date used (the end of the data if the last generation is not reached)
+    max_plot_date = fdate[-1] if not pd.isnull(fdate[-1]) else cDD.index[-1]
     print("Generation Dates (first is start date):", *fdate, sep="\n\t")
+    instrument.stop(rows=num_gen)
+
+    # computed variables for output
+    latest_temp_datetime = t.loc[(t['filled'] == 0) & (t['normN'] == 0)].index[-1]
+    # name ... a short descriptive string used for title, filename, ect.
+    if args.station:
+        name = args.station
+    else:
+        name = os.path.splitext(os.path.basename(temperatures_filename))[0]
+
+    # machine readable results
+    results_format = args.results_format or ('json' if args.results_only else '')
+    if results_format:
+        instrument.start('results write')
+        if args.results_file:
+            results_filename = args.results_file
+        elif args.out_file:
+            results_filename = os.path.splitext(args.out_file)[0]+'.'+results_format
+        else:
+            results_filename = "{} {} {}.{}".format(name, args.start_date,
+                          datetime.fromtimestamp(time.time()).astimezone().strftime("%Y-%m-%d"), results_format)
+        summary = results_summary(args, temperatures_filename, t, norm_start, fdate, latest_temp_datetime)
+        daily = daily_results(t, dd['DD'], cDD, start_dt, dd.get('hourly'))
+        write_results(results_filename, results_format, summary, daily)
+        instrument.stop(rows=daily.shape[0])
+        logging.info("Results saved to: '{}'".format(results_filename))
+    if args.results_only: # no figures or report
+        if args.timing_summary:
+            timing_filename = os.path.splitext(results_filename)[0]+'.timing.json'
+            instrument.write_json(timing_filename,
+                                  temperatures_file=temperatures_filename,
+                                  station=args.station,
+                                  results=results_filename)
+            logging.info("Stage timing:\n"+instrument.summary())
+        return 0
+
+    ## Plot
+    instrument.start('plot')
+
+    ## Main results figure ... spaghetti-like plot
+    fig = plt.figure(figsize=(7,4))
+    ax = fig.add_subplot(1,1,1)
 
     # previous years
     lab = 'previous years'
@@ -270,7 +305,8 @@ def main_process(args, tkroot, tktext):
             print("No data for year {}; skipping".format(yr))
             continue
         tmp = cDD-cDD.loc[sd]
-        tmp = tmp.loc[sd:tmp[tmp>DD_per_gen*num_gen].index[0]]
+        done = tmp.index[tmp > DD_per_gen*num_gen]
+        tmp = tmp.loc[sd:done[0] if len(done) > 0 else None]
         # @TCC -- could distinguish previous years used in normal from older years
         c = 'k'
         if sd < norm_start:
@@ -279,7 +315,7 @@ def main_process(args, tkroot, tktext):
         lab = '' # only label first line
 
     # from the given start_date
-    tmp = (cDD-startcDD).loc[fdate[0]:fdate[-1]]
+    tmp = (cDD-startcDD).loc[fdate[0]:max_plot_date]
     proj_mask = tmp.index >= proj_start_dt
     ax.plot((tmp[~proj_mask].index-start_dt).days, tmp[~proj_mask],
             '-', c='b', lw=2, label=str(start_dt.date()))
@@ -291,6 +327,9 @@ def main_process(args, tkroot, tktext):
     for i in range(num_gen):
         y = DD_per_gen*(i+1)
         ax.axhline(y=y, c='k', ls=':', alpha=0.5, lw=1)
+        if pd.isnull(fdate[i+1]):
+            ax.text(0, y, ' F{:d} not reached'.format(i+1), transform=trans, ha='left', va='bottom')
+            continue
         ax.text(0, y, ' F{:d}'.format(i+1), transform=trans, ha='left', va='bottom')
         x = (fdate[i+1]-fdate[0]).days
         ax.stem([x], [y], linefmt='k:', markerfmt='none')
@@ -324,11 +363,12 @@ def main_process(args, tkroot, tktext):
 
     ax = fig.add_subplot(gs[0,0])
     regions = [['input',        (t2['filled'] == 0) & (t2['normN'] == 0), 'C0'],
-               ['interpolated', (t2['filled'] != 0) & (t2['normN'] == 0), 'C1'],
+               ['interpolated', (t2['filled'] != 0) & ~t2['neighbor'] & (t2['normN'] == 0), 'C1'],
+               ['neighbor',     t2['neighbor'] & (t2['normN'] == 0),      'C3'],
                ['projected',    (t2['normN'] != 0),                       'C2'],
               ]
     for label, mask, color in regions:
-        tmp = t2.copy()
+        tmp = t2[['minAT','maxAT']].copy()
         tmp.loc[~mask] = np.nan
         x = np.column_stack((tmp.index, tmp.index+pd.Timedelta(days=1))).flatten()
         ymin = np.column_stack((tmp['minAT'], tmp['minAT'])).flatten()
@@ -353,17 +393,10 @@ def main_process(args, tkroot, tktext):
     fig.savefig(figio, format="svg", bbox_extra_artists=(ldg,), bbox_inches='tight')
     t_fig_str = b'<svg' + figio.getvalue().split(b'<svg')[1]
     del figio
+    instrument.stop(rows=t2.shape[0])
     if args.interactive:
         plt.show()
 
-    # computed variables for output
-    latest_temp_datetime = t.loc[(t['filled'] == 0) & (t['normN'] == 0)].index[-1]
-    # name ... a short descriptive string used for title, filename, ect.
-    if args.station:
-        name = args.station
-    else:
-        name = os.path.splitext(os.path.basename(temperatures_filename))[0]
-
     # output html
     if not args.out_file:
         tmp = "{} {} {}.html".format(name, args.start_date,
@@ -382,6 +415,7 @@ def main_process(args, tkroot, tktext):
         logging.error("Cannot save to: '{}'".format(outfilename))
         sys.exit(1)
     logging.info("Saving to: '{}'".format(outfilename))
+    instrument.start('report write')
 
     # header boilerplate
     with open(outfilename, 'w') as fh:
@@ -405,7 +439,7 @@ def main_process(args, tkroot, tktext):
 
 <h3> Model </h3>
 <ul style='list-style-type:none'>
-<li> Single-sine degree day
+<li> {dd_method_str}
 <li> Base Temperature : {base_temp}
 <li> Degree-days per generation : {DD_per_gen}
 </ul>
@@ -417,6 +451,11 @@ def main_process(args, tkroot, tktext):
 <li> Latest temperature date : {latest_temp_date}
 <li> Earliest temperature date : {earliest_temp_date}
 <li> Normal temperatures calculated using : {norm_start} to {latest_temp_date}
+<li> Days without night ({night_hours}) readings, min gap-filled : {night_window_missing_days}
+<li> Days without afternoon ({afternoon_hours}) readings, max gap-filled : {afternoon_window_missing_days}
+<li> Mean hours per day with readings : {mean_hours_per_day:.1f}
+<li> Readings dropped as spikes ({qc_str}) : {qc_flagged_readings} on {qc_flagged_days} days
+<li> Days filled from neighbor stations : {neighbor_days}
 </ul>
 
 <h3> Results </h3>
@@ -426,14 +465,22 @@ def main_process(args, tkroot, tktext):
             station=args.station,
             start_date=args.start_date,
             run_time_str=datetime.fromtimestamp(time.time()).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z"),
+            dd_method_str=dd_method_description(dd),
             base_temp=args.base_temp,
             DD_per_gen=args.DD_per_gen,
             latest_temp_date=latest_temp_datetime.date(),
             earliest_temp_date=t.index[0].date(),
             norm_start=norm_start.date(),
+            night_hours=args.night_hours or 'not checked',
+            afternoon_hours=args.afternoon_hours or 'not checked',
+            qc_str=qc_description(args),
+            **coverage_stats(t),
             temperatures_filename=temperatures_filename)
         print(tmp, file=fh)
         for i in range(len(fdate)-1):
+            if pd.isnull(fdate[i+1]):
+                print("<li> generation {} : not reached".format(i+1), file=fh)
+                continue
             print("<li> generation {} : {}  ({} days past start)".format(i+1,
                     fdate[i+1].date(), (fdate[i+1]-fdate[0]).days), file=fh)
             if fdate[i+1] <= latest_temp_datetime:
@@ -464,11 +511,27 @@ start_date: {start_date}
 base_temp: {base_temp}
 DD_per_gen: {DD_per_gen}
 num_gen: {num_gen}
+dd_method: {dd_method}
+dh_max_gap: {dh_max_gap}
+dh_min_coverage: {dh_min_coverage}
 
 min_readings_per_day: {min_readings_per_day}
+night_hours: {night_hours}
+afternoon_hours: {afternoon_hours}
+qc_mad_k: {qc_mad_k}
+qc_window: {qc_window}
+qc_max_rate: {qc_max_rate}
+neighbor_fill: {neighbor_fill}
+neighbor_min_corr: {neighbor_min_corr}
 max_num_years_to_norm: {max_num_years_to_norm}
 norm_method: {norm_method}
+norm_window: {norm_window}
+norm_harmonics: {norm_harmonics}
 num_years_to_add_for_projection: {num_years_to_add_for_projection}
+interpolation_window: {interpolation_window}
+day_start_hour: {day_start_hour}
+timezone: {timezone}
+data_timezone: {data_timezone}
 
 skiprows: {skiprows}
 station_col: {station_col}
@@ -477,17 +540,32 @@ time_col: {time_col}
 air_temp_col: {air_temp_col}
 
 out_file: {outfilename}
+results_format: {results_format}
+results_file: {results_file}
 interactive: {interactive}
+timing_summary: {timing_summary}
+no_open: {no_open}
 </pre>
 </body>
 </html>""".format(temperatures_filename=temperatures_filename,
                     outfilename=outfilename,
                     **vars(args))
         print(tmp, file=fh)
+    instrument.stop()
 
+    # stage timing sidecar (and log summary)
+    timing_filename = os.path.splitext(outfilename)[0]+'.timing.json'
+    instrument.write_json(timing_filename,
+                          temperatures_file=temperatures_filename,
+                          station=args.station,
+                          report=outfilename)
+    if args.timing_summary:
+        logging.info("Stage timing:\n"+instrument.summary())
 
     # open file
-    if sys.platform=='win32':
+    if args.no_open:
+        pass
+    elif sys.platform=='win32':
         os.startfile(outfilename)
     elif sys.platform=='darwin':
         subprocess.Popen(['open', outfilename])
@@ -501,7 +579,173 @@ interactive: {interactive}
     return 0
 
 
-def load_temperature_data(fn, args):
+def make_parser(parents=()):
+    """
+    The ddtool_html.py command line parser (without the config file argument
+    main adds with parents)
+    """
+    parser = argparse.ArgumentParser(description=__doc__, parents=list(parents))
+    parser.add_argument("-f","--temperatures_file", default=None,
+            help="File containing the temperature data for all sites; "
+            "either a workbook of readings or a daily store (.hdf) made by ddstore.py")
+    parser.add_argument("-o","--out-file", default=None,
+            help="Filename to output results report to; Default is to ask")
+    parser.add_argument("-s","--station", default='',
+            help="Filter temperatures_file for given station name")
+    parser.add_argument("--start-date", type=str, default=None,
+            help="Date (YYYY-MM-DD) to begin degree-day accumulation calculation")
+    parser.add_argument("--base-temp", type=float, default=None,
+            help="Base temperature threshold for degree-day computation")
+    parser.add_argument("--DD-per-gen", type=float, default=None,
+            help="Degree-days required for one generation of development")
+    parser.add_argument("--num-gen", type=int, default=3,
+            help="Number of generations of development to model")
+    add_dd_arguments(parser)
+    add_load_arguments(parser)
+    parser.add_argument("--results-format", default='', choices=['', 'json', 'csv', 'parquet'],
+            help="Also save the results (generation dates, coverage, daily series) "
+            "as compact json, csv or parquet")
+    parser.add_argument("--results-file", default='',
+            help="Filename for the results; Default is out-file (or the default report name) "
+            "with the results-format extension")
+    parser.add_argument("--results-only", action='store_true', default=False,
+            help="Only save the results (json if no --results-format); skip the figures and html report")
+    parser.add_argument('-i', "--interactive", action='store_true', default=False,
+            help="Display interactive plots")
+    parser.add_argument("--timing-summary", action='store_true', default=False,
+            help="Log a table of the time and memory used by each processing stage "
+            "(always saved next to the report as .timing.json; with --results-only, "
+            "next to the results)")
+    parser.add_argument("--no-open", action='store_true', default=False,
+            help="Do not open the report when done")
+    parser.add_argument("--profile", nargs='?', const=True, default=False, metavar='PREFIX',
+            help="Profile the run with cProfile; writes PREFIX.prof and PREFIX.collapsed.txt "
+            "(stacks for flamegraph tools). Default PREFIX is the script name and time")
+    parser.add_argument("--profile-sample", type=float, default=0, metavar='MS',
+            help="With --profile, sample the stack every MS milliseconds instead of cProfile "
+            "(lower overhead for long batch runs)")
+    parser.add_argument('-q', "--quiet", action='count', default=0,
+            help="Decrease verbosity")
+    parser.add_argument('-v', "--verbose", action='count', default=0,
+            help="Increase verbosity")
+    parser.add_argument("--verbose_level", type=int, default=0,
+            help="Set verbosity level as a number")
+
+    return parser
+
+
+def add_dd_arguments(parser):
+    """
+    Options of the daily degree-day computation
+    """
+    parser.add_argument("--dd-method", default='sine', choices=['sine', 'hourly'],
+            help="Daily degree-days from the single-sine method on the daily min & max ('sine'), "
+            "or from integrating the (sub-daily) readings on days they cover ('hourly'; "
+            "single-sine for the other days)")
+    parser.add_argument("--dh-max-gap", type=int, default=90,
+            help="Gaps between readings longer than this many minutes are not integrated ('hourly' dd-method)")
+    parser.add_argument("--dh-min-coverage", type=float, default=20.,
+            help="Hours of a day the readings must cover to use their integral ('hourly' dd-method)")
+    return parser
+
+
+def add_load_arguments(parser):
+    """
+    Options of load_temperature_data (shared with the tools which load
+    temperatures files with it, eg: ddserve.py)
+    """
+    parser.add_argument("--min-readings-per-day", type=int, default=4,
+            help="Exclude days with fewer temperature values from min & max calculation")
+    parser.add_argument("--night-hours", default='',
+            help="Local hours (eg: 0-8, end excluded) a day needs a reading in to use its min; "
+            "Default is to not check")
+    parser.add_argument("--afternoon-hours", default='',
+            help="Local hours (eg: 12-18) a day needs a reading in to use its max; "
+            "Default is to not check")
+    parser.add_argument("--qc-mad-k", type=float, default=0.,
+            help="Drop readings more than this many MADs from the rolling median (eg: 5); 0 to not check")
+    parser.add_argument("--qc-window", type=int, default=120,
+            help="Minutes of readings in the rolling median window (--qc-mad-k)")
+    parser.add_argument("--qc-max-rate", type=float, default=0.,
+            help="Drop single readings jumping faster than this (degrees per hour) and back; 0 to not check")
+    parser.add_argument("--neighbor-fill", action='store_true', default=False,
+            help="Fill missing days from per month regressions on the other stations in the temperatures file")
+    parser.add_argument("--neighbor-min-corr", type=float, default=0.8,
+            help="Least correlation of a neighbor station's monthly fit to use it (--neighbor-fill)")
+    parser.add_argument("--max-num-years-to-norm", type=int, default=6,
+            help="Maximum number of years to use for normal temperature calculation. "
+                "'0' uses all available data")
+    parser.add_argument("--norm-method", default="median",
+            help="Method to calculate normal/typical temperatures for projection: "
+            "'mean' or 'median' of each calendar day, "
+            "'rolling' mean of a window of days around each calendar day, "
+            "or 'harmonic' fit to the yearly cycle")
+    parser.add_argument("--norm-window", type=int, default=15,
+            help="Number of days in the window for the 'rolling' norm-method")
+    parser.add_argument("--norm-harmonics", type=int, default=3,
+            help="Number of yearly harmonics for the 'harmonic' norm-method")
+    parser.add_argument("--num-years-to-add-for-projection", type=int, default=3,
+            help="Number of years of normal temperatures to generate for projection")
+    parser.add_argument("--interpolation-window", type=int, default=3,
+            help="Number of points to average on ends of gaps before interpolating")
+    parser.add_argument("--day-start-hour", type=int, default=0,
+            help="Local hour each (observation) day starts at; eg: 6 for 06:00 to 06:00 days")
+    parser.add_argument("--timezone", default='',
+            help="Timezone (tz database name, eg: America/Los_Angeles) to convert readings to "
+            "before grouping by day. Default is no conversion")
+    parser.add_argument("--data-timezone", default='UTC',
+            help="Timezone of the readings in the temperatures file (used with --timezone)")
+    parser.add_argument("--skiprows", type=int, default=0,
+            help="Number of initial rows to skip of input temperature data file")
+    parser.add_argument("--station-col", default="STATION",
+            help="Column heading for station names in data file")
+    parser.add_argument("--date-col", default="DATE",
+            help="Column heading for dates in data file")
+    parser.add_argument("--time-col", default="TIME",
+            help="Column heading for time in data file")
+    parser.add_argument("--air-temp-col", default="TEMP_A_F",
+            help="Column heading for air temperatures in data file")
+    return parser
+
+
+def default_args(**kwargs):
+    """
+    Namespace of the ddtool_html.py defaults (as parsed without a config
+    file or options) updated with kwargs, for running the pipeline from
+    other tools
+    """
+    args = make_parser().parse_args([])
+    args.cfg_filename = ''
+    vars(args).update(kwargs)
+    return args
+
+
+def load_defaults():
+    """
+    Dict of the load_temperature_data options and their defaults
+    """
+    return vars(add_load_arguments(argparse.ArgumentParser()).parse_args([]))
+
+
+def dd_defaults():
+    """
+    Dict of the degree-day (compute_dd) options and their defaults
+    """
+    return vars(add_dd_arguments(argparse.ArgumentParser()).parse_args([]))
+
+
+def load_temperature_data(fn, args, keep_readings=False):
+    """
+    Daily min & max temperatures (gap-filled and extended with projected
+    normals) and the start of the normals period.  Days without a reading
+    in the night_hours window have their min gap-filled, and without one in
+    the afternoon_hours window their max (hoursAT is the number of local
+    hours with readings, rejected the REJECT_ bits).  Readings failing the
+    spike checks (qc_mad_k, qc_max_rate) are dropped before the days are
+    aggregated (flaggedAT is the number per day).  With keep_readings the
+    readings (AT and local 'day' indexed by time, sorted; None for a daily
+    store) are returned too, for compute_degree_hours.
+    """
     #fn = args.temperatures_file
     station = args.station
     interp_window = args.interpolation_window
@@ -515,45 +759,83 @@ def load_temperature_data(fn, args):
     air_temp_col = args.air_temp_col
     min_readings_per_day = args.min_readings_per_day
 
-    df = pd.read_excel(fn, skiprows=skiprows)#, parse_dates=[[date_col, time_col]])
-    if df is None:
-        logging.critical("Failed to load temperatures file '{}'".format(fn))
-        return 1
-    df.rename(columns={date_col:'date',
-                       time_col:'time',
-                       air_temp_col:'AT'}, inplace=True)
-    if station_col:
-        df.rename(columns={station_col:'station'}, inplace=True)
-    if station:
-        df = df.loc[df['station'] == station]
-    df['datetime'] = df.apply(lambda r : pd.datetime.combine(r['date'],r['time']),1)
-    print(df.head())
-
-    # min and max AT
-    gb = df.groupby(df['date'].rename('date_group'))['AT']
-    mmdf = gb.count().to_frame()
-    mmdf.columns = ['cntAT']
-    print(mmdf.head())
-    mmdf['minAT'] = gb.min()
-    mmdf['maxAT'] = gb.max()
-    mmdf.loc[mmdf['cntAT'] < min_readings_per_day, ['minAT','maxAT']] = np.nan
+    readings = None
+    instrument.start('load')
+    if os.path.splitext(fn)[1].lower() in ['.hdf', '.h5']: # daily store made by ddstore.py
+        mmdf = read_store(fn, station)
+        instrument.stop(rows=mmdf.shape[0])
+        if mmdf.shape[0] == 0:
+            logging.critical("No data for station '{}' in '{}'".format(station, fn))
+            return 1
+        mmdf = aggregate_store_days(mmdf, args)
+        neighbors = [x for x in store_summary(fn).index if x != station] if args.neighbor_fill else []
+    else:
+        df = pd.read_excel(fn, skiprows=skiprows)#, parse_dates=[[date_col, time_col]])
+        if df is None:
+            logging.critical("Failed to load temperatures file '{}'".format(fn))
+            return 1
+        df.rename(columns={date_col:'date',
+                           time_col:'time',
+                           air_temp_col:'AT'}, inplace=True)
+        if station_col:
+            df.rename(columns={station_col:'station'}, inplace=True)
+        neighbors = []
+        if station:
+            if args.neighbor_fill:
+                neighbors = df.loc[df['station'] != station]
+            df = df.loc[df['station'] == station]
+        df['datetime'] = pd.to_datetime(df['date']) + pd.to_timedelta(df['time'].astype(str))
+        print(df.head())
+        instrument.stop(rows=df.shape[0])
+
+        mmdf, days = aggregate_readings(df, args)
+        if keep_readings:
+            readings = pd.DataFrame({'AT': df['AT'].values.astype(np.float64), 'day': days.values},
+                                    index=pd.DatetimeIndex(df['datetime'].values))
+            readings = readings.dropna().sort_index(kind='stable')
+        del df
     mmdf = mmdf.resample('D').mean() # ensure daily frequency
-    del df
+    coverage = mmdf[['hoursAT','rejected','flaggedAT']].fillna({'rejected': 0})
+    coverage['rejected'] = coverage['rejected'].astype(np.uint8)
+    mmdf = mmdf[['cntAT','minAT','maxAT']]
     print("Total days:", mmdf.shape[0])
+    missing = mmdf[['minAT','maxAT']].isnull()
+    missing_days = mmdf.index[missing.any(axis=1)]
+
+    ## fill missing values from the regression on neighbor stations ##
+    neighbor = np.zeros(mmdf.shape[0], dtype=bool)
+    if args.neighbor_fill and len(neighbors) > 0:
+        instrument.start('neighbor fill')
+        daily = neighbor_days(fn, neighbors, args)
+        daily[station] = mmdf
+        pred = regression_fill(daily, [station], args.neighbor_min_corr)[station]
+        for col in ['minAT', 'maxAT']:
+            have = pred[col].notnull().values
+            mmdf.loc[have, col] = pred.loc[have, col]
+            neighbor |= have
+        print("Days filled from neighbor stations:", neighbor.sum(),
+              pred.loc[pred['station'] != '', 'station'].value_counts().to_dict())
+        instrument.stop(rows=int(neighbor.sum()))
 
     ## fill missing data with interpolation ##
-    missing_days = mmdf.index[mmdf.isnull().any(axis=1)]
+    # only the missing values are filled; a day rejected for coverage keeps its other value
+    instrument.start('gap-fill')
     print("Missing days:", len(missing_days), missing_days)
     if interp_window <= 1: # simple linear interpolation
         t = mmdf.interpolate(method='linear')
     else: # interpolation based on smoothed / rolling mean values
         t = mmdf.copy()
         rt = t.rolling(interp_window, center=True).mean().interpolate(method='linear')
-        t.loc[missing_days] = rt.loc[missing_days]
+        t = t.fillna(rt)
         t = t.interpolate(method='linear') # fill in any remaining missing values
     t['filled'] = False
     t.loc[missing_days, 'filled'] = True
-    t.loc[missing_days, 'cntAT'] = 0
+    t.loc[missing.all(axis=1), 'cntAT'] = 0
+    t['neighbor'] = neighbor
+    t['hoursAT'] = coverage['hoursAT']
+    t['rejected'] = coverage['rejected']
+    t['flaggedAT'] = coverage['flaggedAT']
+    instrument.stop(rows=len(missing_days))
 
     ## compute normal temperatures for projection ##
     t['normN'] = 0 # keeps track of number of values used to compute normal projections
@@ -567,40 +849,344 @@ def load_temperature_data(fn, args):
         norm_start= t.index[0]
     logging.info("Computing normal using data from {} to {}".format(norm_start, t.index[-1]))
     # actual norm computation
-    tmp = t.loc[norm_start:]
-    gb = tmp.groupby([tmp.index.month.rename('_month'), tmp.index.day.rename('_day')])
-    if norm_method == 'mean':
-        norm = gb.mean()
-    elif norm_method == 'median':
-        norm = gb.median()
-    else:
+    if norm_method not in NORM_METHODS:
         logging.critical("norm_method '{}' not understood".format(norm_method))
         return 1
-    norm['normN'] = gb.count()['minAT']
-    if (2,29) in norm.index: # drop Feb 29 if it is in there
-        norm.drop((2,29), inplace=True)
-    norm.sort_index(inplace=True)
+    instrument.start('normals')
+    norm = compute_normals(t.loc[norm_start:], norm_method, args.norm_window, args.norm_harmonics)
+    instrument.stop(rows=t.loc[norm_start:].shape[0])
     # extend data with multiple years of normals
-    lnorm = None
-    for yr in np.arange(0,num_years_to_add_for_projection+1)+t.index[-1].year:
-        idx = pd.date_range(start='{:04d}-{:02d}-{:02d}'.format(yr,*norm.index[0]),
-                            end=  '{:04d}-{:02d}-{:02d}'.format(yr,*norm.index[-1]),
-                            freq='D')
-        if idx.shape[0] == 366: # leapyear
-            idx = idx[(idx.month!=2) | (idx.day!=29)]
-        tmp = norm.copy()
-        tmp.index = idx
-        if lnorm is None:
-            lnorm = tmp
-        else:
-            lnorm = pd.concat((lnorm, tmp), axis=0)
-        lnorm.resample('D').mean()
-        lnorm.interpolate(method='linear') # fill in any 02-29
-    t = pd.concat((t, lnorm.loc[t.index[-1]+pd.DateOffset(days=1):
-                                t.index[-1]+pd.DateOffset(years=num_years_to_add_for_projection)]))
+    instrument.start('projection')
+    proj_dates = pd.date_range(t.index[-1]+pd.DateOffset(days=1),
+                               t.index[-1]+pd.DateOffset(years=num_years_to_add_for_projection),
+                               freq='D')
+    t = pd.concat((t, project_normals(norm, proj_dates)))
+    t['rejected'] = t['rejected'].fillna(0).astype(np.uint8)
+    t['neighbor'] = t['neighbor'].fillna(False).astype(bool)
+    instrument.stop(rows=len(proj_dates))
+    if keep_readings:
+        return t, norm_start, readings
     return t, norm_start
 
 
+# rejected bits of the daily frame: day missing the night_hours (afternoon_hours) window
+REJECT_MIN = 1
+REJECT_MAX = 2
+
+def aggregate_readings(df, args):
+    """
+    Daily cntAT, minAT, maxAT, flaggedAT, hoursAT and rejected (indexed by
+    local day) of one station's readings (frame with datetime and AT):
+    readings failing the spike checks are dropped (AT set to NaN in df) and
+    the min (max) of days with too few readings or missing the night
+    (afternoon) window are NaN.  Returns the frame and the day of each reading.
+    """
+    min_readings_per_day = args.min_readings_per_day
+    # drop sensor glitches before they become daily extremes
+    flagged = np.zeros(df.shape[0], dtype=bool)
+    if args.qc_mad_k > 0 or args.qc_max_rate > 0:
+        instrument.start('qc')
+        order = np.argsort(df['datetime'].values, kind='stable')
+        flagged[order] = spike_flags(df['datetime'].values[order], df['AT'].values[order],
+                                     args.qc_window, args.qc_mad_k, args.qc_max_rate)
+        df['AT'] = df['AT'].where(~flagged)
+        print("Readings flagged by QC:", flagged.sum())
+        instrument.stop(rows=df.shape[0])
+
+    # min and max AT
+    instrument.start('aggregate')
+    days, hours = local_day_hours(df['datetime'], tz=args.timezone, source_tz=args.data_timezone,
+                                  day_start_hour=args.day_start_hour)
+    gb = df['AT'].groupby(days.rename('date_group'))
+    mmdf = gb.count().to_frame()
+    mmdf.columns = ['cntAT']
+    print(mmdf.head())
+    mmdf['minAT'] = gb.min()
+    mmdf['maxAT'] = gb.max()
+    mmdf['flaggedAT'] = pd.Series(flagged, index=df.index).groupby(days.values).sum()
+    mmdf.loc[mmdf['cntAT'] < min_readings_per_day, ['minAT','maxAT']] = np.nan
+    # diurnal coverage: a day missing the night (afternoon) window has a biased min (max)
+    ok = df['AT'].notnull().values & (hours >= 0) # not the DST readings without a day
+    cover = hour_coverage(days.values[ok], hours[ok]).reindex(mmdf.index, fill_value=0).values
+    mmdf['hoursAT'] = count_hours(cover)
+    mmdf['rejected'] = 0
+    for col, window, bit in [('minAT', args.night_hours, REJECT_MIN),
+                             ('maxAT', args.afternoon_hours, REJECT_MAX)]:
+        mask = hour_mask(window)
+        if mask:
+            bad = ((cover & mask) == 0) & mmdf[col].notnull().values
+            mmdf.loc[bad, col] = np.nan
+            mmdf.loc[bad, 'rejected'] |= bit
+    print("Days rejected for coverage: {} min, {} max".format(
+            (mmdf['rejected'] & REJECT_MIN != 0).sum(), (mmdf['rejected'] & REJECT_MAX != 0).sum()))
+    instrument.stop(rows=mmdf.shape[0])
+    return mmdf, days
+
+
+def aggregate_store_days(mmdf, args):
+    """
+    aggregate_readings columns of a station's days from a daily store: the
+    min & max of days with too few readings are NaN (days from daily
+    summaries have no readings count to check)
+    """
+    instrument.start('aggregate')
+    too_few = (mmdf['cntAT'] < args.min_readings_per_day) & ((mmdf['flags'] & FLAG_DAILY_INPUT) == 0)
+    mmdf = mmdf[['cntAT','minAT','maxAT']].astype(np.float64) # store is compact (float32, uint16)
+    mmdf.loc[too_few, ['minAT','maxAT']] = np.nan
+    mmdf['hoursAT'] = np.nan # the store has no reading times to check the coverage of
+    mmdf['rejected'] = 0
+    mmdf['flaggedAT'] = np.nan # or readings to check for spikes
+    instrument.stop(rows=mmdf.shape[0])
+    return mmdf
+
+
+def neighbor_days(fn, neighbors, args):
+    """
+    Daily min & max of the neighbor stations (the other stations' readings
+    from the workbook, or the names of the other stations in the store fn),
+    checked like the station's.  Returns a dict of station -> frame.
+    """
+    daily = {}
+    if isinstance(neighbors, pd.DataFrame):
+        for name, df in neighbors.groupby('station'):
+            df = df.copy()
+            df['datetime'] = pd.to_datetime(df['date']) + pd.to_timedelta(df['time'].astype(str))
+            daily[name] = aggregate_readings(df, args)[0][['minAT','maxAT']]
+    else:
+        for name in neighbors:
+            daily[name] = aggregate_store_days(read_store(fn, name), args)[['minAT','maxAT']]
+    return daily
+
+
+NEIGHBOR_MIN_DAYS = 30 # fewest days in common for a neighbor's monthly fit to be used
+
+def regression_fill(daily, targets, min_corr=0.8, min_days=NEIGHBOR_MIN_DAYS):
+    """
+    Predict the missing daily min & max of each of targets from the other
+    stations in daily (dict of station -> frame with minAT & maxAT indexed
+    by day).  The least squares line of each station's min (max) on every
+    other station's is fit per calendar month over the days both have, for
+    all station pairs at once (the sums are masked matrix products over the
+    month's days, so memory goes as stations x days).  A missing day comes from the best correlated neighbor with
+    a value that day (at least min_corr, fit on at least min_days).
+    Returns a dict of target -> frame (the target's days) with the predicted
+    minAT & maxAT (NaN where not missing or no neighbor fits) and the
+    station used.
+    """
+    names = list(daily)
+    days = daily[names[0]].index
+    for name in names[1:]:
+        days = days.union(daily[name].index)
+    days = pd.date_range(days.min(), days.max(), freq='D')
+    month = days.month.values-1
+
+    out = {name: pd.DataFrame({'minAT': np.nan, 'maxAT': np.nan, 'station': ''},
+                              index=daily[name].index) for name in targets}
+    for col in ['minAT', 'maxAT']:
+        Y = np.vstack([daily[name][col].reindex(days).values.astype(np.float64) for name in names])
+        M = (~np.isnan(Y)).astype(np.float64) # stations x days
+        Z = np.nan_to_num(Y)
+        # [month, station i, station j] sums over the days both have; i is fit on j
+        n, Sx, Sy, Sxx, Syy, Sxy = np.zeros((6, 12, len(names), len(names)))
+        for m in range(12):
+            sel = month == m
+            Mm, Zm = M[:, sel], Z[:, sel]
+            n[m] = Mm @ Mm.T
+            Sx[m] = Mm @ Zm.T
+            Sy[m] = Zm @ Mm.T
+            Sxx[m] = Mm @ (Zm*Zm).T
+            Syy[m] = (Zm*Zm) @ Mm.T
+            Sxy[m] = Zm @ Zm.T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cov = n*Sxy - Sx*Sy
+            varx = n*Sxx - Sx*Sx
+            b = cov/varx
+            a = (Sy - b*Sx)/n
+            r = cov/np.sqrt(varx*(n*Syy - Sy*Sy))
+        ok = (n >= min_days) & (r >= min_corr) & ~np.eye(len(names), dtype=bool)[None, :, :]
+        r = np.where(ok, r, -np.inf)
+
+        for name in targets:
+            i = names.index(name)
+            # [day, neighbor] correlation of the day's month fit where the neighbor has a value
+            score = np.where(M.T > 0, r[month, i, :], -np.inf)
+            best = score.argmax(axis=1)
+            d = np.arange(len(days))
+            fill = (M[i] == 0) & np.isfinite(score[d, best])
+            pred = pd.Series(np.where(fill, a[month, i, best] + b[month, i, best]*Z[best, d], np.nan),
+                             index=days).reindex(out[name].index)
+            src = pd.Series(np.where(fill, np.asarray(names, dtype=object)[best], ''),
+                            index=days).reindex(out[name].index)
+            out[name][col] = pred.values
+            out[name].loc[pred.notnull().values, 'station'] = src[pred.notnull()].values
+    return out
+
+
+NORM_METHODS = ['mean', 'median', 'rolling', 'harmonic']
+NORM_COLUMNS = ['cntAT', 'minAT', 'maxAT', 'filled']
+FEB29_SLOT = 59 # day-of-year slot (0 based) of Feb 29 in the 366 slot calendar
+
+def doy_slots(idx):
+    """
+    Day-of-year slot (0-365) of each date on a leap-year calendar, so a
+    calendar day always has the same slot and Feb 29 has its own (59).
+    """
+    idx = pd.DatetimeIndex(idx)
+    return (idx.dayofyear.values - 1) + ((~idx.is_leap_year) & (idx.month > 2)).astype(int)
+
+
+def years_by_days(t, columns=NORM_COLUMNS):
+    """
+    Arrange daily values into (number of years x 366 slots) matrices, one per
+    column (NaN where there is no value).  Returns dict of column -> matrix.
+    """
+    yr = t.index.year.values - t.index.year.values.min()
+    slot = doy_slots(t.index)
+    mats = {}
+    for col in columns:
+        m = np.full((yr.max()+1, 366), np.nan)
+        m[yr, slot] = t[col].values.astype(float)
+        mats[col] = m
+    return mats
+
+
+def _circular_window_sum(x, window):
+    # sum over a centered window (odd length) wrapping around the year
+    half = window//2
+    c = np.cumsum(np.concatenate((np.zeros(1), x[-half:] if half else x[:0], x, x[:half])))
+    return c[2*half+1:] - c[:-(2*half+1)]
+
+
+def compute_normals(t, norm_method, window=15, harmonics=3):
+    """
+    Normal (typical) values of the daily frame t for each of 366 day-of-year
+    slots (see doy_slots), computed over a years x days matrix.
+    norm_method is one of
+        mean, median : of each calendar day across years
+        rolling : mean across years of a centered window of days around each calendar day
+        harmonic : least squares fit of a mean plus harmonics (cycles per year)
+    For mean & median, Feb 29 is smoothed with Feb 28 and Mar 1 since it has
+    few years.  Calendar days with no data are interpolated (circularly) from
+    their neighbors.  Returns a frame indexed by slot with the NORM_COLUMNS
+    and normN (the number of values used, at least 1).
+    """
+    mats = years_by_days(t)
+    cnts = {k: (~np.isnan(m)).sum(axis=0) for k, m in mats.items()}
+    cnt = cnts['minAT']
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning) # all-NaN slots
+        if norm_method in ['mean', 'median']:
+            if norm_method == 'mean':
+                norm = {k: np.nanmean(m, axis=0) for k, m in mats.items()}
+            else:
+                norm = {k: np.nanmedian(m, axis=0) for k, m in mats.items()}
+            # Feb 29 only occurs every 4th year; blend with the days around it
+            feb29 = slice(FEB29_SLOT-1, FEB29_SLOT+2)
+            w = cnt[feb29].astype(float)
+            for k in norm:
+                v = norm[k][feb29]
+                norm[k][FEB29_SLOT] = np.nansum(v*w)/w.sum() if w.sum() > 0 else np.nan
+            cnt[FEB29_SLOT] = cnt[feb29].sum()
+        elif norm_method == 'rolling':
+            window = 2*(max(1, window)//2)+1 # must be odd to be centered
+            norm = {k: _circular_window_sum(np.nansum(m, axis=0), window) /
+                       _circular_window_sum(cnts[k], window)
+                    for k, m in mats.items()}
+            cnt = _circular_window_sum(cnt, window).astype(int)
+        elif norm_method == 'harmonic':
+            phase = 2*np.pi*np.arange(366)/366
+            B = np.column_stack([np.ones(366)] +
+                                [f(h*phase) for h in range(1, harmonics+1) for f in (np.cos, np.sin)])
+            norm = {}
+            for k, m in mats.items():
+                # normal equations weighted by the number of values for each day
+                A = B.T @ (cnts[k][:,None]*B)
+                coef = np.linalg.lstsq(A, B.T @ np.nansum(m, axis=0), rcond=None)[0]
+                norm[k] = B @ coef
+        else:
+            raise ValueError("norm_method '{}' not understood".format(norm_method))
+    norm = pd.DataFrame(norm, index=pd.RangeIndex(366, name='slot'))
+    norm['normN'] = np.maximum(cnt, 1) # >0 marks projected days, even ones filled below
+    # fill calendar days without any data
+    if norm['minAT'].isnull().any():
+        tmp = pd.concat((norm, norm, norm)).reset_index(drop=True).interpolate(method='linear')
+        norm.loc[:, NORM_COLUMNS] = tmp.iloc[366:2*366][NORM_COLUMNS].values
+    return norm
+
+
+def project_normals(norm, dates):
+    """
+    Projected daily frame for dates from compute_normals output; a single
+    gather of the normals by day-of-year slot.
+    """
+    proj = norm.iloc[doy_slots(dates)]
+    proj.index = pd.DatetimeIndex(dates)
+    return proj
+
+
+# status bits of the compact daily representation
+STATUS_INPUT = 1
+STATUS_INTERPOLATED = 2
+STATUS_PROJECTED = 4
+STATUS_NEIGHBOR = 8 # with STATUS_INTERPOLATED; filled from neighbor stations
+STATUS_REJECT_MIN = 16 # the rejected bits (REJECT_MIN, REJECT_MAX)
+STATUS_REJECT_MAX = 32
+HOURS_NONE = 255 # compact hoursAT of days without it (store and projected days)
+FLAGGED_NONE = np.iinfo(np.uint16).max # compact flaggedAT of days without it
+
+def compact_daily(t):
+    """
+    Memory-compact form of a daily frame from load_temperature_data.
+    Returns a dict with the start date, int32 day offsets from it, float32
+    minAT, maxAT & cntAT (the normals' mean on projected days), uint16 normN
+    & flaggedAT (FLAGGED_NONE for NaN),
+    uint8 hoursAT (HOURS_NONE for NaN) and a uint8 status bitfield (STATUS_INPUT, STATUS_INTERPOLATED,
+    STATUS_PROJECTED, STATUS_NEIGHBOR and the STATUS_REJECT_ bits).
+    Use expand_daily to get the frame back for plotting and reports.
+    """
+    start = t.index[0]
+    projected = (t['normN'] > 0).values
+    interpolated = (t['filled'] != 0).values & ~projected
+    status = np.where(projected, STATUS_PROJECTED,
+                      np.where(interpolated, STATUS_INTERPOLATED, STATUS_INPUT)).astype(np.uint8)
+    status[t['neighbor'].values & ~projected] |= STATUS_NEIGHBOR
+    rejected = t['rejected'].values
+    status[(rejected & REJECT_MIN) != 0] |= STATUS_REJECT_MIN
+    status[(rejected & REJECT_MAX) != 0] |= STATUS_REJECT_MAX
+    return {'start': start,
+            'day': ((t.index-start)//pd.Timedelta(days=1)).values.astype(np.int32),
+            'minAT': t['minAT'].values.astype(np.float32),
+            'maxAT': t['maxAT'].values.astype(np.float32),
+            'cntAT': t['cntAT'].values.astype(np.float32),
+            'normN': t['normN'].values.astype(np.uint16),
+            'hoursAT': np.nan_to_num(t['hoursAT'].values.astype(np.float64), nan=HOURS_NONE).astype(np.uint8),
+            'flaggedAT': np.nan_to_num(np.clip(t['flaggedAT'].values.astype(np.float64), 0, FLAGGED_NONE-1),
+                                       nan=FLAGGED_NONE).astype(np.uint16),
+            'status': status}
+
+
+def expand_daily(c):
+    """
+    Daily frame (as returned by load_temperature_data) from compact_daily output
+    """
+    t = pd.DataFrame({'cntAT': c['cntAT'].astype(np.float64),
+                      'minAT': c['minAT'].astype(np.float64),
+                      'maxAT': c['maxAT'].astype(np.float64),
+                      'filled': (c['status'] & STATUS_INTERPOLATED) != 0,
+                      'normN': c['normN'].astype(np.int64),
+                      'neighbor': (c['status'] & STATUS_NEIGHBOR) != 0,
+                      'hoursAT': np.where(c['hoursAT'] == HOURS_NONE, np.nan, c['hoursAT']),
+                      'flaggedAT': np.where(c['flaggedAT'] == FLAGGED_NONE, np.nan, c['flaggedAT']),
+                      'rejected': (((c['status'] & STATUS_REJECT_MIN) != 0)*REJECT_MIN |
+                                   ((c['status'] & STATUS_REJECT_MAX) != 0)*REJECT_MAX).astype(np.uint8)},
+                     index=c['start']+pd.to_timedelta(c['day'].astype(np.int64), unit='D'))
+    return t
+
+
+def compact_daily_nbytes(c):
+    return sum(v.nbytes for v in c.values() if isinstance(v, np.ndarray))
+
+
 # Function which computes BM (single sine method) degree day generation from temperature data
 def compute_BMDD_Fs(tmin, tmax, base_temp):
     # Used internally
@@ -636,10 +1222,302 @@ def compute_BMDD_Fs(tmin, tmax, base_temp):
     # compute the degree-days for each day in the temperature input (from tmin and tmax vectors)
     dd = pd.concat([tmin,tmax], axis=1)
     dd.columns = ['tmin', 'tmax']
-    dd['DD'] = dd.apply(lambda x: _compute_daily_BM_DD(x[0], x[1], (x[0]+x[1])/2.0, base_temp), axis=1)
+    dd['DD'] = dd.apply(lambda x: _compute_daily_BM_DD(x['tmin'], x['tmax'], (x['tmin']+x['tmax'])/2.0, base_temp), axis=1)
     return dd
 
 
+def compute_degree_hours(readings, base_temp, max_gap_minutes=90):
+    """
+    Degree-hours above base_temp for each day, integrated from the readings
+    (frame with AT and day indexed by time, sorted) with the trapezoid rule
+    on the straight lines between readings; where a line crosses base_temp
+    only the part above it counts.  Gaps longer than max_gap_minutes are not
+    integrated.  Each interval counts for the day of the reading it starts
+    at.  Returns a frame indexed by day with DH (degree-hours) and hours
+    (hours covered by the intervals).
+    """
+    T = readings['AT'].values
+    day = readings['day'].values
+    n = len(T)
+    if n == 0:
+        return pd.DataFrame({'DH': [], 'hours': []}, index=pd.DatetimeIndex([], name='date_group'))
+    dt = np.diff(readings.index.values).astype('timedelta64[s]').astype(np.float64)/3600.
+    ok = (dt > 0) & (dt <= max_gap_minutes/60.)
+    e0 = T[:-1]-base_temp
+    e1 = T[1:]-base_temp
+    p0 = np.maximum(e0, 0)
+    p1 = np.maximum(e1, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # both above: trapezoid; crossing: triangle above base; both below: 0
+        area = np.where((e0 >= 0) & (e1 >= 0), (e0+e1)/2.,
+                        (p0*p0+p1*p1)/(2.*(np.abs(e0)+np.abs(e1))))
+    area = np.append(np.where(ok, dt*np.nan_to_num(area), 0.), 0.)
+    hours = np.append(np.where(ok, dt, 0.), 0.)
+    # sums per day from the cumulative sums at the day boundaries
+    starts = np.concatenate(([0], np.flatnonzero(day[1:] != day[:-1])+1))
+    ends = np.append(starts[1:], n)
+    c_area = np.concatenate(([0.], np.cumsum(area)))
+    c_hours = np.concatenate(([0.], np.cumsum(hours)))
+    return pd.DataFrame({'DH': c_area[ends]-c_area[starts],
+                         'hours': c_hours[ends]-c_hours[starts]},
+                        index=pd.DatetimeIndex(day[starts], name='date_group'))
+
+
+def apply_degree_hours(dd, dh, min_hours=20):
+    """
+    Replace the (single-sine) daily DD of dd with the degree-hour integral
+    (compute_degree_hours) on days the readings cover for at least
+    min_hours; partly covered days get the average over the covered hours.
+    Adds the bool column 'hourly' to dd.  Returns the number of days replaced.
+    """
+    dh = dh.loc[dh['hours'] >= min_hours].reindex(dd.index)
+    hourly = dh['hours'].notnull().values
+    dd['hourly'] = hourly
+    dd.loc[hourly, 'DD'] = (dh['DH']/dh['hours']).values[hourly]
+    return int(hourly.sum())
+
+
+def dd_method_description(dd):
+    # for the report
+    if 'hourly' not in dd.columns:
+        return "Single-sine degree day"
+    return ("Degree-hours integrated from the readings on {} days; "
+            "single-sine degree day for the others".format(int(dd['hourly'].sum())))
+
+
+def cumsum_dd(DD, starts=None):
+    """
+    Cumulative degree-days of the daily DD series.  Days without a value
+    (NaN) add nothing, so one gap does not make every later value NaN.
+    If starts (dates) is given, the sum restarts at 0 on each start date
+    (segmented cumsum) and is NaN before the first one.
+    """
+    x = np.nan_to_num(DD.values.astype(float))
+    c = np.cumsum(x)
+    if starts is not None:
+        pos = DD.index.get_indexer(pd.DatetimeIndex(starts))
+        is_start = np.zeros(len(x), dtype=bool)
+        is_start[pos[pos >= 0]] = True
+        # index of the most recent start at each day (-1 before the first)
+        seg = np.maximum.accumulate(np.where(is_start, np.arange(len(x)), -1))
+        c = np.where(seg >= 0, c - c[np.maximum(seg, 0)], np.nan)
+    return pd.Series(c, index=DD.index, name='cDD')
+
+
+def generation_dates(cDD, start_date, DD_per_gen, num_gen):
+    """
+    Dates on which each of num_gen generations is completed, ie: the
+    cumulative degree-days cDD since start_date first exceed DD_per_gen per
+    generation.  The first entry is start_date; generations not completed
+    within cDD are NaT.
+    """
+    start_dt = pd.to_datetime(start_date)
+    fdate = np.empty([num_gen+1], dtype=type(start_dt))
+    fdate[0] = start_dt
+    tmp = cDD-cDD.loc[start_dt]
+    for gen in range(1,num_gen+1):
+        done = cDD.index[tmp > DD_per_gen*gen]
+        fdate[gen] = done[0] if len(done) > 0 else pd.NaT
+    return fdate
+
+
+def results_summary(args, temperatures_filename, t, norm_start, fdate, latest_temp_datetime):
+    """
+    Dict of the run results: generation dates (with days past start and
+    passed/projected status), the normals window and the data coverage
+    """
+    gens = []
+    for i, d in enumerate(fdate[1:]):
+        if pd.isnull(d):
+            gens.append({'generation': i+1, 'date': None, 'days_past_start': None, 'status': 'not reached'})
+        else:
+            gens.append({'generation': i+1,
+                         'date': str(d.date()),
+                         'days_past_start': int((d-fdate[0]).days),
+                         'status': 'passed' if d <= latest_temp_datetime else 'projected'})
+    obs = t['normN'] == 0
+    return {'station': args.station,
+            'temperatures_file': temperatures_filename,
+            'start_date': str(pd.to_datetime(args.start_date).date()),
+            'base_temp': args.base_temp,
+            'DD_per_gen': args.DD_per_gen,
+            'num_gen': args.num_gen,
+            'dd_method': args.dd_method,
+            'generations': gens,
+            'normals': {'start': str(norm_start.date()),
+                        'end': str(latest_temp_datetime.date()),
+                        'method': args.norm_method,
+                        'projection_start': str(t.index[~obs.values][0].date()) if (~obs).any() else None},
+            'coverage': {'earliest_temp_date': str(t.index[0].date()),
+                         'latest_temp_date': str(latest_temp_datetime.date()),
+                         'days': int(obs.sum()),
+                         'input_days': int((obs & (t['filled'] == 0)).sum()),
+                         'interpolated_days': int((obs & (t['filled'] != 0) & ~t['neighbor']).sum()),
+                         'projected_days': int((~obs).sum()),
+                         'min_readings_per_day': args.min_readings_per_day,
+                         'mean_readings_per_day': float(t.loc[obs & (t['filled'] == 0), 'cntAT'].mean()),
+                         'night_hours': args.night_hours,
+                         'afternoon_hours': args.afternoon_hours,
+                         'qc_mad_k': args.qc_mad_k,
+                         'qc_window': args.qc_window,
+                         'qc_max_rate': args.qc_max_rate,
+                         'neighbor_fill': args.neighbor_fill,
+                         'neighbor_min_corr': args.neighbor_min_corr,
+                         **coverage_stats(t)},
+            }
+
+
+def coverage_stats(t):
+    """
+    Coverage of the observed days of a daily frame: the number of days
+    rejected for a missing night (min) or afternoon (max) window, the mean
+    number of hours with readings (NaN for a daily store), the readings
+    dropped by the spike checks and the days they were on, and the days
+    filled from neighbor stations
+    """
+    obs = (t['normN'] == 0).values
+    rejected = t['rejected'].values[obs]
+    flagged = t['flaggedAT'].values[obs]
+    neighbor = t['neighbor'].values[obs]
+    return {'night_window_missing_days': int(((rejected & REJECT_MIN) != 0).sum()),
+            'afternoon_window_missing_days': int(((rejected & REJECT_MAX) != 0).sum()),
+            'mean_hours_per_day': float(t.loc[obs, 'hoursAT'].mean()),
+            'qc_flagged_readings': int(np.nansum(flagged)),
+            'qc_flagged_days': int((flagged > 0).sum()),
+            'neighbor_days': int(neighbor.sum())}
+
+
+def qc_description(args):
+    # for the report
+    checks = []
+    if args.qc_mad_k > 0:
+        checks.append("{:g} MADs from the {} minute median".format(args.qc_mad_k, args.qc_window))
+    if args.qc_max_rate > 0:
+        checks.append("jumps over {:g} degrees per hour".format(args.qc_max_rate))
+    return ", ".join(checks) if checks else 'not checked'
+
+
+def daily_results(t, DD, cDD, start_dt, hourly=None):
+    """
+    Daily series of the run: min & max temperature, readings count, hours
+    with readings, readings dropped as spikes, status (input, neighbor,
+    interpolated or projected), DD and cumulative DD since start (NaN
+    before it), and if given whether DD was integrated from the readings
+    (hourly)
+    """
+    status = np.where(t['normN'] > 0, 'projected',
+                      np.where(t['neighbor'], 'neighbor', np.where(t['filled'] != 0, 'interpolated', 'input')))
+    since = cDD - cDD.loc[start_dt]
+    since[cDD.index < start_dt] = np.nan
+    daily = pd.DataFrame({'minAT': t['minAT'],
+                          'maxAT': t['maxAT'],
+                          'cntAT': t['cntAT'],
+                          'hoursAT': t['hoursAT'],
+                          'flaggedAT': t['flaggedAT'],
+                          'status': status,
+                          'DD': DD,
+                          'cDD': since},
+                         index=t.index)
+    if hourly is not None:
+        daily['hourly'] = hourly
+    daily.index.name = 'date'
+    return daily
+
+
+def write_results(fn, fmt, summary, daily):
+    """
+    Save summary (dict) and daily (frame) as
+        json : one compact object; the daily series as columns (lists)
+        csv : the daily series with the summary as '# ' comment lines first
+        parquet : the daily series with the summary (json) in the 'ddtool' schema metadata
+    """
+    if fmt == 'json':
+        cols = {'date': [str(d.date()) for d in daily.index]}
+        for k in daily.columns:
+            v = daily[k]
+            if pd.api.types.is_numeric_dtype(v) and not pd.api.types.is_bool_dtype(v):
+                cols[k] = [None if np.isnan(x) else round(x, 4) for x in v.values.astype(float)]
+            else:
+                cols[k] = v.tolist() # strings and bools (eg: hourly) as they are
+        with open(fn, 'w') as fh:
+            json.dump(dict(summary, daily=cols), fh, separators=(',', ':'))
+    elif fmt == 'csv':
+        with open(fn, 'w', newline='') as fh:
+            for line in json.dumps(summary, indent=1).splitlines():
+                print('# '+line, file=fh)
+            daily.to_csv(fh, float_format='%.4f', date_format='%Y-%m-%d')
+    elif fmt == 'parquet':
+        import pyarrow as pa # optional; only needed here
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(daily)
+        table = table.replace_schema_metadata(dict(table.schema.metadata or {},
+                                                   ddtool=json.dumps(summary)))
+        pq.write_table(table, fn)
+    else:
+        raise ValueError("results format '{}' not understood".format(fmt))
+
+
+def update_cumulative_dd(store_fn, station, base_temp, min_readings_per_day=0):
+    """
+    Extend the cumulative degree-days stored in the daily store (ddstore.py)
+    for station and base_temp to the latest stored day.  Only days after the
+    last stored cumulative value are computed, continuing from it.  Days
+    without (enough) data add no DD and are counted in 'missing'.
+    Returns the newly added days (DD, cDD, missing indexed by date).
+    """
+    old = read_cdd(store_fn, station, base_temp)
+    start = old.index[-1]+pd.DateOffset(days=1) if old.shape[0] > 0 else None
+    daily = read_store(store_fn, station, start=start)
+    if daily.shape[0] == 0:
+        return old.iloc[:0]
+    too_few = (daily['cntAT'] < min_readings_per_day) & ((daily['flags'] & FLAG_DAILY_INPUT) == 0)
+    daily.loc[too_few, ['minAT','maxAT']] = np.nan
+    days = pd.date_range(start if start is not None else daily.index[0], daily.index[-1], freq='D')
+    daily = daily.reindex(days)
+    DD = compute_BMDD_Fs(daily['minAT'].astype(float), daily['maxAT'].astype(float), base_temp)['DD']
+    c0, m0 = (old['cDD'].iloc[-1], old['missing'].iloc[-1]) if old.shape[0] > 0 else (0, 0)
+    new = pd.DataFrame({'DD': DD,
+                        'cDD': c0 + cumsum_dd(DD).values,
+                        'missing': m0 + np.cumsum(np.isnan(DD.values))},
+                       index=days)
+    append_cdd(store_fn, station, base_temp, new)
+    return new
+
+
+def stored_generation_dates(store_fn, station, base_temp, starts, DD_per_gen, num_gen,
+                            min_readings_per_day=0):
+    """
+    Generation dates of the observed days in a daily store (ddstore.py) for
+    each of the start dates (eg: a biofix each season), from the stored
+    cumulative degree-days (extended first with update_cumulative_dd, so
+    only new days are computed).  The sum restarts at each start date
+    (cumsum_dd starts), so each start only counts the days up to the next
+    one.  Returns a list (by start date) of dicts of the start_date, fdate
+    (as generation_dates, NaT if not reached), the cDD to the segment's
+    last day and its days missing data.
+    """
+    update_cumulative_dd(store_fn, station, base_temp, min_readings_per_day)
+    starts = pd.DatetimeIndex(sorted(set(pd.to_datetime(starts))))
+    cdd = read_cdd(store_fn, station, base_temp, start=starts[0])
+    if cdd.shape[0] == 0 or starts[0] < cdd.index[0] or starts[-1] > cdd.index[-1]:
+        raise ValueError("start dates {} to {} outside of the stored days{}".format(
+                            starts[0].date(), starts[-1].date(), "" if cdd.shape[0] == 0 else
+                            " ({} to {})".format(cdd.index[0].date(), cdd.index[-1].date())))
+    seg = cumsum_dd(cdd['DD'], starts=starts)
+    out = []
+    for i, start_dt in enumerate(starts):
+        end = starts[i+1]-pd.DateOffset(days=1) if i+1 < len(starts) else seg.index[-1]
+        # the stored missing count is cumulative from the store's first day
+        # (cdd is read from starts[0]), so count the segment's own days
+        missing = cdd.loc[start_dt:end, 'DD'].isnull().sum()
+        out.append({'start_date': start_dt,
+                    'fdate': generation_dates(seg.loc[start_dt:end], start_dt, DD_per_gen, num_gen),
+                    'end_date': end,
+                    'cDD': float(seg.loc[end]),
+                    'missing_days': int(missing)})
+    return out
+
+
 ## Main hook for running as script
 if __name__ == "__main__":
     sys.exit(main(argv=None))
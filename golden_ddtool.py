@@ -0,0 +1,856 @@
+#!/usr/bin/env python3
+"""
+Check that the ddtool_html.py computations (daily degree-days, cumulative
+degree-days, generation dates and normals) give the same results as the
+straightforward day-by-day reference implementations below.
+Runs the example workbook, the LAAR MBF files and randomized inputs and
+reports the days that differ by more than the tolerance.
+Exit code is 0 when everything matches.
+
+Outputs can also be saved (--save) and later compared to (--golden) to
+check for changes between versions.
+"""
+
+import sys
+import os
+import time
+import argparse
+from datetime import datetime
+import logging
+import math
+import json
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+import ddtool_html
+import ddstore
+import ddserve
+import instrument
+from MBFTemps2CSV import load_datfile
+from temps2daily import local_day_hours
+from multicolumn_listbox import Multicolumn_Listbox
+import temps2daily_gui
+
+# setup logging
+def getlvlnum(name):
+    return name if isinstance(name, int) else logging.getLevelName(name)
+def getlvlname(num):
+    return num if isinstance(num, str) else logging.getLevelName(num)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+logging.getLogger().setLevel(logging.INFO)
+
+
+## CONSTANTS ##
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+EXAMPLE_WORKBOOK = os.path.join(REPO_DIR, 'examples', 'LAAR_CountryClub2000-2018_Temps.xlsx')
+EXAMPLE_START_DATE = '2018-01-13'
+EXAMPLE_NIGHT_HOURS = '0-8'
+EXAMPLE_AFTERNOON_HOURS = '12-18'
+EXAMPLE_QC_MAX_RATE = 5. # the readings are 4 hours apart, too far for the qc_mad_k window
+MBF_FILES = [os.path.join(REPO_DIR, 'testfiles', 'LAAR17'),
+             os.path.join(REPO_DIR, 'testfiles', 'LAAR18')]
+BASE_TEMP = 54.3
+DD_PER_GEN = 622.
+NUM_GEN = 3
+
+
+###
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--random", type=int, default=20,
+            help="Number of randomized cases")
+    parser.add_argument("--seed", type=int, default=0,
+            help="Random seed for the randomized cases")
+    parser.add_argument("--rtol", type=float, default=1e-9,
+            help="Relative tolerance for degree-days and normals")
+    parser.add_argument("--atol", type=float, default=1e-9,
+            help="Absolute tolerance for degree-days and normals")
+    parser.add_argument("--no-example", action='store_true', default=False,
+            help="Skip the example workbook (slow to read)")
+    parser.add_argument("--no-normals", action='store_true', default=False,
+            help="Skip the normals checks")
+    parser.add_argument("--max-report", type=int, default=10,
+            help="Maximum number of differing days listed per check")
+    parser.add_argument("--save", default=None,
+            help="Directory to save the ddtool_html outputs to (for a later --golden)")
+    parser.add_argument("--golden", default=None,
+            help="Directory of outputs saved (--save) by another version to also compare to")
+    parser.add_argument('-q', "--quiet", action='count', default=0,
+            help="Decrease verbosity")
+    parser.add_argument('-v', "--verbose", action='count', default=0,
+            help="Increase verbosity")
+    parser.add_argument("--verbose_level", type=int, default=0,
+            help="Set verbosity level as a number")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.getLogger().getEffectiveLevel()+
+                                 (10*(args.quiet-args.verbose-args.verbose_level)))
+
+    start_time = time.time()
+    logging.info("Started @ {}".format(
+                        datetime.fromtimestamp(time.time()).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z")))
+    logging.info("args="+str(args))
+
+    retval = main_process(args)
+
+    logging.info("Ended @ {} ({:.2f} s)".format(
+                        datetime.fromtimestamp(time.time()).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z"),
+                        time.time()-start_time))
+    return retval
+
+
+#######
+
+def main_process(args):
+    cases = [] # (name, daily frame with minAT & maxAT, start_date, base_temp, DD_per_gen)
+    norm_cases = [] # (name, daily frame for normals)
+    path_cases = [] # (name, function returning problems) checks of the other ddtool_html paths
+    if not args.no_example:
+        if not os.path.isfile(EXAMPLE_WORKBOOK):
+            logging.warning("Example workbook '{}' not found; skipped".format(EXAMPLE_WORKBOOK))
+        else:
+            t, norm_start = example_daily()
+            cases.append(('example', t, EXAMPLE_START_DATE, BASE_TEMP, DD_PER_GEN))
+            norm_cases.append(('example', t.loc[norm_start:].loc[t['normN'] == 0]))
+            # the diurnal coverage & spike checks are opt-in; check them (and the compact form) on the example
+            t, norm_start, readings = example_daily(keep_readings=True, night_hours=EXAMPLE_NIGHT_HOURS,
+                                                    afternoon_hours=EXAMPLE_AFTERNOON_HOURS,
+                                                    qc_max_rate=EXAMPLE_QC_MAX_RATE)
+            path_cases.append(('example coverage', lambda t=t, r=readings: check_coverage(t, r)))
+            path_cases.append(('example compact', lambda t=t: check_compact(t, args)))
+    for fn in MBF_FILES:
+        if not os.path.isfile(fn):
+            logging.warning("MBF file '{}' not found; skipped".format(fn))
+            continue
+        t = mbf_daily(fn)
+        cases.append((os.path.basename(fn), t, t.index[0], BASE_TEMP, DD_PER_GEN))
+    rng = np.random.default_rng(args.seed)
+    for i in range(args.random):
+        t, start_date, base_temp, DD_per_gen = random_daily(rng)
+        cases.append(('random{:02d}'.format(i), t, start_date, base_temp, DD_per_gen))
+        if i < 5:
+            norm_cases.append(('random{:02d}'.format(i), random_years(rng)))
+
+    failed = []
+    for name, t, start_date, base_temp, DD_per_gen in cases:
+        problems = check_dd(name, t, start_date, base_temp, DD_per_gen, args)
+        print("{:<12s} {} days: {}".format(name, t.shape[0], "FAIL" if problems else "ok"))
+        for p in problems:
+            print(p)
+        if problems:
+            failed.append(name)
+    if not args.no_normals:
+        for name, t in norm_cases:
+            for norm_method in ddtool_html.NORM_METHODS:
+                problems = check_normals(t, norm_method, args)
+                print("{:<12s} normals {:<8s}: {}".format(name, norm_method, "FAIL" if problems else "ok"))
+                for p in problems:
+                    print(p)
+                if problems:
+                    failed.append(name+' normals '+norm_method)
+
+    path_cases.append(('store upsert', lambda: check_store_upsert(rng, args)))
+    path_cases.append(('store ingest', check_store_ingest))
+    path_cases.append(('store cumulative DD', lambda: check_store_cdd(rng, args)))
+    path_cases.append(('generations not reached', lambda: check_not_reached(rng)))
+    path_cases.append(('results only json', lambda: check_results_only(rng)))
+    path_cases.append(('degree-hours sine days', lambda: check_degree_hours(rng)))
+    path_cases.append(('local days over DST', check_local_dst))
+    path_cases.append(('temps2daily_gui rows', lambda: check_tfile_rows(rng)))
+    path_cases.append(('listbox sort missing', lambda: check_sort_missing(rng)))
+    path_cases.append(('ddserve cold loads', lambda: check_serve_loads(rng)))
+    for name, check in path_cases:
+        problems = check()
+        print("{:<24s}: {}".format(name, "FAIL" if problems else "ok"))
+        for p in problems:
+            print(p)
+        if problems:
+            failed.append(name)
+
+    if failed:
+        logging.error("{} check(s) differ: {}".format(len(failed), ", ".join(failed)))
+        return 1
+    logging.info("All {} checks match".format(
+                    len(cases) + len(path_cases) +
+                    (0 if args.no_normals else len(norm_cases)*len(ddtool_html.NORM_METHODS))))
+    return 0
+
+
+## inputs ##
+def example_daily(keep_readings=False, **kwargs):
+    """
+    Daily frame (with projection) of the example workbook from
+    ddtool_html.load_temperature_data; kwargs override the default options
+    """
+    args = ddtool_html.default_args(**kwargs)
+    return ddtool_html.load_temperature_data(EXAMPLE_WORKBOOK, args, keep_readings=keep_readings)
+
+
+def mbf_daily(fn):
+    """
+    Daily min & max of an MBF file (records without a date dropped), one row per day
+    """
+    dat = pd.DataFrame(load_datfile(fn),
+                       columns=['jday', 'day', 'month', 'year', 'minAT', 'maxAT', 'date_str', 'fn'])
+    dat = dat[dat['date_str'] != '']
+    t = dat.groupby(pd.to_datetime(dat['date_str']))[['minAT', 'maxAT']].mean()
+    return t.resample('D').mean()
+
+
+def random_daily(rng):
+    """
+    Random daily min & max around a random base temperature, including days
+    exactly at the base, constant days, swapped min & max and missing days
+    """
+    n = int(rng.integers(30, 2000))
+    base_temp = float(rng.choice([10., 32., 50., 54.3]))
+    tmin = base_temp + rng.normal(0, 15, n)
+    tmax = tmin + np.abs(rng.normal(10, 5, n))
+    for x, p in [(tmin, 0.02), (tmax, 0.02)]: # exactly at the base
+        x[rng.random(n) < p] = base_temp
+    same = rng.random(n) < 0.01
+    tmax[same] = tmin[same]
+    swap = rng.random(n) < 0.005
+    tmin[swap], tmax[swap] = tmax[swap], tmin[swap].copy()
+    for x in [tmin, tmax]:
+        x[rng.random(n) < 0.02] = np.nan
+    idx = pd.date_range('2000-01-01', periods=n, freq='D') + pd.Timedelta(days=int(rng.integers(0, 3650)))
+    start_date = idx[int(rng.integers(0, n//2))]
+    DD_per_gen = float(rng.uniform(20, 800))
+    return pd.DataFrame({'minAT': tmin, 'maxAT': tmax}, index=idx), start_date, base_temp, DD_per_gen
+
+
+def random_years(rng):
+    """
+    Several years of random daily values (with missing days) for the normals checks
+    """
+    idx = pd.date_range('{}-{:02d}-01'.format(int(rng.integers(1990, 2015)), int(rng.integers(1, 13))),
+                        periods=int(rng.integers(400, 3000)), freq='D')
+    doy = idx.dayofyear.values
+    minAT = 45 - 15*np.cos(2*np.pi*(doy-15)/365.25) + rng.normal(0, 4, len(idx))
+    t = pd.DataFrame({'cntAT': rng.integers(0, 100, len(idx)).astype(float),
+                      'minAT': minAT,
+                      'maxAT': minAT + np.abs(rng.normal(20, 5, len(idx))),
+                      'filled': rng.random(len(idx)) < 0.05,
+                      'normN': 0},
+                     index=idx)
+    t.loc[rng.random(len(idx)) < 0.03, ['cntAT', 'minAT', 'maxAT']] = np.nan
+    return t
+
+
+## reference implementations (plain day by day; keep these simple) ##
+def ref_daily_dd(mint, maxt, base_temp):
+    """
+    Baskerville-Emin (single sine) degree-days of one day.  Missing values
+    give NaN, except a missing min with the max below the base is 0.
+    """
+    avet = (mint+maxt)/2.0
+    if maxt < base_temp:
+        return 0.
+    if mint >= base_temp:
+        return avet - base_temp
+    W = (maxt-mint)/2.0
+    tmp = (base_temp-avet)/W
+    if math.isnan(tmp):
+        return math.nan
+    tmp = min(1., max(-1., tmp))
+    A = math.asin(tmp)
+    return ((W*math.cos(A))-((base_temp-avet)*((math.pi/2.0)-A)))/math.pi
+
+
+def ref_dd(tmin, tmax, base_temp):
+    return pd.Series([ref_daily_dd(a, b, base_temp) for a, b in zip(tmin.values, tmax.values)],
+                     index=tmin.index)
+
+
+def ref_sine_dh(mean, amp, base_temp, t0, t1):
+    """
+    Degree-hours above base_temp from hour t0 to t1 of a day following
+    mean + amp*sin(2*pi*h/24) (h in hours), integrated analytically
+    """
+    w = 2*math.pi/24.
+    def F(h): # integral of the temperature above the base
+        return (mean-base_temp)*h - amp/w*math.cos(w*h)
+    s = (base_temp-mean)/amp
+    if s >= 1:
+        return 0.
+    if s <= -1:
+        return F(t1)-F(t0)
+    a, b = math.asin(s)/w, (math.pi-math.asin(s))/w # above the base in [a, b] (+ 24 k)
+    dh = 0.
+    for k in range(-1, 3):
+        lo, hi = max(t0, a+24*k), min(t1, b+24*k)
+        if hi > lo:
+            dh += F(hi)-F(lo)
+    return dh
+
+
+def ref_cumsum(DD):
+    # days without a value add nothing
+    c, out = 0., []
+    for x in DD.values:
+        if not math.isnan(x):
+            c += x
+        out.append(c)
+    return pd.Series(out, index=DD.index)
+
+
+def ref_generation_dates(DD, start_date, DD_per_gen, num_gen):
+    """
+    Walk the days after start_date adding up DD until each generation is completed
+    """
+    start_date = pd.Timestamp(start_date)
+    dates = [start_date] + [pd.NaT]*num_gen
+    c, gen = 0., 1
+    for d, x in zip(DD.index, DD.values):
+        if d <= start_date:
+            continue
+        if not math.isnan(x):
+            c += x
+        while gen <= num_gen and c > DD_per_gen*gen:
+            dates[gen] = d
+            gen += 1
+        if gen > num_gen:
+            break
+    return dates
+
+
+def ref_slot(d):
+    # day of the year on a leap year calendar (0-365)
+    return datetime(2000, d.month, d.day).timetuple().tm_yday - 1
+
+
+def ref_normals(t, norm_method, window=15, harmonics=3):
+    """
+    Normals of the minAT & maxAT for each of the 366 slots; mean & median
+    slots with no data (and Feb 29) are NaN (not checked)
+    """
+    slots = np.array([ref_slot(d) for d in t.index])
+    norm = {}
+    for col in ['minAT', 'maxAT']:
+        x = t[col].values.astype(float)
+        ok = ~np.isnan(x)
+        out = np.full(366, np.nan)
+        if norm_method in ['mean', 'median']:
+            f = np.mean if norm_method == 'mean' else np.median
+            for s in range(366):
+                v = x[ok & (slots == s)]
+                if len(v) > 0 and s != ddtool_html.FEB29_SLOT:
+                    out[s] = f(v)
+        elif norm_method == 'rolling':
+            half = (2*(max(1, window)//2)+1)//2
+            for s in range(366):
+                near = (np.abs(slots - s) <= half) | (366 - np.abs(slots - s) <= half)
+                v = x[ok & near]
+                if len(v) > 0:
+                    out[s] = v.mean()
+        elif norm_method == 'harmonic':
+            def design(s):
+                phase = 2*np.pi*np.asarray(s)/366
+                return np.column_stack([np.ones(len(phase))] +
+                                       [f(h*phase) for h in range(1, harmonics+1) for f in (np.cos, np.sin)])
+            coef = np.linalg.lstsq(design(slots[ok]), x[ok], rcond=None)[0]
+            out = design(np.arange(366)) @ coef
+        norm[col] = out
+    return pd.DataFrame(norm, index=pd.RangeIndex(366, name='slot'))
+
+
+## checks ##
+def check_dd(name, t, start_date, base_temp, DD_per_gen, args):
+    """
+    Compare the ddtool_html daily DD, cumulative DD and generation dates to
+    the references; returns a list of problem descriptions
+    """
+    problems = []
+    dd = ddtool_html.compute_BMDD_Fs(t['minAT'], t['maxAT'], base_temp)['DD']
+    cDD = ddtool_html.cumsum_dd(dd)
+    fdate = list(ddtool_html.generation_dates(cDD, start_date, DD_per_gen, NUM_GEN))
+    rDD = ref_dd(t['minAT'], t['maxAT'], base_temp)
+    problems += compare_series('DD', rDD, dd, args)
+    problems += compare_series('cDD', ref_cumsum(rDD), cDD, args)
+    problems += compare_dates('generation dates', ref_generation_dates(rDD, start_date, DD_per_gen, NUM_GEN),
+                              fdate)
+
+    out = pd.DataFrame({'DD': dd, 'cDD': cDD})
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+        out.to_csv(os.path.join(args.save, name+'.csv'), index_label='date')
+        with open(os.path.join(args.save, name+'-generations.json'), 'w') as fh:
+            json.dump([str(d) for d in fdate], fh)
+    if args.golden:
+        fn = os.path.join(args.golden, name+'.csv')
+        if not os.path.isfile(fn):
+            problems.append("  no golden output '{}'".format(fn))
+        else:
+            gold = pd.read_csv(fn, index_col='date', parse_dates=['date'])
+            problems += compare_series('golden DD', gold['DD'], dd, args)
+            problems += compare_series('golden cDD', gold['cDD'], cDD, args)
+            with open(os.path.join(args.golden, name+'-generations.json')) as fh:
+                problems += compare_dates('golden generation dates',
+                                          [pd.Timestamp(d) for d in json.load(fh)], fdate)
+    return problems
+
+
+def check_normals(t, norm_method, args):
+    norm = ddtool_html.compute_normals(t, norm_method)
+    ref = ref_normals(t, norm_method)
+    problems = []
+    for col in ['minAT', 'maxAT']:
+        checked = ref[col].notnull()
+        problems += compare_series(col, ref.loc[checked, col], norm.loc[checked, col], args, label='slot')
+    return problems
+
+
+def check_coverage(t, readings):
+    """
+    Compare the rejected bits of the days of t to the days (with enough
+    readings) without a reading in the night (afternoon) hours, found
+    day-by-day from the readings
+    """
+    args = ddtool_html.default_args()
+    windows = [(ddtool_html.REJECT_MIN, EXAMPLE_NIGHT_HOURS), (ddtool_html.REJECT_MAX, EXAMPLE_AFTERNOON_HOURS)]
+    ref = {}
+    for day, r in readings[readings['AT'].notnull()].groupby('day'):
+        hours = set(r.index.hour)
+        bits = 0
+        if len(r) >= args.min_readings_per_day:
+            for bit, window in windows:
+                lo, hi = [int(x) for x in window.split('-')]
+                if not hours & set(range(lo, hi)):
+                    bits |= bit
+        ref[day] = bits
+    ref = pd.Series(ref).reindex(t.index[t['normN'] == 0], fill_value=0)
+    problems = []
+    if not ref.any():
+        problems.append("  no days rejected by the reference (nothing checked)")
+    new = t.loc[ref.index, 'rejected']
+    bad = ref.values != new.values
+    if bad.any():
+        problems.append("  rejected: differs on {} of {} days".format(bad.sum(), len(ref)))
+        problems += ["    {}  ref={}  new={}".format(d, a, b)
+                     for d, a, b in zip(ref.index[bad], ref.values[bad], new.values[bad])][:10]
+    return problems
+
+
+def check_compact(t, args):
+    """
+    Compare a daily frame, and its coverage_stats, to its
+    compact_daily/expand_daily round trip (cntAT, minAT & maxAT to float32
+    precision)
+    """
+    t = t.copy()
+    t.loc[t['normN'] > 0, 'cntAT'] += 1/3. # projected counts are means of the normals
+    new = ddtool_html.expand_daily(ddtool_html.compact_daily(t))
+    problems = []
+    for col in ['cntAT', 'minAT', 'maxAT', 'normN', 'hoursAT', 'rejected', 'flaggedAT', 'filled', 'neighbor']:
+        ref = t[col].astype(np.float32) if col in ['cntAT', 'minAT', 'maxAT'] else t[col]
+        problems += compare_series('compact '+col, ref, new[col], args)
+    ref, stats = ddtool_html.coverage_stats(t), ddtool_html.coverage_stats(new)
+    if not ref['qc_flagged_readings'] or not ref['night_window_missing_days']:
+        problems.append("  no flagged readings or rejected days (nothing checked)")
+    for k in ref:
+        if not np.isclose(ref[k], stats[k], equal_nan=True):
+            problems.append("  compact coverage_stats {}: ref={} new={}".format(k, ref[k], stats[k]))
+    return problems
+
+
+def check_store_upsert(rng, args):
+    """
+    Upsert a batch of days with gaps over a station's stored days and compare
+    the store to the expected days (the batch's where it has them, else the
+    stored ones), also checking another station is untouched
+    """
+    def days(idx):
+        return pd.DataFrame({'minAT': np.round(rng.normal(50, 10, len(idx)), 2),
+                             'maxAT': np.round(rng.normal(70, 10, len(idx)), 2),
+                             'cntAT': rng.integers(4, 30, len(idx)),
+                             'flags': 0}, index=idx)
+    stored = days(pd.date_range('2020-01-01', periods=60, freq='D'))
+    other = days(stored.index)
+    batch = days(stored.index[[5, 6, 7, 20, 40, 41]].append(pd.DatetimeIndex(['2020-03-15'])))
+    expect = pd.concat((stored.drop(batch.index, errors='ignore'), batch)).sort_index()
+    problems = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store_fn = os.path.join(tmpdir, 'golden.hdf')
+        ddstore.upsert_daily(store_fn, 'A', stored)
+        ddstore.upsert_daily(store_fn, 'B', other)
+        ddstore.upsert_daily(store_fn, 'A', batch)
+        for station, ref in [('A', expect), ('B', other)]:
+            new = ddstore.read_store(store_fn, station)
+            for col in ['minAT', 'maxAT', 'cntAT']:
+                problems += compare_series('store {} {}'.format(station, col),
+                                           ref[col].astype(np.float32), new[col], args)
+    return problems
+
+
+def check_store_ingest():
+    """
+    Ingest hourly readings, re-ingest (replace) an older part of them, then
+    ingest incrementally past the end: each day must count its 24 readings
+    once
+    """
+    def readings(first, last):
+        idx = pd.date_range(first, last, freq='60min')
+        return pd.DataFrame({'T': 50+10*np.sin(np.arange(len(idx))*2*np.pi/24)}, index=idx)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store_fn = os.path.join(tmpdir, 'golden.hdf')
+        ddstore.ingest_readings(store_fn, 'A', readings('2020-01-01', '2020-01-10 23:00'))
+        ddstore.ingest_readings(store_fn, 'A', readings('2020-01-01', '2020-01-03 23:00'), replace=True)
+        ddstore.ingest_readings(store_fn, 'A', readings('2020-01-01', '2020-01-12 23:00'))
+        stored = ddstore.read_store(store_fn, 'A')
+    bad = stored.index[stored['cntAT'] != 24]
+    if len(stored) != 12 or len(bad):
+        return ["  {} days stored; readings counts off on {}".format(len(stored), list(bad.date))]
+    return []
+
+
+def check_store_cdd(rng, args):
+    """
+    Add random days to a daily store in two batches, getting the generation
+    dates from the stored cumulative DD (ddtool_html.stored_generation_dates)
+    after each, and compare the stored DD & cDD and the generation dates of
+    each start date (counting only the days up to the next start) to the
+    references
+    """
+    t, start_date, base_temp, DD_per_gen = random_daily(rng)
+    t = t.assign(cntAT=24, flags=0)
+    t.loc[start_date, 'minAT'] = np.nan # a missing start day counts as missing
+    starts = [start_date, start_date+pd.Timedelta(days=int(rng.integers(1, t.index[-1].dayofyear+30)))]
+    starts = [d for d in starts if d <= t.index[-1]]
+    problems = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store_fn = os.path.join(tmpdir, 'golden.hdf')
+        split = t.index[int(len(t)*0.6)]
+        ddstore.upsert_daily(store_fn, 'A', t.loc[:split])
+        ddtool_html.stored_generation_dates(store_fn, 'A', base_temp, starts[:1], DD_per_gen, NUM_GEN)
+        ddstore.upsert_daily(store_fn, 'A', t.loc[split+pd.Timedelta(days=1):])
+        gens = ddtool_html.stored_generation_dates(store_fn, 'A', base_temp, starts, DD_per_gen, NUM_GEN)
+        stored = ddstore.read_store(store_fn, 'A')
+        cdd = ddstore.read_cdd(store_fn, 'A', base_temp)
+    days = pd.date_range(stored.index[0], stored.index[-1], freq='D')
+    rDD = ref_dd(stored['minAT'].astype(float).reindex(days), stored['maxAT'].astype(float).reindex(days),
+                 base_temp)
+    problems += compare_series('stored DD', rDD, cdd['DD'], args)
+    problems += compare_series('stored cDD', ref_cumsum(rDD), cdd['cDD'], args)
+    for i, g in enumerate(gens):
+        seg = rDD.loc[starts[i]:(starts[i+1]-pd.Timedelta(days=1) if i+1 < len(starts) else None)]
+        problems += compare_dates('stored generation dates from {}'.format(starts[i].date()),
+                                  ref_generation_dates(seg, starts[i], DD_per_gen, NUM_GEN), list(g['fdate']))
+        if g['missing_days'] != int(seg.isnull().sum()):
+            problems.append("  stored missing days from {}: ref={} new={}".format(
+                                starts[i].date(), int(seg.isnull().sum()), g['missing_days']))
+    return problems
+
+
+def check_results_only(rng):
+    """
+    Run with --results-only and --timing-summary on a daily store: the json
+    results and the timing sidecar are written (and no report), and
+    write_results keeps bool daily columns (eg: hourly) as bools
+    """
+    idx = pd.date_range('2016-01-01', '2018-06-30', freq='D')
+    season = 60-15*np.cos(2*np.pi*(idx.dayofyear.values-15)/365.25)
+    t = pd.DataFrame({'minAT': season-10+rng.normal(0, 3, len(idx)),
+                      'maxAT': season+10+rng.normal(0, 3, len(idx)),
+                      'cntAT': 24, 'flags': 0}, index=idx)
+    problems = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store_fn = os.path.join(tmpdir, 'golden.hdf')
+        out_fn = os.path.join(tmpdir, 'golden.html')
+        ddstore.upsert_daily(store_fn, 'A', t)
+        a = ddtool_html.default_args(temperatures_file=store_fn, out_file=out_fn, station='A',
+                                     start_date='2018-03-01', base_temp=BASE_TEMP, DD_per_gen=DD_PER_GEN,
+                                     results_only=True, timing_summary=True, no_open=True)
+        retval = ddtool_html.main_process(a, None, None)
+        if retval:
+            return ["  results only run returned {}".format(retval)]
+        for fn in [os.path.splitext(out_fn)[0]+'.json', os.path.splitext(out_fn)[0]+'.timing.json']:
+            if not os.path.isfile(fn):
+                problems.append("  '{}' not written".format(os.path.basename(fn)))
+        if os.path.isfile(out_fn):
+            problems.append("  report written with --results-only")
+        daily = pd.DataFrame({'DD': [1.5, np.nan], 'hourly': [True, False]},
+                             index=pd.DatetimeIndex(['2018-03-01', '2018-03-02'], name='date'))
+        fn = os.path.join(tmpdir, 'bool.json')
+        ddtool_html.write_results(fn, 'json', {}, daily)
+        with open(fn) as fh:
+            cols = json.load(fh)['daily']
+    if cols['hourly'] != [True, False] or not all(isinstance(x, bool) for x in cols['hourly']) or \
+            cols['DD'] != [1.5, None]:
+        problems.append("  json daily columns: {}".format(cols))
+    return problems
+
+
+def check_degree_hours(rng, num_days=3, step_minutes=10, max_gap_minutes=90, rtol=1e-3):
+    """
+    Compare compute_degree_hours of readings of sine days (crossing the base
+    temperature) to the analytic integral over the hours they cover, with a
+    gap longer than max_gap_minutes on the second day that isn't integrated
+    """
+    mean, amp = rng.uniform(55, 65), rng.uniform(8, 15)
+    base_temp = mean+rng.uniform(-0.5, 0.5)*amp
+    idx = pd.date_range('2020-06-01', periods=num_days*24*60//step_minutes, freq='{}min'.format(step_minutes))
+    h = (idx-idx[0])/pd.Timedelta(hours=1)
+    gap = (h > 24+6) & (h < 24+9) # from 6:00 to 9:00 of the 2nd day
+    readings = pd.DataFrame({'AT': mean+amp*np.sin(2*np.pi*h/24.), 'day': idx.floor('D')}, index=idx)[~gap]
+    dh = ddtool_html.compute_degree_hours(readings, base_temp, max_gap_minutes=max_gap_minutes)
+    problems = []
+    if dh.shape[0] != num_days:
+        return ["  {} days of degree-hours from {} days of readings".format(dh.shape[0], num_days)]
+    for d in range(num_days):
+        # each day covers to the first reading of the next (the last day to its last reading)
+        end = 24. if d+1 < num_days else 24.-step_minutes/60.
+        spans = [(0., 6.), (9., end)] if d == 1 else [(0., end)]
+        ref = sum(ref_sine_dh(mean, amp, base_temp, a, b) for a, b in spans)
+        hours = sum(b-a for a, b in spans)
+        new = dh.iloc[d]
+        if not np.isclose(new['hours'], hours) or not np.isclose(new['DH']/new['hours'], ref/hours, rtol=rtol):
+            problems.append("  day {} DH/hours: ref={:.5f} ({} h) new={:.5f} ({} h)".format(
+                                d+1, ref/hours, hours, new['DH']/new['hours'], new['hours']))
+    return problems
+
+
+def check_local_dst(tz='America/Los_Angeles'):
+    """
+    Days and hours (local_day_hours) of half-hourly readings logged in local
+    time over the spring-forward and fall-back dates, plus one in the skipped
+    hour.  In logger order the repeated hour is inferred; sorted, its
+    readings can't be told apart and are dropped (NaT)
+    """
+    utc = pd.date_range('2021-03-13 08:00', '2021-03-16 07:30', freq='30min').append(
+            pd.date_range('2021-11-06 07:00', '2021-11-09 07:30', freq='30min'))
+    local = utc.tz_localize('UTC').tz_convert(tz).tz_localize(None)
+    skipped = pd.Timestamp('2021-03-14 02:15')
+    pos = int(np.searchsorted(local[:len(local)//2], skipped))
+    times = local.insert(pos, skipped)
+    ref_days, ref_hours = times.normalize(), np.asarray(times.hour)
+    ref_hours[pos] = 3 # moved past the skipped hour
+    problems = []
+    for how, order in [('logger order', np.arange(len(times))), ('sorted', np.argsort(times.values, kind='stable'))]:
+        try:
+            days, hours = local_day_hours(times[order], tz=tz, source_tz=tz)
+        except Exception as e:
+            problems.append("  {}: local_day_hours failed: {!r}".format(how, e))
+            continue
+        expect_days, expect_hours = ref_days[order], ref_hours[order]
+        if how == 'sorted':
+            repeated = times[order].duplicated(keep=False)
+            expect_days = expect_days.where(~repeated)
+            expect_hours = np.where(repeated, -1, expect_hours)
+        bad = ~((days == expect_days) | (days.isna() & expect_days.isna())) | (hours != expect_hours)
+        if bad.any():
+            problems.append("  {}: {} readings differ, eg: {} day={} hour={} (ref {} {})".format(
+                                how, bad.sum(), times[order][bad][0], days[bad][0], hours[bad][0],
+                                expect_days[bad][0], expect_hours[bad][0]))
+    return problems
+
+
+def check_not_reached(rng, num_gen=60):
+    """
+    Run the whole report (html, csv results and plots) on a daily store with
+    more generations than the data (with projection) reaches, and check the
+    generations past the end are listed as not reached
+    """
+    idx = pd.date_range('2014-01-01', '2018-06-30', freq='D')
+    season = 60-15*np.cos(2*np.pi*(idx.dayofyear.values-15)/365.25)
+    t = pd.DataFrame({'minAT': season-10+rng.normal(0, 3, len(idx)),
+                      'maxAT': season+10+rng.normal(0, 3, len(idx)),
+                      'cntAT': 24, 'flags': 0}, index=idx)
+    problems = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store_fn = os.path.join(tmpdir, 'golden.hdf')
+        out_fn = os.path.join(tmpdir, 'golden.html')
+        ddstore.upsert_daily(store_fn, 'A', t)
+        a = ddtool_html.default_args(temperatures_file=store_fn, out_file=out_fn, station='A',
+                                     start_date='2018-03-01', base_temp=BASE_TEMP, DD_per_gen=DD_PER_GEN,
+                                     num_gen=num_gen, results_format='csv', no_open=True)
+        ddtool_html.plt.switch_backend('Agg') # no windows
+        try:
+            retval = ddtool_html.main_process(a, None, None)
+        except Exception as e:
+            return ["  report with num_gen={} failed: {!r}".format(num_gen, e)]
+        finally:
+            ddtool_html.plt.close('all')
+        if retval:
+            return ["  report with num_gen={} returned {}".format(num_gen, retval)]
+        with open(os.path.splitext(out_fn)[0]+'.csv') as fh:
+            summary = json.loads("".join(line[2:] for line in fh if line.startswith('# ')))
+        with open(out_fn) as fh:
+            report = fh.read()
+    status = [g['status'] for g in summary['generations']]
+    if len(status) != num_gen or 'not reached' not in status or status[0] == 'not reached':
+        problems.append("  results generation status: {}".format(status))
+    n = report.count(' : not reached')
+    if n != status.count('not reached'):
+        problems.append("  report lists {} generations not reached; results {}".format(
+                            n, status.count('not reached')))
+    return problems
+
+
+class HeadlessListbox(Multicolumn_Listbox):
+    """
+    Virtual Multicolumn_Listbox rows without the Treeview (nothing is drawn)
+    """
+    def __init__(self, columns, sort_command=None):
+        self._virtual = True
+        self._columns = columns
+        self._number_of_columns = len(columns)
+        self._data = []
+        self._selected = set()
+        self._top = 0
+        self._slots = []
+        self._sort_command = sort_command
+
+    def _render(self):
+        pass
+
+    def _render_row(self, index):
+        pass
+
+    def _update_scrollbar(self):
+        pass
+
+    def fit_width_to_content(self, padding=5):
+        pass
+
+
+def check_sort_missing(rng, num_rows=50):
+    """
+    Sort listbox rows with missing values (blank, None) by a number, a date
+    and a string column, ascending and descending: the values present are
+    in order and the missing ones last, either way
+    """
+    rows = []
+    for i in range(num_rows):
+        miss = rng.random(3) < 0.2
+        rows.append(['' if miss[0] else "{:.1f}".format(rng.normal(50, 20)),
+                     None if miss[1] else str(pd.Timestamp('2018-01-01')+pd.Timedelta(days=int(rng.integers(365)))),
+                     '' if miss[2] else 'station {}'.format(int(rng.integers(100))),
+                     i])
+    lb = HeadlessListbox(['number', 'date', 'name', 'row'])
+    lb.insert_rows(rows)
+    problems = []
+    for col, key in [(0, float), (1, pd.Timestamp), (2, str)]:
+        for desc in [False, True]:
+            lb.sort_by_columns([col], descending=desc)
+            values = lb.column_data(col)
+            present = [key(v) for v in values if v not in ['', None]]
+            n = len(present)
+            if any(v not in ['', None] for v in values[n:]) or present != sorted(present, reverse=desc):
+                problems.append("  column {} {}: {}".format(
+                                    col, "descending" if desc else "ascending", values))
+    return problems
+
+
+def check_serve_loads(rng, num_requests=4):
+    """
+    Concurrent cold requests of a station from a daily store should load it
+    once (the others wait and use its entry), without recording any stages
+    """
+    t, start_date, base_temp, DD_per_gen = random_daily(rng)
+    t = t.assign(cntAT=24, flags=0)
+    problems = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store_fn = os.path.join(tmpdir, 'golden.hdf')
+        ddstore.upsert_daily(store_fn, 'A', t)
+        cache = ddserve.StationCache(argparse.Namespace(**ddtool_html.load_defaults()), 2**30)
+        instrument.reset()
+        barrier = threading.Barrier(num_requests)
+        got = [None]*num_requests
+        def request(i):
+            barrier.wait()
+            got[i] = cache.get(store_fn, 'A')
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(num_requests)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+    if cache.misses != 1 or cache.hits != num_requests-1:
+        problems.append("  {} loads and {} hits for {} requests".format(cache.misses, cache.hits, num_requests))
+    if any(r is None for r in got) or len(set(id(r[0]) for r in got if r is not None)) != 1:
+        problems.append("  requests got different entries")
+    if instrument.stages():
+        problems.append("  stages recorded by the loads: {}".format([r['stage'] for r in instrument.stages()]))
+    return problems
+
+
+def check_tfile_rows(rng, num_files=200):
+    """
+    Drive the temps2daily_gui file list (without Tk): submit files, sort the
+    list by a column heading part way through the indexing results, remove
+    some, and check each file's row shows that file
+    """
+    app = temps2daily_gui.App.__new__(temps2daily_gui.App)
+    app.tfiles, app.tfile_errors, app.pending, app.stations = {}, {}, {}, []
+    app.sorted_rows, app.other_rows, app.row_keys, app.row_of = [], [], {}, None
+    app.row_serial = temps2daily_gui.count()
+    app.selected_files_strvar = argparse.Namespace(set=lambda v: None)
+    app.mc = HeadlessListbox(temps2daily_gui.TFILE_COLUMNS, sort_command=app._on_column_sort)
+    problems = []
+    def check(when):
+        for i, row in enumerate(app.mc.table_data):
+            if row != app.tfile_row(row[-1]) or app.row_index(row[-1]) != i:
+                problems.append("  {}: row {} shows {}".format(when, i, row))
+                return
+    fns = ["f{:04d}.csv".format(i) for i in range(num_files)]
+    for fn in fns:
+        app.pending[fn] = 'indexing'
+        app.update_tfile_row(fn)
+    for k, i in enumerate(rng.permutation(num_files)):
+        if k == num_files//3:
+            app.mc.sort_by_columns([4, 0], [False, True]) # heading clicks
+            check('after sort')
+        fn = fns[i]
+        app.pending.pop(fn)
+        last = pd.Timestamp('2018-01-01')+pd.Timedelta(days=int(rng.integers(0, 30)))
+        app._indexed(fn, {'station': str(rng.choice(['A', 'B'])), 'first': last-pd.Timedelta(days=30),
+                          'last': last, 'nrows': 10, 'tcol': 'T'})
+    check('after the results')
+    app.mc._selected = set(range(0, num_files, 7))
+    app.update_stations = lambda: None # no Tk for the priority comboboxes
+    app._remove_selected_files()
+    check('after removing')
+    app.tfiles = dict(sorted(app.tfiles.items(), key=temps2daily_gui.tfile_sort_key))
+    app.update_tfiles_listbox() # the Sort button
+    check('after Sort')
+    if len(app.mc.table_data) != num_files-len(range(0, num_files, 7)):
+        problems.append("  {} rows listed".format(len(app.mc.table_data)))
+    return problems
+
+
+def compare_series(what, ref, new, args, label='date'):
+    """
+    Days (index values) where new differs from ref by more than the tolerance
+    (NaN only matches NaN); returns a list of problem descriptions
+    """
+    if not ref.index.equals(new.index):
+        return ["  {}: index differs ({} vs {} values)".format(what, len(ref), len(new))]
+    r = ref.values.astype(float)
+    n = new.values.astype(float)
+    bad = ~np.isclose(n, r, rtol=args.rtol, atol=args.atol, equal_nan=True)
+    if not bad.any():
+        return []
+    diff = np.abs(n-r)
+    lines = ["  {}: differs on {} of {} {}s (max abs diff {:g})".format(
+                what, bad.sum(), len(r), label, np.nanmax(np.where(bad, diff, np.nan)))]
+    for i in np.flatnonzero(bad)[:args.max_report]:
+        lines.append("    {}  ref={:.10g}  new={:.10g}  diff={:g}".format(ref.index[i], r[i], n[i], diff[i]))
+    return lines
+
+
+def compare_dates(what, ref, new):
+    if len(ref) != len(new):
+        return ["  {}: {} vs {} dates".format(what, len(ref), len(new))]
+    bad = [(i, a, b) for i, (a, b) in enumerate(zip(ref, new))
+           if not ((pd.isnull(a) and pd.isnull(b)) or a == b)]
+    if not bad:
+        return []
+    return ["  {}: differ".format(what)] + \
+           ["    generation {}  ref={}  new={}".format(i, a, b) for i, a, b in bad]
+
+
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
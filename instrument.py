@@ -0,0 +1,270 @@
+"""
+Lightweight per-stage instrumentation of the processing pipeline.
+Each stage records wall time, CPU time, the increase of the peak resident
+memory (RSS) and, optionally, a row count.
+
+    instrument.reset()
+    instrument.start('load')
+    ...
+    instrument.stop(rows=df.shape[0])
+    instrument.write_json('report.timing.json')
+    logging.info(instrument.summary())
+
+Whole runs can be profiled with profile_call (the scripts' --profile option),
+either deterministically with cProfile or by sampling the stack.
+"""
+
+import sys
+import os
+import time
+import json
+import logging
+import threading
+import contextlib
+import cProfile
+import pstats
+
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+_stages = [] # finished stages, in order
+_running = [] # stack of started stages
+_listeners = [] # called with ('start', name) and ('stop', record); eg: GUI progress (tkworker.py)
+_local = threading.local() # per thread: off when not recording (see disabled)
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process in bytes (None if not available)
+    """
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss*1024 # linux reports KiB
+    if psutil is not None:
+        mi = psutil.Process().memory_info()
+        return getattr(mi, 'peak_wset', mi.rss)
+    return None
+
+
+def reset():
+    del _stages[:]
+    del _running[:]
+
+
+@contextlib.contextmanager
+def disabled():
+    """
+    Don't record (or notify listeners of) the stages run by this thread in
+    the block; eg: the requests of ddserve.py, which run concurrently
+    """
+    prev = getattr(_local, 'off', False)
+    _local.off = True
+    try:
+        yield
+    finally:
+        _local.off = prev
+
+
+def add_listener(func):
+    _listeners.append(func)
+
+
+def remove_listener(func):
+    if func in _listeners:
+        _listeners.remove(func)
+
+
+def _notify(event, arg):
+    # exceptions of listeners are passed on (tkworker uses this to cancel a run)
+    for func in list(_listeners):
+        func(event, arg)
+
+
+def start(name):
+    """
+    Start timing the stage name; stages can be nested
+    """
+    if getattr(_local, 'off', False):
+        return
+    _notify('start', name)
+    _running.append({'stage': name,
+                     'wall_start': time.perf_counter(),
+                     'cpu_start': time.process_time(),
+                     'rss_start': peak_rss()})
+
+
+def stop(rows=None):
+    """
+    Finish the most recently started stage; returns its record
+    """
+    if getattr(_local, 'off', False):
+        return None
+    if not _running:
+        logging.warning("instrument.stop() without a running stage")
+        return None
+    st = _running.pop()
+    rss = peak_rss()
+    rec = {'stage': st['stage'],
+           'depth': len(_running),
+           'wall_s': time.perf_counter()-st['wall_start'],
+           'cpu_s': time.process_time()-st['cpu_start'],
+           'peak_rss_delta_bytes': None if rss is None or st['rss_start'] is None else rss-st['rss_start'],
+           'rows': None if rows is None else int(rows)}
+    _stages.append(rec)
+    _notify('stop', rec)
+    return rec
+
+
+def stages():
+    return list(_stages)
+
+
+def summary():
+    """
+    Table of the finished stages as a string (for the log)
+    """
+    lines = ["{:<24s} {:>10s} {:>10s} {:>12s} {:>12s}".format(
+                "stage", "wall [s]", "cpu [s]", "peak RSS +MB", "rows")]
+    for rec in _stages:
+        rss = rec['peak_rss_delta_bytes']
+        lines.append("{:<24s} {:>10.3f} {:>10.3f} {:>12s} {:>12s}".format(
+                "  "*rec['depth'] + rec['stage'],
+                rec['wall_s'], rec['cpu_s'],
+                "" if rss is None else "{:.1f}".format(rss/2**20),
+                "" if rec['rows'] is None else str(rec['rows'])))
+    return "\n".join(lines)
+
+
+def write_json(fn, **extra):
+    """
+    Write the finished stages (and any extra info) to the json file fn
+    """
+    with open(fn, 'w') as fh:
+        json.dump(dict(extra, stages=_stages, peak_rss_bytes=peak_rss()), fh, indent=1, default=str)
+
+
+## profiling ##
+def profile_call(func, prefix, sample_interval=None, *args, **kwargs):
+    """
+    Call func(*args, **kwargs) under the profiler and return its result.
+    With cProfile (default) writes prefix.prof (for pstats, snakeviz, ...)
+    and prefix.collapsed.txt, stacks in the collapsed format of flamegraph.pl
+    and speedscope with times in microseconds.  If sample_interval (seconds)
+    is given the stack is instead sampled at that interval, which costs much
+    less on long runs; only prefix.collapsed.txt (sample counts) is written.
+    """
+    collapsed_fn = prefix+'.collapsed.txt'
+    if sample_interval:
+        sampler = _StackSampler(threading.get_ident(), sample_interval)
+        sampler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sampler.stop()
+            _write_collapsed(collapsed_fn, sampler.counts)
+            logging.info("Profile ({} samples) saved to '{}'".format(
+                            sum(sampler.counts.values()), collapsed_fn))
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(func, *args, **kwargs)
+    finally:
+        prof.dump_stats(prefix+'.prof')
+        _write_collapsed(collapsed_fn, collapse_pstats(pstats.Stats(prof)))
+        logging.info("Profile saved to '{}' and '{}'".format(prefix+'.prof', collapsed_fn))
+
+
+def profile_prefix(profile, script):
+    """
+    File prefix for the --profile option value (True/'' for the default of
+    script name and time)
+    """
+    if profile and profile is not True and str(profile).lower() not in ['true', 'yes', 'y', '1']:
+        return os.path.splitext(str(profile))[0]
+    return "{}-{}".format(os.path.splitext(os.path.basename(script))[0],
+                          time.strftime("%Y%m%d-%H%M%S"))
+
+
+def _frame_name(filename, funcname):
+    if filename == '~': # built-in
+        name = funcname
+    else:
+        name = "{}:{}".format(os.path.basename(filename), funcname)
+    return name.replace(';', ',').replace(' ', '_')
+
+
+def collapse_pstats(stats, max_depth=100, min_fraction=1e-4):
+    """
+    Collapsed stacks from cProfile stats.  cProfile only keeps caller ->
+    callee totals, so each function's time is split between its callers in
+    proportion to the time it spent for each.  Calls taking less than
+    min_fraction of the total time are not expanded (keeps the number of
+    stacks bounded).  Returns {stack: microseconds}.
+    """
+    min_time = min_fraction*sum(tt for cc, nc, tt, ct, callers in stats.stats.values())
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    counts = {}
+
+    def walk(func, path, frac):
+        cc, nc, tt, ct, callers = stats.stats[func]
+        path = path+[_frame_name(func[0], func[2])]
+        key = ';'.join(path)
+        t = tt*frac
+        for callee, edge_ct in callees.get(func, []):
+            total = stats.stats[callee][3]
+            if callee in seen or total <= 0: # recursion: already accounted for on this path
+                continue
+            f = frac*min(1., edge_ct/total)
+            if f*total < min_time or len(path) >= max_depth:
+                t += f*total # too small to expand; count it here
+                continue
+            seen.add(callee)
+            walk(callee, path, f)
+            seen.discard(callee)
+        us = int(round(t*1e6))
+        if us > 0:
+            counts[key] = counts.get(key, 0)+us
+
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers: # roots
+            seen = {func}
+            walk(func, [], 1.)
+    return counts
+
+
+class _StackSampler(threading.Thread):
+    # samples the stack of thread tid every interval seconds
+    def __init__(self, tid, interval):
+        threading.Thread.__init__(self, name='stack sampler', daemon=True)
+        self.tid = tid
+        self.interval = interval
+        self.counts = {}
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.tid)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame.f_code.co_filename, frame.f_code.co_name))
+                frame = frame.f_back
+            key = ';'.join(reversed(names))
+            self.counts[key] = self.counts.get(key, 0)+1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def _write_collapsed(fn, counts):
+    with open(fn, 'w') as fh:
+        for key, n in sorted(counts.items()):
+            print(key, n, file=fh)
@@ -14,12 +14,45 @@ except ImportError:
     from tkinter.font import Font, nametofont
     from tkinter.ttk import Treeview, Style
 
+import numpy as np
+
 # Python 3 compatibility
 try:
   basestring
 except NameError:
   basestring = str
 
+
+def _as_float(value):
+    # numbers and numeric strings ("~" marks an estimate, empty is missing)
+    if value is None or (isinstance(value, basestring) and not value.strip()):
+        return np.nan
+    if isinstance(value, basestring):
+        value = value.strip().lstrip('~')
+    return float(value)
+
+def sort_ranks(values):
+    """
+    Integer ranks (equal values get the same rank) of a column's values,
+    compared as numbers if they all are numbers, else as dates/times if
+    they all are, else as strings.  Missing values (None, blank, NaN) get
+    rank -1, so the sort can keep them last in both directions.
+    """
+    try:
+        values = np.array([_as_float(value) for value in values], dtype=float)
+        missing = np.isnan(values)
+    except (ValueError, TypeError):
+        try:
+            values = np.array(values, dtype='datetime64[us]')
+            missing = np.isnat(values)
+        except (ValueError, TypeError):
+            values = np.array(['' if value is None else str(value) for value in values])
+            missing = np.char.strip(values) == ''
+    ranks = np.full(len(values), -1)
+    if not missing.all():
+        ranks[~missing] = np.unique(values[~missing], return_inverse=True)[1].reshape(-1)
+    return ranks
+
 class Row(object):
     def __init__(self, table, index):
         self._multicolumn_listbox = table
@@ -144,8 +177,18 @@ class Multicolumn_Listbox(object):
                 field_background=None, heading_font= None,
                 heading_background=None, heading_foreground=None,
                 cell_pady=2, cell_background=None, cell_foreground=None,
-                cell_font=None, headers=True):
+                cell_font=None, headers=True, virtual=False, sort_command=None):
         self._stripped_rows = stripped_rows
+        # virtual mode: the rows are kept in _data and the Treeview only has
+        # items (slots) for the visible rows, which are refilled on scrolling
+        self._virtual = virtual
+        self._data = []
+        self._selected = set() # indices of the selected rows
+        self._top = 0 # index of the first visible row
+        self._slots = []
+        self._yscrollcommand = None
+        self._headers = headers
+        self._item_data = {} # typed row values by item (non-virtual mode), for sorting
         self._columns = columns   
         self._number_of_rows = 0
         self._number_of_columns = len(columns)
@@ -235,8 +278,16 @@ class Multicolumn_Listbox(object):
 
         self.interior = Treeview(master, columns=columns, **treeview_kwargs)
         
-        if command is not None:
-            self._command = command
+        self._command = command
+        self._sort_command = sort_command # called after the rows are reordered by sort_by_columns
+        if virtual:
+            self._set_number_of_slots(height if height is not None else 10)
+            self.interior.bind("<<TreeviewSelect>>", self._on_virtual_select)
+            self.interior.bind("<Configure>", self._on_configure)
+            self.interior.bind("<MouseWheel>", self._on_mousewheel)
+            self.interior.bind("<Button-4>", self._on_mousewheel)
+            self.interior.bind("<Button-5>", self._on_mousewheel)
+        elif command is not None:
             self.interior.bind("<<TreeviewSelect>>", self._on_select)
 
         for i in range(0, self._number_of_columns):
@@ -252,8 +303,7 @@ class Multicolumn_Listbox(object):
             self.interior.column(i, anchor=cell_anchor)
             
         if data is not None:
-            for row in data:
-                self.insert_row(row)
+            self.insert_rows(data)
 
     @property
     def row_height(self):
@@ -272,6 +322,12 @@ class Multicolumn_Listbox(object):
         self.interior.column('#%s'%(index+1), **kwargs)
 
     def row_data(self, index):
+        if self._virtual:
+            try:
+                return list(self._data[index])
+            except IndexError:
+                raise ValueError("Row index out of range: %d"%index)
+
         try:
             item_ID = self.interior.get_children()[index]
         except IndexError:
@@ -280,6 +336,16 @@ class Multicolumn_Listbox(object):
         return self.item_ID_to_row_data(item_ID)
 
     def update_row(self, index, data):
+        if self._virtual:
+            if len(data) != self._number_of_columns:
+                raise ValueError("The multicolumn listbox has only %d columns"%self._number_of_columns)
+            try:
+                self._data[index] = list(data)
+            except IndexError:
+                raise ValueError("Row index out of range: %d"%index)
+            self._render_row(index)
+            return
+
         try:
             item_ID = self.interior.get_children()[index]
         except IndexError:
@@ -287,28 +353,44 @@ class Multicolumn_Listbox(object):
             
         if len(data) == len(self._columns):
             self.interior.item(item_ID, values=data)
+            self._item_data[item_ID] = list(data)
         else:
             raise ValueError("The multicolumn listbox has only %d columns"%self._number_of_columns)
 
     def delete_row(self, index):
+        if self._virtual:
+            try:
+                del self._data[index]
+            except IndexError:
+                raise ValueError("Row index out of range: %d"%index)
+            self._selected = set(i if i < index else i-1 for i in self._selected if i != index)
+            self._render()
+            return
+
         list_of_items = self.interior.get_children()
         try:
             item_ID = list_of_items[index]
         except IndexError:
             raise ValueError("Row index out of range: %d"%index)
         self.interior.delete(item_ID)
+        self._item_data.pop(item_ID, None)
         self._number_of_rows -= 1
         if self._stripped_rows:
             for i in range(index, self._number_of_rows):
                 self.interior.tag_configure(list_of_items[i+1], background=self._stripped_rows[i%2])
 
     def insert_row(self, data, index=None):
+        if self._virtual:
+            self.insert_rows([data], index)
+            return
+
         if len(data) != self._number_of_columns:
             raise ValueError("The multicolumn listbox has only %d columns"%self._number_of_columns)
         if index is None:
             index = self._number_of_rows
         item_ID = self.interior.insert('', index, values=data)
         self.interior.item(item_ID, tags=item_ID)
+        self._item_data[item_ID] = list(data)
         self._number_of_rows += 1
         if self._stripped_rows:
             list_of_items = self.interior.get_children()
@@ -316,29 +398,82 @@ class Multicolumn_Listbox(object):
             for i in range(index+1, self._number_of_rows):
                 self.interior.tag_configure(list_of_items[i], background=self._stripped_rows[i%2])
 
+    def insert_rows(self, rows, index=None):
+        """Insert several rows at index (default at the end)"""
+        rows = [list(row) for row in rows]
+        for data in rows:
+            if len(data) != self._number_of_columns:
+                raise ValueError("The multicolumn listbox has only %d columns"%self._number_of_columns)
+        if not self._virtual:
+            if index is None or index >= self._number_of_rows:
+                # appending, so the stripes of the existing rows don't change
+                for data in rows:
+                    item_ID = self.interior.insert('', 'end', values=data)
+                    self.interior.item(item_ID, tags=item_ID)
+                    self._item_data[item_ID] = data
+                    if self._stripped_rows:
+                        self.interior.tag_configure(item_ID, background=self._stripped_rows[self._number_of_rows%2])
+                    self._number_of_rows += 1
+            else:
+                for i, data in enumerate(rows):
+                    self.insert_row(data, index+i)
+            return
+
+        if index is None:
+            index = len(self._data)
+        self._data[index:index] = rows
+        if self._selected:
+            self._selected = set(i if i < index else i+len(rows) for i in self._selected)
+        if index < self._top + len(self._slots):
+            self._render()
+        else:
+            self._update_scrollbar()
+
     def column_data(self, index):
+        if self._virtual:
+            return [row[index] for row in self._data]
         return [self.interior.set(child_ID, index) for child_ID in self.interior.get_children('')]
 
     def update_column(self, index, data):
+        if self._virtual:
+            for row, value in zip(self._data, data):
+                row[index] = value
+            self._render()
+            return data
+
         for i, item_ID in enumerate(self.interior.get_children()):
-            data_row = self.item_ID_to_row_data(item_ID)
+            data_row = self._item_data.get(item_ID) or self.item_ID_to_row_data(item_ID)
             data_row[index] = data[i]
             self.interior.item(item_ID, values=data_row)
+            self._item_data[item_ID] = data_row
         return data
 
     def clear(self):
-        # Another possibility:
-        #  self.interior.delete(*self.interior.get_children())
-        for row in self.interior.get_children():
-            self.interior.delete(row)
+        if self._virtual:
+            self._data = []
+            self._selected = set()
+            self._top = 0
+            self._render()
+            return
+
+        self.interior.delete(*self.interior.get_children())
+        self._item_data = {}
         self._number_of_rows = 0
 
     def update(self, data):
         self.clear()
-        for row in data:
-            self.insert_row(row)
+        self.insert_rows(data)
 
     def fit_width_to_content(self, padding=5):
+        if self._virtual:
+            # only measure the longest value of each column (measuring every cell is slow)
+            for col in range(0, self.number_of_columns):
+                values = [str(self._columns[col])] + [str(row[col]) for row in self._data]
+                max_width = max(self._cell_font.measure(self._columns[col]),
+                                self._cell_font.measure(max(values, key=len)))
+                self.interior.column('#%s'%(col+1), minwidth=max_width+2*padding)
+            return
+
         for col in range(0, self.number_of_columns):
             max_width = self._cell_font.measure(self._columns[col])
             for row in range(0, self.number_of_rows):
@@ -350,6 +485,16 @@ class Multicolumn_Listbox(object):
             self.interior.column('#%s'%(col+1), minwidth=max_width+2*padding)
 
     def focus(self, index=None):
+        if self._virtual:
+            if index is None:
+                item_ID = self.interior.focus()
+                if item_ID not in self._slots:
+                    return None
+                return self.row_data(self._top + self._slots.index(item_ID))
+            self.see(index)
+            self.interior.focus(self._slots[index - self._top])
+            return
+
         if index is None:
             return self.interior.item(self.interior.focus())
         else:
@@ -364,6 +509,8 @@ class Multicolumn_Listbox(object):
 
     @property
     def number_of_rows(self):
+        if self._virtual:
+            return len(self._data)
         return self._number_of_rows
         
     @property
@@ -371,6 +518,12 @@ class Multicolumn_Listbox(object):
         return self._number_of_columns
         
     def toogle_selection(self, index):
+        if self._virtual:
+            self._check_index(index)
+            self._selected ^= set([index])
+            self._render()
+            return
+
         list_of_items = self.interior.get_children()
         
         try:
@@ -381,6 +534,12 @@ class Multicolumn_Listbox(object):
         self.interior.selection_toggle(item_ID)     
 
     def select_row(self, index):
+        if self._virtual:
+            self._check_index(index)
+            self._selected.add(index)
+            self._render()
+            return
+
         list_of_items = self.interior.get_children()
         
         try:
@@ -391,6 +550,12 @@ class Multicolumn_Listbox(object):
         self.interior.selection_add(item_ID)
 
     def deselect_row(self, index):
+        if self._virtual:
+            self._check_index(index)
+            self._selected.discard(index)
+            self._render()
+            return
+
         list_of_items = self.interior.get_children()
         
         try:
@@ -401,15 +566,30 @@ class Multicolumn_Listbox(object):
         self.interior.selection_remove(item_ID)
         
     def deselect_all(self):
+        if self._virtual:
+            self._selected = set()
+            self._render()
+            return
+
         self.interior.selection_remove(self.interior.selection())
 
     def set_selection(self, indices):
+        if self._virtual:
+            for index in indices:
+                self._check_index(index)
+            self._selected = set(indices)
+            self._render()
+            return
+
         list_of_items = self.interior.get_children()
 
         self.interior.selection_set(" ".join(list_of_items[row_index] for row_index in indices))
 
     @property
     def selected_rows(self):
+        if self._virtual:
+            return [list(self._data[i]) for i in sorted(self._selected)]
+
         data = []
         for item_ID in self.interior.selection():
             data_row = self.item_ID_to_row_data(item_ID)
@@ -419,6 +599,9 @@ class Multicolumn_Listbox(object):
 
     @property
     def indices_of_selected_rows(self):
+        if self._virtual:
+            return sorted(self._selected)
+
         list_of_indices = []
         for index, item_ID in enumerate(self.interior.get_children()):
             if item_ID in self.interior.selection():
@@ -427,9 +610,17 @@ class Multicolumn_Listbox(object):
         return list_of_indices
         
     def delete_all_selected_rows(self):
+        if self._virtual:
+            number_of_deleted_rows = len(self._selected)
+            self._data = [row for i, row in enumerate(self._data) if i not in self._selected]
+            self._selected = set()
+            self._render()
+            return number_of_deleted_rows
+
         selected_items = self.interior.selection()
         for item_ID in selected_items:
             self.interior.delete(item_ID)
+            self._item_data.pop(item_ID, None)
         
         number_of_deleted_rows = len(selected_items)
         self._number_of_rows -= number_of_deleted_rows
@@ -447,6 +638,9 @@ class Multicolumn_Listbox(object):
     
     @property
     def table_data(self):
+        if self._virtual:
+            return [list(row) for row in self._data]
+
         data = []
 
         for item_ID in self.interior.get_children():
@@ -461,6 +655,9 @@ class Multicolumn_Listbox(object):
     
     def cell_data(self, row, column):
         """Get the value of a table cell"""
+        if self._virtual:
+            return self.row_data(row)[column]
+
         try:
             item = self.interior.get_children()[row]
         except IndexError:
@@ -470,13 +667,19 @@ class Multicolumn_Listbox(object):
             
     def update_cell(self, row, column, value):
         """Set the value of a table cell"""
+        if self._virtual:
+            self._check_index(row)
+            self._data[row][column] = value
+            self._render_row(row)
+            return
 
         item_ID = self.interior.get_children()[row]
         
-        data = self.item_ID_to_row_data(item_ID)
+        data = self._item_data.get(item_ID) or self.item_ID_to_row_data(item_ID)
         
         data[column] = value
         self.interior.item(item_ID, values=data)
+        self._item_data[item_ID] = data
     
     def __getitem__(self, index):
         if isinstance(index, tuple):
@@ -499,30 +702,159 @@ class Multicolumn_Listbox(object):
         """
         sort tree contents when a column header is clicked
         """
-        # grab values to sort
-        data = [(self.interior.set(child_ID, col), child_ID) for child_ID in self.interior.get_children('')]
-        
-        # if the data to be sorted is numeric change to float
-        try:
-            data = [(float(number), child_ID) for number, child_ID in data]
-        except ValueError:
-            pass
-
-        # now sort the data in place
-        data.sort(reverse=descending)
-        for idx, item in enumerate(data):
-            self.interior.move(item[1], '', idx)
+        # stable, so rows which are equal in col stay in the previous order
+        self.sort_by_columns([col], descending)
 
         # switch the heading so that it will sort in the opposite direction
         self.interior.heading(col, command=lambda col=col: self.sort_by(col, not descending))
-        
-        if self._stripped_rows:
+
+    def sort_by_columns(self, columns, descending=False):
+        """
+        Stable sort by several columns (the first is the primary key), on the
+        values as inserted (see sort_ranks) rather than the displayed strings.
+        descending is a bool or one per column.
+        """
+        if isinstance(descending, bool):
+            descending = [descending]*len(columns)
+        if self._virtual:
+            rows = self._data
+        else:
             list_of_items = self.interior.get_children('')
-            for i in range(len(list_of_items)):
-                self.interior.tag_configure(list_of_items[i], background=self._stripped_rows[i%2])
+            rows = [self._item_data.get(item_ID) or self.item_ID_to_row_data(item_ID)
+                    for item_ID in list_of_items]
+        if not rows:
+            return
+
+        keys = []
+        for col, desc in zip(columns, descending):
+            ranks = sort_ranks([row[col] for row in rows])
+            keys.append(ranks < 0) # missing values last, either way
+            keys.append(-ranks if desc else ranks)
+        order = np.lexsort(keys[::-1]) # lexsort's primary key is the last
+
+        if self._virtual:
+            self._reorder(order)
+        else:
+            for idx, i in enumerate(order):
+                self.interior.move(list_of_items[i], '', idx)
+            if self._stripped_rows:
+                for idx, i in enumerate(order):
+                    self.interior.tag_configure(list_of_items[i], background=self._stripped_rows[idx%2])
+        if self._sort_command is not None:
+            self._sort_command()
 
     def destroy(self):
         self.interior.destroy()
+
+    def yview(self, *args):
+        """Scrollbar command (use instead of interior.yview)"""
+        if not self._virtual:
+            return self.interior.yview(*args)
+        if not args:
+            n = max(1, len(self._data))
+            return (float(self._top)/n, float(min(n, self._top+len(self._slots)))/n)
+        if args[0] == 'moveto':
+            self._top = int(round(float(args[1])*len(self._data)))
+        elif args[0] == 'scroll':
+            step = len(self._slots) if args[2] == 'pages' else 1
+            self._top += int(args[1])*step
+        self._render()
+
+    def set_yscrollcommand(self, command):
+        """Set the vertical scrollbar's set method (use instead of interior yscrollcommand)"""
+        if self._virtual:
+            self._yscrollcommand = command
+            self._update_scrollbar()
+        else:
+            self.interior.configure(yscrollcommand=command)
+
+    def see(self, index):
+        """Scroll so row index is visible"""
+        if not self._virtual:
+            self.interior.see(self.item_ID(index))
+            return
+        self._check_index(index)
+        if index < self._top:
+            self._top = index
+        elif index >= self._top + len(self._slots):
+            self._top = index - len(self._slots) + 1
+        self._render()
+
+    def _reorder(self, order):
+        # rows in the given order of the current row indices (virtual mode)
+        selected = self._selected
+        self._data = [self._data[i] for i in order]
+        self._selected = set(new for new, old in enumerate(order) if old in selected)
+        self._render()
+
+    def _check_index(self, index):
+        if not 0 <= index < len(self._data):
+            raise ValueError("Row index out of range: %d"%index)
+
+    def _set_number_of_slots(self, number_of_slots):
+        number_of_slots = max(1, number_of_slots)
+        while len(self._slots) < number_of_slots:
+            item_ID = self.interior.insert('', 'end', values=())
+            self.interior.item(item_ID, tags=item_ID)
+            self._slots.append(item_ID)
+        if len(self._slots) > number_of_slots:
+            self.interior.delete(*self._slots[number_of_slots:])
+            del self._slots[number_of_slots:]
+
+    def _render(self):
+        # fill the slots with the visible rows; only the slots are touched so
+        # this doesn't depend on the number of rows
+        number_of_rows = len(self._data)
+        self._top = max(0, min(self._top, number_of_rows - len(self._slots)))
+        selection = []
+        for i, item_ID in enumerate(self._slots):
+            index = self._top + i
+            if index < number_of_rows:
+                self.interior.move(item_ID, '', i) # reattach
+                self.interior.item(item_ID, values=self._data[index])
+                if self._stripped_rows:
+                    self.interior.tag_configure(item_ID, background=self._stripped_rows[index%2])
+                if index in self._selected:
+                    selection.append(item_ID)
+            else:
+                self.interior.detach(item_ID)
+        self.interior.selection_set(selection)
+        self._update_scrollbar()
+
+    def _render_row(self, index):
+        if self._top <= index < self._top + len(self._slots):
+            self.interior.item(self._slots[index - self._top], values=self._data[index])
+
+    def _update_scrollbar(self):
+        if self._yscrollcommand is not None:
+            self._yscrollcommand(*self.yview())
+
+    def _on_configure(self, event):
+        # as many slots as rows fit
+        header_height = self._rowheight+4 if self._headers else 0
+        number_of_slots = (event.height - header_height)//self._rowheight
+        if number_of_slots != len(self._slots):
+            self._set_number_of_slots(number_of_slots)
+            self._render()
+
+    def _on_mousewheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.yview('scroll', -1, 'units')
+        else:
+            self.yview('scroll', 1, 'units')
+        return 'break'
+
+    def _on_virtual_select(self, event):
+        # selection of the visible rows changed (clicks or _render)
+        selection = event.widget.selection()
+        visible = set(range(self._top, min(len(self._data), self._top + len(self._slots))))
+        selected = set(self._top + self._slots.index(item_ID) for item_ID in selection
+                       if item_ID in self._slots)
+        new = selected - self._selected
+        self._selected = (self._selected - visible) | selected
+        if self._command is not None:
+            for index in sorted(new):
+                self._command(list(self._data[index]))
         
     def item_ID(self, index):
         return self.interior.get_children()[index]
@@ -14,10 +14,20 @@ import dateutil
 import logging
 import io
 import glob
+import csv
+
+from collections import OrderedDict as ordereddict
 
 import numpy as np
 import pandas as pd
 
+try:
+    from zoneinfo import ZoneInfo
+except ImportError: # python < 3.9; let pandas look the name up
+    ZoneInfo = None
+
+import instrument
+
 # setup logging
 def getlvlnum(name):
     return name if isinstance(name, int) else logging.getLevelName(name)
@@ -83,7 +93,30 @@ def main(argv):
     parser.add_argument("--hour-offset", type=int, default=0,
             help="Offset from times in file to localtime for grouping by day. "
             "Typically timezone offset from UTC; eg: CA is -7. "
-            "Ignores daylight-savings")
+            "Ignores daylight-savings. Not used if --timezone is given")
+    parser.add_argument("--timezone", default='',
+            help="Timezone (tz database name, eg: America/Los_Angeles) of the local days "
+            "readings are grouped into. Handles daylight-savings")
+    parser.add_argument("--source-timezone", default='UTC',
+            help="Timezone of the times in the input files (used with --timezone)")
+    parser.add_argument("--day-start-hour", type=int, default=0,
+            help="Local hour each (observation) day starts at; eg: 6 for 06:00 to 06:00 days")
+    parser.add_argument("--min-readings-per-day", type=int, default=4,
+            help="Days with fewer readings from a station are not taken from that station")
+    parser.add_argument("--station-priority", default='',
+            help="Comma separated station names, highest priority first, used to choose "
+            "which station supplies each day when stations overlap. "
+            "Stations not listed follow in the order their files were given")
+    parser.add_argument("--csv-engine", default="auto", choices=['auto', 'c', 'python', 'pyarrow'],
+            help="Parser used for the input files; 'auto' uses pyarrow if it is installed")
+    parser.add_argument("-o", "--out-file", default=None,
+            help="Filename to write the composited daily min & max values to (csv)")
+    parser.add_argument("--profile", nargs='?', const=True, default=False, metavar='PREFIX',
+            help="Profile the run with cProfile; writes PREFIX.prof and PREFIX.collapsed.txt "
+            "(stacks for flamegraph tools). Default PREFIX is the script name and time")
+    parser.add_argument("--profile-sample", type=float, default=0, metavar='MS',
+            help="With --profile, sample the stack every MS milliseconds instead of cProfile "
+            "(lower overhead for long batch runs)")
     parser.add_argument('-q', "--quiet", action='count', default=0,
             help="Decrease verbosity")
     parser.add_argument('-v', "--verbose", action='count', default=0,
@@ -108,7 +141,11 @@ def main(argv):
                         datetime.fromtimestamp(time.time()).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z")))
     logging.info("args="+str(args))
 
-    return_value = main_process(args)
+    if args.profile:
+        return_value = instrument.profile_call(main_process, instrument.profile_prefix(args.profile, __file__),
+                                               args.profile_sample/1000., args)
+    else:
+        return_value = main_process(args)
 
     # cleanup and exit
     logging.info("Ended @ {}".format(
@@ -137,39 +174,355 @@ def main_process(args):
         logging.critical("No input files found")
         return 1
         
+    readings = ordereddict() # station -> list of reading frames
     for f in files:
         logging.info("Input file '{}'".format(f))
-        df = load_tfile(f, args.date_column, args.temperature_column)
+        station, df = load_tfile(f, args.date_column, args.temperature_column, args.csv_engine)
         if df is None:
             logging.critical("Failed to load file '{}'".format(f))
             return 1
-#        break
-    
+        readings.setdefault(station, []).append(df)
+
+    daily = ordereddict()
+    for station, dfs in readings.items():
+        daily[station] = daily_min_max(pd.concat(dfs), args.hour_offset,
+                                       tz=args.timezone, source_tz=args.source_timezone,
+                                       day_start_hour=args.day_start_hour)
+
+    priority = [x.strip() for x in args.station_priority.split(',') if x.strip()]
+    for station in priority:
+        if station not in daily:
+            logging.warning("Station '{}' in station-priority has no data".format(station))
+    priority = [x for x in priority if x in daily]
+    priority += [x for x in daily if x not in priority]
+    logging.info("Station priority: {}".format(", ".join(priority)))
+    comp = composite_stations(daily, priority, args.min_readings_per_day)
+    print(comp['station'].value_counts(sort=False))
+
+    if args.out_file:
+        logging.info("Saving to '{}'".format(args.out_file))
+        comp.to_csv(args.out_file, index_label='date')
+
     return 0
 
 
-def load_tfile(fn, date_column, temperature_column):
-    df = pd.read_csv(fn, parse_dates=[date_column]).dropna()
-    tcol = [x for x in df.columns if x.startswith(temperature_column)]
+def tfile_columns(fn, date_column, temperature_column):
+    """
+    Read just the header line of a (time, temperature) csv file and return
+    the list of columns and the (first) matching temperature column, or
+    (columns, None) if the date or temperature column is missing.
+    """
+    with open(fn, 'r', encoding='utf-8-sig', newline='') as fh:
+        cols = next(csv.reader(fh), [])
+    if date_column not in cols:
+        logging.critical("Date column '{}' not found in '{}'".format(date_column, fn))
+        return cols, None
+    tcol = [x for x in cols if x.startswith(temperature_column)]
     if len(tcol) < 1:
         logging.critical("Temperature column starting with '{}' not found".format(temperature_column))
-        return None
-    else:
-        tmp = [x.strip() for x in tcol[0].split(',')]
-        station = tmp[-1]
-        print(tmp, station)
-        
-        t = df.loc[:,[date_column,tcol[0]]]
-        t.set_index(date_column, inplace=True)
-        t.columns = ['T']
-        t.sort_index(inplace=True)
-        #t['station'] = station
-        first = t.index[0]
-        last = t.index[-1]
-        print(station, first, last)
+        return cols, None
+    return cols, tcol[0]
+
+
+def csv_engine(engine='auto'):
+    """
+    Parser engine for pd.read_csv; 'auto' uses pyarrow if it is available
+    """
+    if engine == 'auto':
+        try:
+            import pyarrow
+            engine = 'pyarrow'
+        except ImportError:
+            engine = 'c'
+    return engine
+
+
+def load_tfile(fn, date_column, temperature_column, engine='c'):
+    # only the date and temperature columns are parsed; wide exports carry many other sensors
+    _, tcol = tfile_columns(fn, date_column, temperature_column)
+    if tcol is None:
+        return None, None
+    df = pd.read_csv(fn, usecols=[date_column, tcol],
+                     dtype={tcol: np.float64},
+                     parse_dates=[date_column],
+                     engine=csv_engine(engine)).dropna()
+    tmp = [x.strip() for x in tcol.split(',')]
+    station = tmp[-1]
+    print(tmp, station)
+
+    t = df.loc[:,[date_column,tcol]]
+    t.set_index(date_column, inplace=True)
+    t.columns = ['T']
+    t.sort_index(inplace=True)
+    #t['station'] = station
+    first = t.index[0]
+    last = t.index[-1]
+    print(station, first, last)
     print(t.shape)
     print(t.head())
-    return t
+    return station, t
+
+
+def index_tfile(fn, date_column, temperature_column, nlines=5):
+    """
+    Quickly summarize a (time, temperature) csv file without parsing all of it.
+    Only the header, the first and the last few lines are read (seeking back
+    from the end of the file), so the row count is an estimate from the file
+    size.  Returns a dict with station, tcol, first, last and nrows or None if
+    the columns or dates are not found.
+    """
+    cols, tcol = tfile_columns(fn, date_column, temperature_column)
+    if tcol is None:
+        return None
+    dcol = cols.index(date_column)
+    ticol = cols.index(tcol)
+    with open(fn, 'rb') as fh:
+        header = fh.readline()
+        def _has_reading(line):
+            x = next(csv.reader([line.decode('utf-8', 'replace')]), [])
+            return len(x) > max(dcol, ticol) and x[ticol].strip() != ''
+        def _dates(lines):
+            rows = [next(csv.reader([l.decode('utf-8', 'replace')])) for l in lines if _has_reading(l)]
+            return pd.to_datetime([x[dcol] for x in rows], errors='coerce').dropna()
+
+        data_start = len(header)
+        head = [fh.readline() for _ in range(nlines)]
+        head_dates = _dates(head)
+        line_size = max(1, np.mean([len(x) for x in head]))
+        size = fh.seek(0, os.SEEK_END)
+        # read back from the end until there are readings (exports can end with empty rows)
+        blocksize = int(line_size*(nlines+1))
+        tail_dates = []
+        data_end = size
+        while True:
+            pos = max(data_start, size-blocksize)
+            fh.seek(pos)
+            lines = fh.read(size-pos).splitlines(keepends=True)
+            if pos > data_start:
+                lines = lines[1:] # probably a partial line
+            last = [i for i, l in enumerate(lines) if _has_reading(l)]
+            if last:
+                tail_dates = _dates(lines[max(0, last[-1]-nlines+1):last[-1]+1])
+                data_end = size - sum(len(l) for l in lines[last[-1]+1:])
+            if len(tail_dates) > 0 or pos == data_start:
+                break
+            blocksize *= 4
+
+    if len(head_dates) < 1 or len(tail_dates) < 1:
+        logging.critical("Could not read dates from '{}'".format(fn))
+        return None
+    return {'station': [x.strip() for x in tcol.split(',')][-1],
+            'tcol': tcol,
+            'first': head_dates.min(),
+            'last': tail_dates.max(),
+            'nrows': int(round((data_end-data_start)/line_size))}
+
+
+def local_days(times, tz='', source_tz='UTC', hour_offset=0, day_start_hour=0):
+    """
+    Map reading times to the local calendar (or observation) day they fall in.
+    times are naive datetimes (or epoch seconds) in source_tz.  If tz is
+    given the times are converted with the tz database, so daylight-savings
+    transitions are handled; otherwise hour_offset is simply added.  Days
+    start at day_start_hour local time (eg: 6 for 06:00 to 06:00 days) and
+    are labeled with the date they start on.  Everything is done as whole
+    array operations; returns a naive DatetimeIndex of days.
+    """
+    return local_day_hours(times, tz, source_tz, hour_offset, day_start_hour)[0]
+
+
+def local_day_hours(times, tz='', source_tz='UTC', hour_offset=0, day_start_hour=0):
+    """
+    local_days and the local clock hour (0-23) of each reading.  With a
+    source_tz that has daylight-savings, the repeated hour of the fall-back
+    is told apart by the order of the readings if possible, else its
+    readings get NaT days (and hour -1) so they are dropped by the groupby;
+    readings in the skipped spring-forward hour are moved past it.
+    """
+    if np.issubdtype(np.asarray(times).dtype, np.number): # epoch seconds
+        times = pd.to_datetime(np.asarray(times), unit='s')
+    times = pd.DatetimeIndex(times)
+    if tz:
+        if times.tz is None:
+            zone = ZoneInfo(source_tz) if ZoneInfo else source_tz
+            try:
+                times = times.tz_localize(zone, ambiguous='infer', nonexistent='shift_forward')
+            except Exception: # ValueError (pytz's AmbiguousTimeError with older pandas)
+                times = times.tz_localize(zone, ambiguous='NaT', nonexistent='shift_forward')
+        times = times.tz_convert(ZoneInfo(tz) if ZoneInfo else tz).tz_localize(None)
+    elif hour_offset:
+        times = times + pd.Timedelta(hours=hour_offset)
+    hours = np.where(times.isna(), -1, np.nan_to_num(times.hour.values)).astype(int)
+    if day_start_hour:
+        times = times - pd.Timedelta(hours=day_start_hour)
+    return times.normalize(), hours
+
+
+def hour_coverage(days, hours):
+    """
+    Bitmap of the local clock hours observed on each day (bit h set if there
+    is a reading in hour h), from the days and hours of the readings (see
+    local_day_hours).  One pass: 1<<hour or-reduced over each run of days.
+    Returns a uint32 Series indexed by day.
+    """
+    days = np.asarray(days)
+    bits = np.left_shift(np.uint32(1), np.asarray(hours).astype(np.uint32))
+    if len(days) == 0:
+        return pd.Series(bits, index=pd.DatetimeIndex(days))
+    if (days[1:] < days[:-1]).any():
+        order = np.argsort(days, kind='stable')
+        days, bits = days[order], bits[order]
+    starts = np.concatenate(([0], np.flatnonzero(days[1:] != days[:-1])+1))
+    return pd.Series(np.bitwise_or.reduceat(bits, starts), index=pd.DatetimeIndex(days[starts]))
+
+
+def hour_mask(spec):
+    """
+    Bitmap of the local clock hours of a window like '0-8' (hours 0 to 7;
+    '22-6' wraps around midnight); empty is no hours
+    """
+    spec = str(spec).strip()
+    if not spec:
+        return 0
+    start, end = [int(x) % 24 for x in spec.split('-')]
+    mask = 0
+    h = start
+    while True:
+        mask |= 1 << h
+        h = (h+1) % 24
+        if h == end:
+            return mask
+
+
+def count_hours(bitmap):
+    """
+    Number of hours set in hour_coverage bitmaps
+    """
+    bitmap = np.asarray(bitmap, dtype=np.uint32)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(bitmap).astype(np.int64)
+    return np.unpackbits(bitmap.reshape(-1, 1).view(np.uint8), axis=1).sum(axis=1)
+
+
+# smallest deviation from the rolling median spike_flags flags, so quiet
+# (or quantized) stretches with a MAD near 0 don't flag every small change
+QC_MIN_DEVIATION = 2.0
+QC_MAX_WINDOW = 25 # readings; longer spike windows (frequent readings) are shortened to this
+QC_CHUNK = 1 << 16 # windows per partition in rolling_median_mad
+
+def rolling_median_mad(v, window):
+    """
+    Median and MAD (median absolute deviation from that median) of the
+    centered window of each value (window odd; ends padded with the end
+    values).  Partitions a strided view of the windows in chunks, so it is
+    whole array operations without the windows ever being all in memory.
+    """
+    h = window//2
+    win = np.lib.stride_tricks.sliding_window_view(np.pad(v, h, mode='edge'), 2*h+1)
+    med = np.empty(len(v))
+    mad = np.empty(len(v))
+    for i in range(0, len(v), QC_CHUNK):
+        x = win[i:i+QC_CHUNK]
+        m = np.partition(x, h, axis=1)[:, h]
+        med[i:i+QC_CHUNK] = m
+        mad[i:i+QC_CHUNK] = np.partition(np.abs(x-m[:, None]), h, axis=1)[:, h]
+    return med, mad
+
+
+def spike_flags(times, values, window_minutes=120, mad_k=0., max_rate=0., min_dev=QC_MIN_DEVIATION):
+    """
+    Flag sensor glitches in readings sorted by time: values further than
+    mad_k (normal scaled) MADs, and at least min_dev, from the median of the
+    readings in the centered window_minutes around them (a Hampel filter),
+    and single readings jumping faster than max_rate (degrees per hour) in
+    and back out.  0 skips a test; missing values are skipped.
+    The window is a number of readings at the median interval between them
+    (at most QC_MAX_WINDOW); the median test is skipped if that is under 3,
+    since a window spanning much of the daily cycle flags the daily extremes.
+    Returns a bool array, True for the flagged readings.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    flags = np.zeros(len(values), dtype=bool)
+    ok = np.flatnonzero(~np.isnan(values))
+    if len(ok) < 3:
+        return flags
+    v = values[ok]
+    dt = np.diff(np.asarray(times, dtype='datetime64[ns]')[ok]).astype('timedelta64[s]').astype(np.float64)/3600.
+    bad = np.zeros(len(v), dtype=bool)
+    if mad_k > 0:
+        step = np.median(dt[dt > 0]) if (dt > 0).any() else 0.
+        window = min(int(round(window_minutes/60./step)) if step > 0 else 0, QC_MAX_WINDOW) | 1 # odd
+        if window >= 3:
+            med, mad = rolling_median_mad(v, window)
+            bad |= np.abs(v-med) > np.maximum(mad_k*1.4826*mad, min_dev)
+        else:
+            logging.warning("Readings too far apart ({:g} min) for a {} min spike window; "
+                            "not checked against the median".format(step*60, window_minutes))
+    if max_rate > 0:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rate = np.diff(v)/dt
+        fast = np.abs(rate) > max_rate
+        bad[1:-1] |= fast[:-1] & fast[1:] & ((rate[:-1] > 0) != (rate[1:] > 0))
+    flags[ok] = bad
+    return flags
+
+
+def daily_min_max(t, hour_offset=0, tz='', source_tz='UTC', day_start_hour=0):
+    """
+    Collapse readings (a load_tfile frame) to daily min, max, and count.
+    See local_days for how readings are assigned to days.
+    """
+    t = t[~t.index.duplicated(keep='first')] # overlapping exports repeat readings
+    days = local_days(t.index, tz, source_tz, hour_offset, day_start_hour)
+    gb = t['T'].groupby(days)
+    d = pd.DataFrame({'minT': gb.min(),
+                      'maxT': gb.max(),
+                      'cntT': gb.count()})
+    d.index.name = 'date'
+    return d
+
+
+def composite_stations(daily, priority, min_readings_per_day):
+    """
+    Build one daily series out of several (possibly overlapping) stations.
+    daily is a dict of station -> daily_min_max frame and priority is the
+    ordered list of stations to use, highest priority first.  Each day is
+    taken from the highest priority station with at least
+    min_readings_per_day readings for that day.  The returned frame has
+    minT, maxT, cntT and the station which supplied each day ('' where no
+    station had enough readings).
+    """
+    if not priority:
+        return pd.DataFrame(columns=['minT', 'maxT', 'cntT', 'station'],
+                            index=pd.DatetimeIndex([], name='date'))
+    days = daily[priority[0]].index
+    for station in priority[1:]:
+        days = days.union(daily[station].index)
+    days = pd.date_range(days.min(), days.max(), freq='D', name='date')
+
+    # stations x days matrices
+    shape = (len(priority), len(days))
+    minT = np.full(shape, np.nan)
+    maxT = np.full(shape, np.nan)
+    cntT = np.zeros(shape, dtype=np.int64)
+    for i, station in enumerate(priority):
+        d = daily[station].reindex(days)
+        minT[i] = d['minT'].values.astype(float)
+        maxT[i] = d['maxT'].values.astype(float)
+        cntT[i] = d['cntT'].fillna(0).values.astype(np.int64)
+    valid = (cntT >= min_readings_per_day) & ~np.isnan(minT) & ~np.isnan(maxT)
+
+    # argmax returns the first (highest priority) valid station for each day
+    best = valid.argmax(axis=0)
+    have = valid.any(axis=0)
+    cols = np.arange(len(days))
+    comp = pd.DataFrame({'minT': np.where(have, minT[best, cols], np.nan),
+                         'maxT': np.where(have, maxT[best, cols], np.nan),
+                         'cntT': np.where(have, cntT[best, cols], 0),
+                         'station': np.where(have, np.asarray(priority, dtype=object)[best], '')},
+                        index=days)
+    return comp
+
 
 ## Main hook for running as script
 if __name__ == "__main__":
@@ -1,21 +1,55 @@
 #!/usr/bin/env python3
 import os
+import sys
 import tkinter as tk
 from tkinter import ttk
 from tkinter.scrolledtext import ScrolledText
 import tkinter.filedialog
+import queue
+import bisect
+from concurrent.futures import ThreadPoolExecutor
 from multicolumn_listbox import Multicolumn_Listbox
+from temps2daily import load_tfile, index_tfile, daily_min_max, composite_stations
 
 import numpy as np
 import pandas as pd
 from collections import OrderedDict as ordereddict
+from itertools import chain, count
+
+## CONSTANTS ##
+TFILE_COLUMNS = ["station", "first date", "last date", "number", "status", "filename"]
+NUM_LOAD_THREADS = min(8, os.cpu_count() or 1) # pandas' csv parser mostly releases the GIL
+POLL_INTERVAL_MS = 100
+
+
+def tfile_sort_key(item):
+    # sort (filename, tfile) items by last date, first date, station
+    return (item[1]['last'], item[1]['first'], item[1]['station'])
+
 
 class App(ttk.Frame):
     def __init__(self, parent, *args, **kwargs):
         ttk.Frame.__init__(self, parent, *args, **kwargs)
         self.root = parent
         self.tfiles = ordereddict()
+        self.tfile_errors = ordereddict() # filename: error message
         self.stations = []
+        # listbox rows: the indexed files first, by sort key, then the pending
+        # and failed files in the order they were added.  Both are sorted
+        # lists of (key, filename), so a file's row is found by bisect.
+        # Once sorted by a column heading the rows keep that order instead,
+        # found through row_of (filename: row) until the next Sort.
+        self.sorted_rows = []
+        self.other_rows = []
+        self.row_keys = {} # filename: (sorted_rows or other_rows, key)
+        self.row_serial = count()
+        self.row_of = None
+        # files are indexed/loaded in a thread pool; results come back through
+        # the done queue, which the Tk thread polls (Tk isn't thread safe)
+        self.pool = ThreadPoolExecutor(max_workers=NUM_LOAD_THREADS)
+        self.pending = {} # filename: 'indexing' or 'loading'
+        self.done = queue.Queue()
+        self.convert_when_loaded = None # min_readings_per_day of a waiting Convert
         self.selected_files_strvar = tk.StringVar()
         self.root.title("DD Tool")
         self.pack(fill=tk.BOTH, expand=1)
@@ -29,18 +63,16 @@ class App(ttk.Frame):
         mcf = ttk.Frame(self)
         mcf.pack(fill=tk.BOTH, expand=1, side=tk.TOP, padx=0, pady=0)
         # multicolumn listbox widget
-        self.mc = Multicolumn_Listbox(mcf, ["station",
-                                            "first date",
-                                            "last date",
-                                            "number",
-                                            "filename"],
+        self.mc = Multicolumn_Listbox(mcf, TFILE_COLUMNS,
                 stripped_rows = ("white","#f2f2f2"),
                 command=self._on_select,
                 adjust_heading_to_content=True,
-                cell_anchor="center")
+                cell_anchor="center",
+                virtual=True, # only the visible rows are Treeview items
+                sort_command=self._on_column_sort)
         # scrollbars
-        ysb = ttk.Scrollbar(mcf, orient='vertical', command=self.mc.interior.yview)
-        self.mc.interior.configure(yscrollcommand=ysb.set)
+        ysb = ttk.Scrollbar(mcf, orient='vertical', command=self.mc.yview)
+        self.mc.set_yscrollcommand(ysb.set)
         ysb.pack(fill=tk.BOTH, expand=0, side=tk.RIGHT)
         xsb = ttk.Scrollbar(mcf, orient='horizontal', command=self.mc.interior.xview)
         self.mc.interior.configure(xscrollcommand=xsb.set)
@@ -58,20 +90,36 @@ class App(ttk.Frame):
         open_button.pack(expand=0, side=tk.RIGHT, padx=3, pady=3)
         sort_button = ttk.Button(mcbf, text='Sort', command=self.sort_tfiles)
         sort_button.pack(expand=0, side=tk.LEFT, padx=3, pady=3)
+        self.status_var = tk.StringVar()
+        ttk.Label(mcbf, textvariable=self.status_var).pack(expand=0, side=tk.LEFT, padx=3, pady=3)
 
         ## Station priority 
         self.station_priority_frame = ttk.LabelFrame(self, text='Station Priority')
         self.station_priority_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=0, padx=3, pady=3)
         self.stations_priority_lbs = []
-        
+
+        ## Conversion
+        cf = ttk.Frame(self)
+        cf.pack(fill=tk.BOTH, expand=0, side=tk.TOP, padx=0, pady=0)
+        self.min_readings_per_day_var = tk.StringVar(value='4')
+        ttk.Label(cf, text='min readings per day').pack(side=tk.LEFT, padx=3, pady=3)
+        ttk.Entry(cf, textvariable=self.min_readings_per_day_var, width=5).pack(side=tk.LEFT, padx=3, pady=3)
+        self.convert_button = ttk.Button(cf, text='Convert', command=self._convert)
+        self.convert_button.pack(expand=0, side=tk.RIGHT, padx=3, pady=3)
+
     def update_stations(self):
         tmp = [ x[1]['station'] for x in self.tfiles.items() ]
         stations = []
         for x in tmp:
             if x not in stations:
                 stations.append(x)
+        if set(stations) == set(self.stations):
+            return # keep the priority comboboxes (and their selections)
         print(stations)
-        # @TCC should preserve selections already made if possible
+        # keep the priorities already selected for the stations still listed
+        selected = [x for x in ordereddict.fromkeys(lb.get() for lb in self.stations_priority_lbs)
+                    if x in stations]
+        priority = selected + [x for x in stations if x not in selected]
         self.stations = stations
 
         for lb in self.stations_priority_lbs:
@@ -81,11 +129,136 @@ class App(ttk.Frame):
             lb = ttk.Combobox(self.station_priority_frame, state="readonly",
                               values=self.stations[i:],
                               exportselection=0)
-            lb.set(self.stations[i])
+            lb.set(priority[i])
             lb.pack(side=tk.LEFT, padx=3, pady=3)
             self.stations_priority_lbs.append(lb)
 
-            
+    def station_priority(self):
+        # ordered stations from the priority comboboxes; unselected stations go last
+        priority = []
+        for lb in self.stations_priority_lbs:
+            if lb.get() and lb.get() not in priority:
+                priority.append(lb.get())
+        priority += [x for x in self.stations if x not in priority]
+        return priority
+
+    def composite(self, min_readings_per_day):
+        # daily values from each station, combined by station priority
+        daily = ordereddict()
+        for station in self.stations:
+            dfs = [self.tfile_df(fn) for fn, x in self.tfiles.items() if x['station'] == station]
+            daily[station] = daily_min_max(pd.concat(dfs))
+        return composite_stations(daily, self.station_priority(), min_readings_per_day)
+
+    def _convert(self):
+        if not self.tfiles:
+            print("ERROR: No temperature files selected", file=sys.stderr)
+            return
+        try:
+            min_readings_per_day = int(self.min_readings_per_day_var.get())
+        except ValueError:
+            print("ERROR: min readings per day must be an integer", file=sys.stderr)
+            return
+        # load the files not loaded yet (in parallel) first
+        for fn, tfile in self.tfiles.items():
+            if tfile['df'] is None and fn not in self.pending:
+                self.submit(fn, 'loading', load_tfile, fn, 'Date', tfile['tcol'])
+        if self.pending:
+            self.convert_when_loaded = min_readings_per_day
+            self.convert_button.config(state='disabled')
+            return
+        self.convert(min_readings_per_day)
+
+    def convert(self, min_readings_per_day):
+        if not self.tfiles:
+            print("ERROR: No temperature files loaded", file=sys.stderr)
+            return
+        comp = self.composite(min_readings_per_day)
+        print(comp['station'].value_counts(sort=False))
+        outfilename = tk.filedialog.asksaveasfilename(
+                                parent=self.root,
+                                title='Save Daily Temperatures',
+                                defaultextension=".csv",
+                                filetypes=(("CSV files","*.csv"),("all files","*.*")))
+        if not outfilename:
+            return
+        comp.to_csv(outfilename, index_label='date')
+
+    def submit(self, fn, status, func, *args):
+        # run func(*args) in the pool; the result is handled by _poll
+        if not self.pending:
+            self.after(POLL_INTERVAL_MS, self._poll)
+        self.pending[fn] = status
+        self.update_tfile_row(fn)
+        future = self.pool.submit(func, *args)
+        future.add_done_callback(lambda f, fn=fn, status=status: self.done.put((fn, status, f)))
+        self.update_status()
+
+    def _poll(self):
+        while True:
+            try:
+                fn, status, future = self.done.get_nowait()
+            except queue.Empty:
+                break
+            if self.pending.pop(fn) == 'removed':
+                continue
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            if status == 'indexing':
+                self._indexed(fn, result)
+            else:
+                self._loaded(fn, result)
+            self.update_status()
+        if self.pending:
+            self.after(POLL_INTERVAL_MS, self._poll)
+            return
+        # all done; sort the files (their rows are already in order) once
+        self.tfiles = ordereddict(sorted(self.tfiles.items(), key=tfile_sort_key))
+        self.selected_files_strvar.set(str(self.tfiles.keys()))
+        self.update_stations()
+        self.mc.fit_width_to_content()
+        if self.convert_when_loaded is not None:
+            min_readings_per_day = self.convert_when_loaded
+            self.convert_when_loaded = None
+            self.convert_button.config(state='normal')
+            self.convert(min_readings_per_day)
+
+    def _indexed(self, fn, idx):
+        if isinstance(idx, Exception):
+            self.tfile_error(fn, idx)
+        elif idx is None:
+            self.tfile_error(fn, "Temperature column not found")
+        else:
+            # the full file is only parsed when needed (see tfile_df)
+            idx['df'] = None
+            self.tfiles[fn] = idx # sorted when the pool is done (see _poll)
+            self.update_tfile_row(fn, move=True)
+
+    def _loaded(self, fn, result):
+        if fn not in self.tfiles: # removed while loading
+            return
+        if isinstance(result, Exception) or result[1] is None or result[1].shape[0] == 0:
+            self.tfile_error(fn, result if isinstance(result, Exception) else "No readings")
+            return
+        self.set_tfile_df(fn, result[1])
+        self.update_tfile_row(fn) # now with the actual number of readings
+
+    def tfile_error(self, fn, msg):
+        # the file stays listed with the error (until removed) but isn't used
+        print("ERROR: {}: {}".format(fn, msg), file=sys.stderr)
+        self.tfiles.pop(fn, None)
+        self.tfile_errors[fn] = str(msg)
+        self.update_tfile_row(fn)
+
+    def update_status(self):
+        counts = ordereddict()
+        for status in self.pending.values():
+            if status != 'removed':
+                counts[status] = counts.get(status, 0) + 1
+        self.status_var.set(", ".join("{} {} files".format(k, v) for k, v in counts.items()))
+
     def _selectFiles(self):
         selected_files = tk.filedialog.askopenfilenames(
                                 parent=self.root,
@@ -93,61 +266,122 @@ class App(ttk.Frame):
                                 filetypes=(("CSV files","*.csv"),("all files","*.*")))                               
         self.update_selected_files(selected_files, replace=False)
         
+    def tfile_row(self, fn):
+        # note: filename is assumed to be the last element by _remove_selected_files
+        if fn in self.tfile_errors:
+            return ['', '', '', '', "ERROR: {}".format(self.tfile_errors[fn]), fn]
+        if fn not in self.tfiles:
+            return ['', '', '', '', self.pending.get(fn, ''), fn]
+        tfile = self.tfiles[fn]
+        if tfile['df'] is None: # only indexed so far; number of readings is an estimate
+            nrows = "~{}".format(tfile['nrows'])
+        else:
+            nrows = tfile['df'].shape[0]
+        status = self.pending.get(fn, 'indexed' if tfile['df'] is None else 'loaded')
+        return [tfile['station'], tfile['first'], tfile['last'], nrows, status, fn]
+
     def update_tfiles_listbox(self):
-        # update the multicolumn_listbox
+        # update the multicolumn_listbox (re-sorting the rows by the current keys)
         self.selected_files_strvar.set(str(self.tfiles.keys()))
-        self.mc.clear()
-        for fn, tfile in self.tfiles.items():
-            # note: filename is assumed to be the last element by _remove_selected_files
-            self.mc.insert_row([tfile['station'], 
-                                tfile['df'].index[0],
-                                tfile['df'].index[-1],
-                                tfile['df'].shape[0],
-                                fn])#, index=self.mc.number_of_rows)
+        self.sorted_rows, self.other_rows, self.row_keys, self.row_of = [], [], {}, None
+        for fn in ordereddict.fromkeys(chain(self.tfiles, self.tfile_errors, self.pending)):
+            self._add_row_key(fn)
+        self.mc.update([self.tfile_row(fn) for _, fn in chain(self.sorted_rows, self.other_rows)])
         self.mc.fit_width_to_content()
 
+    def _add_row_key(self, fn):
+        if fn in self.tfiles:
+            rows, key = self.sorted_rows, (tfile_sort_key((fn, self.tfiles[fn])), fn)
+        else:
+            rows, key = self.other_rows, (next(self.row_serial), fn)
+        bisect.insort(rows, key)
+        self.row_keys[fn] = (rows, key)
+
+    def _remove_row_key(self, fn):
+        rows, key = self.row_keys.pop(fn)
+        del rows[bisect.bisect_left(rows, key)]
+
+    def _on_column_sort(self):
+        # the rows were reordered by a column heading; keep that order
+        self.row_of = {fn: i for i, fn in enumerate(self.mc.column_data(len(TFILE_COLUMNS)-1))}
+
+    def row_index(self, fn):
+        # listbox row of fn (None if not listed)
+        if self.row_of is not None:
+            return self.row_of.get(fn)
+        if fn not in self.row_keys:
+            return None
+        rows, key = self.row_keys[fn]
+        i = bisect.bisect_left(rows, key)
+        return i if rows is self.sorted_rows else len(self.sorted_rows)+i
+
+    def update_tfile_row(self, fn, move=False):
+        # update the file's row in place or insert it (in sort order if
+        # indexed, else after the others); move re-inserts it
+        row = self.tfile_row(fn)
+        index = self.row_index(fn)
+        if self.row_of is not None: # sorted by a column; no moves, new rows go last
+            if index is None:
+                self.row_of[fn] = len(self.row_of)
+                self.mc.insert_row(row)
+            else:
+                self.mc.update_row(index, row)
+            return
+        if index is not None:
+            if not move:
+                self.mc.update_row(index, row)
+                return
+            self.mc.delete_row(index)
+            self._remove_row_key(fn)
+        self._add_row_key(fn)
+        self.mc.insert_row(row, self.row_index(fn))
+
     def _on_select(self, data):
         # called when a multicolumn_listbox row is selected
         pass
 
     def _remove_selected_files(self):
         for row in self.mc.selected_rows:
-            del self.tfiles[row[-1]]
+            if row[-1] in self.pending:
+                self.pending[row[-1]] = 'removed' # ignore the result
+            self.tfiles.pop(row[-1], None)
+            self.tfile_errors.pop(row[-1], None)
+            if self.row_of is None:
+                self._remove_row_key(row[-1])
         self.mc.delete_all_selected_rows()
-        
+        if self.row_of is not None:
+            self._on_column_sort() # rows after the deleted ones moved up
+        self.update_stations()
+
     def update_selected_files(self, selected_files, replace=False):
         if replace:
             self.tfiles = ordereddict()
-        for i,fn in enumerate(selected_files):
-            if fn not in self.tfiles:
-                print("Loading", fn)
-                df = pd.read_csv(fn, parse_dates=['Date']).dropna()
-                tcol = [x for x in df.columns if x.startswith('Temperature ')]
-                if len(tcol) < 1:
-                    print("ERROR: Temperature column not found", file=sts.stderr)
-                else:
-                    tmp = [x.strip() for x in tcol[0].split(',')]
-                    station = tmp[-1]                   
-                    t = df.loc[:,['Date',tcol[0]]]
-                    t.set_index('Date', inplace=True)
-                    t.columns = ['temperature']
-                    t.sort_index(inplace=True)
-                    #t['station'] = station
-                    first = t.index[0]
-                    last = t.index[-1]
-                    self.tfiles[fn] = dict()
-                    self.tfiles[fn]['df'] = t                
-                    self.tfiles[fn]['station'] = station
-                    self.tfiles[fn]['tcol'] = tcol[0]
-        self.sort_tfiles()
-        self.update_stations()
+            self.tfile_errors = ordereddict()
+            self.sorted_rows, self.other_rows, self.row_keys, self.row_of = [], [], {}, None
+            self.mc.clear()
+        # index the new files in the pool; rows appear as each one is done (see _poll)
+        for fn in selected_files:
+            if fn not in self.tfiles and fn not in self.pending:
+                print("Indexing", fn)
+                self.tfile_errors.pop(fn, None) # try again
+                self.submit(fn, 'indexing', index_tfile, fn, 'Date', 'Temperature ')
+
+    def tfile_df(self, fn):
+        # fully parse a temperature file (once)
+        tfile = self.tfiles[fn]
+        if tfile['df'] is None:
+            print("Loading", fn)
+            self.set_tfile_df(fn, load_tfile(fn, 'Date', tfile['tcol'])[1])
+        return tfile['df']
+
+    def set_tfile_df(self, fn, df):
+        tfile = self.tfiles[fn]
+        tfile['df'] = df
+        tfile['first'] = df.index[0]
+        tfile['last'] = df.index[-1]
 
     def sort_tfiles(self):
-        # sort by station, first date, last date
-        self.tfiles = ordereddict(sorted(self.tfiles.items(), 
-                                    key=lambda x: (x[1]['df'].index[-1], 
-                                                   x[1]['df'].index[0],
-                                                   x[1]['station'])))
+        self.tfiles = ordereddict(sorted(self.tfiles.items(), key=tfile_sort_key))
         print(*list(self.tfiles.keys()), sep='\n')
         self.update_tfiles_listbox()
 
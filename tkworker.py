@@ -0,0 +1,143 @@
+"""
+Run pipeline functions in a worker thread so the Tk window stays responsive.
+Progress events (stage, percent, rows) come from the instrument.py stage
+timers and are passed back through a queue that the Tk thread polls with
+after().  A run can be cancelled; it stops at the next stage boundary.
+
+    worker = Worker(func, arg1, arg2, stages=PIPELINE_STAGES)
+    worker.start()
+    poll(widget, worker, on_progress, on_done)  # on_done(result, error)
+    ...
+    worker.cancel()
+
+Tk and matplotlib (pyplot) must only be used from the Tk thread, so func
+should only load and compute.
+"""
+
+import threading
+import queue
+import logging
+
+import instrument
+
+## CONSTANTS ##
+# stages timed by ddtool_html (load_temperature_data & main_process) in order
+PIPELINE_STAGES = ['load', 'qc', 'aggregate', 'neighbor fill', 'gap-fill', 'normals', 'projection', 'DD', 'generation solve']
+POLL_INTERVAL_MS = 100
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Worker(object):
+    """
+    Calls func(*args, **kwargs) in a daemon thread.  events is a queue of
+        ('progress', stage, percent, rows) when a stage starts (rows None) or ends
+        ('done', result, None) or ('done', None, exception) at the end (Cancelled if cancelled)
+    stages is the expected order of the top level stages, for the percent.
+    """
+    def __init__(self, func, *args, stages=PIPELINE_STAGES, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.stages = list(stages)
+        self.events = queue.Queue()
+        self._cancel = threading.Event()
+        self._done = 0 # number of top level stages finished
+        self._depth = 0
+        self.thread = threading.Thread(target=self._run, name='pipeline worker', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def percent(self):
+        return 100.*min(self._done, len(self.stages))/max(1, len(self.stages))
+
+    def _listener(self, event, arg):
+        # called by instrument in the worker thread
+        if threading.current_thread() is not self.thread:
+            return
+        if event == 'start':
+            if self._cancel.is_set():
+                raise Cancelled()
+            self._depth += 1
+            self.events.put(('progress', arg, self.percent(), None))
+        else:
+            self._depth -= 1
+            if self._depth == 0 and arg['stage'] in self.stages:
+                self._done = self.stages.index(arg['stage'])+1
+            self.events.put(('progress', arg['stage'], self.percent(), arg['rows']))
+            if self._cancel.is_set():
+                raise Cancelled()
+
+    def _run(self):
+        instrument.add_listener(self._listener)
+        try:
+            result = self.func(*self.args, **self.kwargs)
+            if self._cancel.is_set():
+                raise Cancelled()
+            self.events.put(('done', result, None))
+        except Exception as e:
+            if not isinstance(e, Cancelled):
+                logging.exception("Pipeline worker failed")
+            self.events.put(('done', None, e))
+        finally:
+            instrument.remove_listener(self._listener)
+
+
+def poll(widget, worker, on_progress, on_done, interval=POLL_INTERVAL_MS):
+    """
+    Pass the worker events to on_progress(stage, percent, rows) and
+    on_done(result, error) from the Tk thread, checking every interval ms
+    """
+    while True:
+        try:
+            ev = worker.events.get_nowait()
+        except queue.Empty:
+            break
+        if ev[0] == 'progress':
+            on_progress(*ev[1:])
+        else:
+            on_done(*ev[1:])
+            return
+    widget.after(interval, poll, widget, worker, on_progress, on_done, interval)
+
+
+def run_blocking(tkroot, worker, on_progress):
+    """
+    Start worker and run the Tk event loop until it is done (for scripts
+    which otherwise run top to bottom, eg: ddtool_html.main_process).
+    Closing the window cancels the worker.  Returns the result or raises
+    the worker's exception.
+    """
+    out = {}
+    def on_done(result, error):
+        out['result'] = result
+        out['error'] = error
+        tkroot.quit() # leave the mainloop below
+    def on_close():
+        worker.cancel()
+        on_progress('cancelling', worker.percent(), None)
+    prev_close = tkroot.protocol('WM_DELETE_WINDOW')
+    tkroot.protocol('WM_DELETE_WINDOW', on_close)
+    worker.start()
+    poll(tkroot, worker, on_progress, on_done)
+    tkroot.mainloop()
+    if 'error' not in out: # window destroyed
+        worker.cancel()
+        raise Cancelled()
+    tkroot.protocol('WM_DELETE_WINDOW', prev_close or '')
+    if out['error'] is not None:
+        raise out['error']
+    return out['result']